@@ -0,0 +1,282 @@
+import argparse
+import contextlib
+import json
+import os
+import runpy
+import shlex
+import sys
+import threading
+import time
+from typing import Any, Optional
+
+import bedrock
+from bedrock import SOFT_ATTRIBUTE_INSTRUCTIONS, llm_cost, soft_attribute_max_tokens
+from budget import Budget, estimate_tokens
+from chunky import MAX_CHUNK_SIZE, dedupe_chunks, extract_relevant_chunks
+from export import section_text
+from metrics import metrics
+from pathy import find_element
+from prefilter import Prefilter
+from preprocess import resolve_references, strip_namespaces
+from sources import Document, find_documents, open_document
+from test import normalize_text
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = {"test": "test.py", "tag": "tag.py"}
+
+# prompt text around the section text of a soft attribute request
+PROMPT_OVERHEAD_TOKENS = estimate_tokens(SOFT_ATTRIBUTE_INSTRUCTIONS) + 40
+
+
+def estimate_document(
+    document: Document,
+    script: str,
+    prefilter: Optional[Prefilter] = None,
+    max_chunk_size: int = MAX_CHUNK_SIZE,
+    dedupe: str = "normalized",
+) -> dict[str, Any]:
+    """
+    LLM requests, tokens and dollars a document will take at most, from its chunks
+
+    test.py asks once per section without a table, tag.py once per chunk that is not
+    a table, leaving out the sections the prefilter (if the scripts run with one) skips
+    on their plain text; every request is counted with its whole max_tokens as output
+    """
+    tree = resolve_references(document)
+    strip_namespaces(tree)
+    texts: dict[str, str] = {}
+    sections: dict[str, tuple[str, Optional[str]]] = {}
+    for chunk in dedupe_chunks(extract_relevant_chunks(tree, max_chunk_size), dedupe, normalize_text):
+        text = chunk.get("text", "")
+        if script == "test.py":
+            if not chunk["section_has_table"]:
+                texts[chunk["section_path"]] = texts.get(chunk["section_path"], "") + text
+                sections[chunk["section_path"]] = (chunk["section_path"], chunk.get("section_code"))
+        elif not chunk["is_table"]:
+            sections[str(len(texts))] = (chunk["section_path"], chunk.get("section_code"))
+            texts[str(len(texts))] = text
+    if prefilter is not None:
+        kept = {
+            (path, code): prefilter.keep(section_text(find_element(tree.getroot(), path)), code)
+            for path, code in set(sections.values())
+        }
+        texts = {k: t for k, t in texts.items() if kept[sections[k]]}
+    input_tokens = sum(PROMPT_OVERHEAD_TOKENS + estimate_tokens(t) for t in texts.values())
+    output_tokens = len(texts) * soft_attribute_max_tokens()
+    return {
+        "requests": len(texts),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "dollars": round(llm_cost(input_tokens, output_tokens), 6),
+    }
+
+
+def load_priorities(path: Optional[str]) -> dict[str, float]:
+    """
+    {input, document path or document name: priority} from a json file, higher runs first
+    """
+    if not path:
+        return {}
+    with open(path, "r") as f:
+        return {k: float(v) for k, v in json.load(f).items()}
+
+
+class Job:
+    def __init__(self, document: Document, priority: float, estimate: dict[str, Any]):
+        self.document = document
+        self.priority = priority
+        self.estimate = estimate
+
+
+class DocumentScheduler:
+    """
+    runs test.py or tag.py over many documents within an LLM budget
+
+    every document's LLM usage is estimated up front; documents run one at a time by
+    descending priority (input order among equals), each admitted once its expected usage
+    fits the budget's windows. the expectation is the estimate scaled by how far off the
+    estimates of the documents already run were. inside a document every request still
+    reserves its own size, so the limits hold exactly; the spend is shown live and
+    accounted per document
+    """
+
+    def __init__(self, script: str, budget: Budget, script_args: Optional[list[str]] = None, log_dir: str = "out/batch"):
+        self.script = script
+        self.budget = budget
+        self.script_args = script_args or []
+        # the scripts skip what their prefilter rules out, so the estimates do too
+        self.prefilter = Prefilter.from_env() if "--prefilter" in self.script_args else None
+        # and chunk the documents the same way
+        chunking = argparse.ArgumentParser(add_help=False)
+        chunking.add_argument("--max-chunk-size", type=int, default=MAX_CHUNK_SIZE)
+        chunking.add_argument("--dedupe", default="normalized")
+        self.chunking, _ = chunking.parse_known_args(self.script_args)
+        self.log_dir = log_dir
+        self.jobs: list[Job] = []
+        self.current = ""
+        self.results: list[dict[str, Any]] = []
+
+    def add(self, document: Document, priority: float = 0.0) -> Job:
+        job = Job(
+            document,
+            priority,
+            estimate_document(
+                document, self.script, self.prefilter, self.chunking.max_chunk_size, self.chunking.dedupe
+            ),
+        )
+        self.jobs.append(job)
+        return job
+
+    def plan(self) -> list[Job]:
+        # sorted() is stable, so equal priorities keep their input order
+        return sorted(self.jobs, key=lambda j: -j.priority)
+
+    def expected(self, job: Job) -> tuple[int, float]:
+        """
+        (tokens, dollars) a document is expected to use: its estimate, scaled by the ratio
+        of actual to estimated input and output tokens of the documents completed so far
+        """
+        done = [r for r in self.results if r["status"] == "ok" and r["actual"]["requests"]]
+        scales = []
+        for kind, actual_kinds in [("input_tokens", ["input_tokens", "cache_read_tokens", "cache_write_tokens"]), ("output_tokens", ["output_tokens"])]:
+            estimated = sum(r["estimate"][kind] for r in done)
+            actual = sum(r["actual"][k] for r in done for k in actual_kinds)
+            scales.append(actual / estimated if estimated else 1.0)
+        input_tokens = round(job.estimate["input_tokens"] * scales[0])
+        output_tokens = round(job.estimate["output_tokens"] * scales[1])
+        return input_tokens + output_tokens, llm_cost(input_tokens, output_tokens)
+
+    def _run_script(self, job: Job, log_path: str) -> dict[str, Any]:
+        argv = sys.argv
+        sys.argv = [self.script, job.document.label] + self.script_args
+        metrics.reset()
+        try:
+            with open(log_path, "w") as log, contextlib.redirect_stdout(log):
+                scope = runpy.run_path(os.path.join(SRC_DIR, self.script), run_name="__main__")
+            return {"status": "ok", "run_key": scope["run"].key}
+        except SystemExit as e:
+            return {"status": f"exited with {e.code}"}
+        except Exception as e:
+            return {"status": f"failed: {e!r}"}
+        finally:
+            sys.argv = argv
+
+    def _show(self, stop: threading.Event, stream: Any, interval: float) -> None:
+        while not stop.wait(interval):
+            stream.write(f"{self.current}: {self.budget.line()}\n")
+            stream.flush()
+
+    def run(self, interval: float = 10.0) -> list[dict[str, Any]]:
+        """
+        runs every document, returns one result per document in the order they ran
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        plan = self.plan()
+        stream = sys.stdout
+        stop = threading.Event()
+        display = threading.Thread(target=self._show, args=(stop, stream, interval), daemon=True)
+        display.start()
+        try:
+            for i, job in enumerate(plan):
+                self.current = f"[{i + 1}/{len(plan)}] {job.document.label}"
+                stream.write(
+                    f"{self.current}: priority {job.priority:g}, estimated {job.estimate['requests']} requests, "
+                    f"{job.estimate['input_tokens']} in / {job.estimate['output_tokens']} out tokens, "
+                    f"${job.estimate['dollars']:.4f}\n"
+                )
+                waited = self.budget.admit(*self.expected(job))
+                if waited > 0.5:
+                    stream.write(f"{self.current}: waited {waited:.1f}s for the budget\n")
+                before = self.budget.spend()
+                start = time.perf_counter()
+                log_path = os.path.join(self.log_dir, f"{i + 1:03d}-{job.document.name}.log")
+                outcome = self._run_script(job, log_path)
+                after = self.budget.spend()
+                actual = {k: after[k] - before[k] for k in after}
+                actual["dollars"] = round(actual["dollars"], 6)
+                result = {
+                    "document": job.document.label,
+                    "priority": job.priority,
+                    **outcome,
+                    "log": log_path,
+                    "seconds": round(time.perf_counter() - start, 3),
+                    "waited_seconds": round(waited, 3),
+                    "estimate": job.estimate,
+                    "actual": actual,
+                }
+                self.results.append(result)
+                stream.write(
+                    f"{self.current}: {outcome['status']}, {actual['requests']} requests, ${actual['dollars']:.4f}; "
+                    f"{self.budget.line()}\n"
+                )
+        finally:
+            stop.set()
+            display.join()
+        return self.results
+
+    def report(self) -> dict[str, Any]:
+        return {
+            "script": self.script,
+            "limits": {
+                "tokens_per_minute": self.budget.tokens_per_minute,
+                "dollars_per_hour": self.budget.dollars_per_hour,
+            },
+            "pricing_per_1k_tokens": dict(bedrock.LLM_PRICING),
+            "total": {**self.budget.spend(), "waited_seconds": round(self.budget.waited, 3)},
+            "documents": self.results,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="python batch.py {test,tag} <inputs...> [--priority priorities.json] "
+        "[--tokens-per-minute N] [--dollars-per-hour USD] [--script-args \"--concurrency 4\"]"
+    )
+    parser.add_argument("script", choices=sorted(SCRIPTS))
+    parser.add_argument("inputs", nargs="+", help="xml files (compressed or not), tar archives or directories")
+    parser.add_argument("--priority", help="json file of {input or document name: priority}, higher runs first")
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=int,
+        default=bedrock.budget.tokens_per_minute,
+        help="LLM input + output tokens per rolling minute (default LLM_TOKENS_PER_MINUTE, unlimited)",
+    )
+    parser.add_argument(
+        "--dollars-per-hour",
+        type=float,
+        default=bedrock.budget.dollars_per_hour,
+        help="LLM spend per rolling hour (default LLM_DOLLARS_PER_HOUR, unlimited)",
+    )
+    parser.add_argument("--script-args", default="", help="options passed to every test.py / tag.py run")
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds between live spend lines")
+    parser.add_argument("--report", default="out/batch_report.json")
+    args = parser.parse_args()
+
+    if "-" in args.inputs:
+        raise SystemExit("batch.py runs every document again by name, stdin cannot be used")
+
+    budget = Budget(args.tokens_per_minute, args.dollars_per_hour)
+    bedrock.set_budget(budget)
+    scheduler = DocumentScheduler(SCRIPTS[args.script], budget, shlex.split(args.script_args))
+    priorities = load_priorities(args.priority)
+    for spec in find_documents(args.inputs):
+        document = open_document(spec)
+        priority = next(
+            (priorities[k] for k in (spec, document.path, document.name) if k in priorities),
+            0.0,
+        )
+        scheduler.add(document, priority)
+
+    scheduler.run(args.interval)
+    report = scheduler.report()
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    total = report["total"]
+    print("------------------------------------------------------------")
+    print(f"Documents: {len(scheduler.results)}, {sum(r['status'] == 'ok' for r in scheduler.results)} completed")
+    print(f"LLM requests: {total['requests']}")
+    print(f"LLM input / output tokens: {total['input_tokens']} / {total['output_tokens']}")
+    print(f"LLM prompt cache read / write tokens: {total['cache_read_tokens']} / {total['cache_write_tokens']}")
+    print(f"LLM cost: ${total['dollars']:.4f}, {total['waited_seconds']:.1f}s waiting for the budget")
+    print(f"Report: {args.report}")
@@ -1,9 +1,17 @@
 import json
 import os
+import re
+import threading
 import time
-from typing import Any
-import boto3
+from typing import Any, Optional
+
 from dotenv import load_dotenv
+from lxml import etree  # type: ignore
+
+from budget import Budget, estimate_tokens
+from metrics import metrics
+from records import parse_soft_attributes
+from router import Endpoint, Router, base_model, parse_endpoints
 
 load_dotenv()
 
@@ -11,67 +19,468 @@ embedding_model_id = "amazon.titan-embed-text-v2:0"
 llm_model_id = os.getenv("LLM_MODEL_ID", "us.anthropic.claude-haiku-4-5-20251001-v1:0")
 lite_model_id = os.getenv("LITE_MODEL_ID", "amazon.nova-2-lite-v1:0")
 
-# Support both .env file and default boto3 credential chain
-aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
-aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
-aws_session_token = os.getenv("AWS_SESSION_TOKEN")
-
-if aws_access_key_id and aws_secret_access_key:
-    client = boto3.client(
-        "bedrock-runtime",
-        region_name="us-west-2",
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_session_token=aws_session_token,
-    )  # type: ignore
-    bedrock = boto3.client(
-        "bedrock",
-        region_name="us-west-2",
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_session_token=aws_session_token,
-    )  # type: ignore
-else:
-    client = boto3.client("bedrock-runtime", region_name="us-west-2")  # type: ignore
-    bedrock = boto3.client("bedrock", region_name="us-west-2")  # type: ignore
+region_name = os.getenv("BEDROCK_REGION") or "us-west-2"
+
+# size of the urllib3 connection pool shared by each client; should be at least
+# the number of requests that can be in flight at once
+max_pool_connections = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS") or 10)
+
+# LLM answers are read with invoke_model_with_response_stream and cut off once complete;
+# set BEDROCK_STREAMING=0 for models or endpoints without streaming support
+streaming = (os.getenv("BEDROCK_STREAMING") or "1") != "0"
+
+# static instructions are sent as a system prompt ending in a cache point, so repeated
+# calls read them from Bedrock's prompt cache; "auto" enables it for models that support it
+prompt_caching = (os.getenv("BEDROCK_PROMPT_CACHING") or "auto").lower()
+PROMPT_CACHING_MODELS = re.compile(
+    r"anthropic\.claude-(3-5-haiku|3-7-sonnet|sonnet-4|opus-4|haiku-4)"
+)
+
+# USD per 1000 LLM tokens, https://aws.amazon.com/bedrock/pricing/ as of 04/01/2025;
+# cache reads cost 10% and cache writes 125% of the input price
+# override with e.g. LLM_PRICING="input=0.001,output=0.005,cache_read=0.0001,cache_write=0.00125"
+LLM_PRICING = {"input": 0.003, "output": 0.015, "cache_read": 0.0003, "cache_write": 0.00375}
+
+
+def set_pricing(spec: str) -> None:
+    """
+    updates LLM_PRICING from "kind=USD per 1000 tokens" pairs separated by commas
+    """
+    for price in spec.split(","):
+        if not price.strip():
+            continue
+        kind, _, value = (p.strip() for p in price.partition("="))
+        if kind not in LLM_PRICING:
+            raise ValueError(f"LLM_PRICING: unknown price {kind!r}, expected one of {', '.join(LLM_PRICING)}")
+        LLM_PRICING[kind] = float(value)
+
+
+set_pricing(os.getenv("LLM_PRICING") or "")
+
+# tokens/minute and dollars/hour limits on LLM requests (LLM_TOKENS_PER_MINUTE,
+# LLM_DOLLARS_PER_HOUR) and the exact spend so far, see budget.py
+budget = Budget.from_env()
+
+# comma separated "region" or "region=model id / inference profile" lists to spread requests
+# over, e.g. "us-west-2,us-east-1"; by default everything goes to region_name
+llm_endpoints = os.getenv("BEDROCK_LLM_ENDPOINTS") or ""
+embedding_endpoints = os.getenv("BEDROCK_EMBEDDING_ENDPOINTS") or ""
+
+# clients are built on first use so that importing this module (and everything
+# that imports it) does not pay for boto3 when no bedrock call is ever made
+_clients: dict[str, Any] = {}
+_clients_lock = threading.Lock()
+
+
+def configure(pool_connections: int) -> None:
+    """
+    sets the connection pool size for clients created from now on
+    call before the first bedrock request, e.g. with the run's concurrency level
+    """
+    global max_pool_connections
+    with _clients_lock:
+        if pool_connections > max_pool_connections:
+            max_pool_connections = pool_connections
+            _clients.clear()
+
+
+def _client_key(service: str, region: Optional[str]) -> str:
+    return service if region in (None, region_name) else f"{service}:{region}"
+
+
+def set_client(service: str, c: Any, region: Optional[str] = None) -> None:
+    """
+    replaces the client for a service ("bedrock-runtime" or "bedrock"), e.g. with a fake
+    `region` defaults to region_name
+    """
+    with _clients_lock:
+        _clients[_client_key(service, region)] = c
+
+
+def get_client(service: str = "bedrock-runtime", region: Optional[str] = None) -> Any:
+    """
+    returns the pooled client for a service in a region (default region_name), creating it on first use
+    """
+    key = _client_key(service, region)
+    c = _clients.get(key)
+    if c is not None:
+        return c
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = _create_client(service, region or region_name)
+        return _clients[key]
+
+
+def _create_client(service: str, region: str) -> Any:
+    import boto3
+    from botocore.config import Config
+
+    config = Config(max_pool_connections=max_pool_connections)
+
+    # Support both .env file and default boto3 credential chain
+    aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
+    aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
+    aws_session_token = os.getenv("AWS_SESSION_TOKEN")
+
+    if aws_access_key_id and aws_secret_access_key:
+        return boto3.client(  # type: ignore
+            service,
+            region_name=region,
+            config=config,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            aws_session_token=aws_session_token,
+        )
+    return boto3.client(service, region_name=region, config=config)  # type: ignore
+
+
+_routers: dict[str, Router] = {}
+_routers_lock = threading.Lock()
+
+
+def _endpoint_client(endpoint: Endpoint) -> Any:
+    return endpoint.client if endpoint.client is not None else get_client("bedrock-runtime", endpoint.region)
+
+
+def set_endpoints(op: str, endpoints: list[Endpoint], **router_options: Any) -> Router:
+    """
+    routes the requests of op ("llm" or "embedding") over these endpoints
+    router_options are passed to router.Router (cooldown, max_cooldown, max_retries)
+    raises ValueError if an embedding endpoint would use a different model than
+    embedding_model_id, since vectors of different models cannot be compared
+    """
+    if op not in ("llm", "embedding"):
+        raise ValueError(f"unknown op {op!r}, expected 'llm' or 'embedding'")
+    if op == "embedding":
+        mixed = [e.name for e in endpoints if e.model_id and base_model(e.model_id) != base_model(embedding_model_id)]
+        if mixed:
+            raise ValueError(
+                f"embedding endpoints {mixed} do not use {embedding_model_id}; embeddings must all come from one model"
+            )
+    router = Router(op, endpoints, _endpoint_client, **router_options)
+    with _routers_lock:
+        _routers[op] = router
+    return router
+
+
+def get_router(op: str) -> Router:
+    """
+    the router of op, built on first use from BEDROCK_LLM_ENDPOINTS / BEDROCK_EMBEDDING_ENDPOINTS
+    """
+    router = _routers.get(op)
+    if router is not None:
+        return router
+    spec = llm_endpoints if op == "llm" else embedding_endpoints
+    return set_endpoints(op, parse_endpoints(spec) or [Endpoint(region_name)])
+
+
+def __getattr__(name: str) -> Any:
+    # keeps `bedrock.client` / `bedrock.bedrock` working for existing callers
+    if name == "client":
+        return get_client("bedrock-runtime")
+    if name == "bedrock":
+        return get_client("bedrock")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def test_bedrock():
-    response = bedrock.list_foundation_models()  # type: ignore
+    response = get_client("bedrock").list_foundation_models()  # type: ignore
     summarries = response["modelSummaries"]  # type: ignore
     for model in summarries:  # type: ignore
         print(model["modelName"], "| model id:", model["modelId"])  # type: ignore
 
 
-def invoke_llm(body: Any, modelId: str = llm_model_id, retries: int = 0) -> Any:
-    # print("invoking llm, retries:", retries)
+def set_budget(b: Budget) -> None:
+    """
+    replaces the LLM budget, e.g. with one shared by a batch of documents
+    """
+    global budget
+    budget = b
+
+
+def _routed(op: str, modelId: str, call: Any) -> Any:
+    """
+    runs call(client, model id) on the endpoints of op, failing over on throttling
+    exits like before when every endpoint keeps failing
+    """
+    default = llm_model_id if op == "llm" else embedding_model_id
     try:
-        return client.invoke_model(modelId=modelId, body=body)  # type: ignore
+        return get_router(op).call(lambda client, endpoint: call(client, endpoint.model_for(default, modelId)))
     except Exception as e:
-        if "(ThrottlingException)" in str(e) and retries < 3:
-            time.sleep((retries + 1) * 8)
-            return invoke_llm(
-                body,
-                modelId,
-                retries + 1,
-            )
         print(e)
         exit(1)
 
 
-def invoke_embedding(body: Any, retries: int = 0) -> Any:
-    # print("invoking embedding, retries:", retries)
+def invoke_llm(body: Any, modelId: str = llm_model_id) -> Any:
+    return _routed("llm", modelId, lambda client, model: client.invoke_model(modelId=model, body=body))
+
+
+def invoke_embedding(body: Any) -> Any:
+    return _routed(
+        "embedding", embedding_model_id, lambda client, model: client.invoke_model(modelId=model, body=body)
+    )
+
+
+# expected answer structure of the soft attribute questions
+SOFT_ATTRIBUTE_FORMAT = (
+    '<pregnancy pregnant="true" or "false" or "null">\n'
+    "<reasoning>explaination of your chain of thought for this record</reasoning>\n"
+    "</pregnancy>\n"
+    '<travel status="true" or "false" or "null">\n'
+    "<recent_travel>\n"
+    "<reasoning>explaination of your chain of thought for this record</reasoning>\n"
+    "<location>string (in City,ST format)</location>\n"
+    "<date>string (in MM/DD/YYYY format)</date>\n"
+    "</recent_travel>\n"
+    "... more recent travels if any\n"
+    "</travel>\n"
+    '<occupation employed="true" or "false" or "null">\n'
+    "<reasoning>explaination of your chain of thought for this record</reasoning>\n"
+    "<job>string</job>\n"
+    "</occupation>\n"
+    'For each field, if the text does not indicate any specific information, return "null" for the boolean value '
+    "and an empty string for the text fields. Do not add any extra keys."
+)
+
+
+def llm_cost(
+    input_tokens: float, output_tokens: float, cache_read_tokens: float = 0, cache_write_tokens: float = 0
+) -> float:
+    """
+    approximate USD cost of LLM usage at LLM_PRICING
+    """
+    return (
+        input_tokens * LLM_PRICING["input"]
+        + output_tokens * LLM_PRICING["output"]
+        + cache_read_tokens * LLM_PRICING["cache_read"]
+        + cache_write_tokens * LLM_PRICING["cache_write"]
+    ) / 1000
+
+
+def supports_prompt_caching(modelId: str = llm_model_id) -> bool:
+    if prompt_caching in ("0", "false", "off"):
+        return False
+    if prompt_caching in ("1", "true", "on"):
+        return True
+    return PROMPT_CACHING_MODELS.search(modelId) is not None
+
+
+def cache_tokens() -> tuple[int, int]:
+    """
+    prompt cache (read, write) input tokens recorded in this process
+    """
+    return (
+        int(metrics.counter("llm_cache_tokens", kind="read")),
+        int(metrics.counter("llm_cache_tokens", kind="write")),
+    )
+
+
+def _record_cache_usage(read: Any, write: Any) -> None:
+    if read:
+        metrics.incr("llm_cache_tokens", int(read), kind="read")
+    if write:
+        metrics.incr("llm_cache_tokens", int(write), kind="write")
+
+
+def anthropic_request(system: str, user: str, max_tokens: int, modelId: str = llm_model_id) -> dict[str, Any]:
+    """
+    request body with the static instructions as system prompt and the per-call text as the
+    user message; the system prompt ends in a cache point when the model supports prompt caching
+    """
+    system_block: dict[str, Any] = {"type": "text", "text": system}
+    if supports_prompt_caching(modelId):
+        system_block["cache_control"] = {"type": "ephemeral"}
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "system": [system_block],
+        "messages": [{"role": "user", "content": [{"type": "text", "text": user}]}],
+        "max_tokens": max_tokens,
+    }
+
+
+# static part of the soft attribute prompts, sent first so that it can be cached
+SOFT_ATTRIBUTE_INSTRUCTIONS = (
+    "You will be given text from a patient's record. "
+    "Answer these questions in XML format with the following keys and structure:\n\n"
+    + SOFT_ATTRIBUTE_FORMAT
+    + " Keep each reasoning to one or two sentences."
+)
+
+
+# output budget of one free-text <reasoning> field, the prompts ask for one or two sentences
+REASONING_TOKENS = 60
+
+# max_tokens of the second try when a soft attribute answer is cut off or does not validate
+SOFT_ATTRIBUTE_RETRY_MAX_TOKENS = 1000
+
+
+def _answer_format() -> str:
+    # the answer holds one of the listed flag values, not the alternatives
+    return re.sub(r'( or "\w+")+', "", SOFT_ATTRIBUTE_FORMAT)
+
+
+def soft_attribute_stop_tags() -> dict[str, int]:
+    """
+    top-level elements of SOFT_ATTRIBUTE_FORMAT; the answer is complete once each is closed
+    """
+    root = etree.fromstring(f"<answer>{_answer_format()}</answer>", etree.XMLParser(recover=True))  # type: ignore
+    return {el.tag: 1 for el in root if isinstance(el.tag, str)}
+
+
+def soft_attribute_max_tokens(travels: int = 2) -> int:
+    """
+    max_tokens for one soft attribute answer, derived from SOFT_ATTRIBUTE_FORMAT:
+    the markup of its tags plus a reasoning budget per <reasoning>, allowing `travels` trips
+    """
+    answer_format = _answer_format()
+    travel = re.search(r"<recent_travel>.*?</recent_travel>", answer_format, re.S).group(0)  # type: ignore
+    tags = re.findall(r"</?\w+[^>]*>", answer_format) + re.findall(r"</?\w+[^>]*>", travel) * (travels - 1)
+    reasoning = answer_format.count("<reasoning>") + travel.count("<reasoning>") * (travels - 1)
+    # ~3 characters per token for markup, plus short values (location, date, job)
+    return sum(len(t) for t in tags) // 3 + reasoning * REASONING_TOKENS + 16 * (travels + 1)
+
+
+class TagStreamParser:
+    """
+    incremental check of streamed model output for closing tags
+    feed() returns True once every tag in `required` has been closed the given number of times
+    """
+
+    def __init__(self, required: dict[str, int]):
+        self.parts: list[str] = []
+        self._text = ""
+        self._remaining = {tag: n for tag, n in required.items() if n > 0}
+        self._pos = {tag: 0 for tag in self._remaining}
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    def feed(self, delta: str) -> bool:
+        self._text += delta
+        for tag in list(self._remaining):
+            closing = f"</{tag}>"
+            i = self._text.find(closing, self._pos[tag])
+            while i >= 0 and self._remaining[tag] > 0:
+                self._remaining[tag] -= 1
+                self._pos[tag] = i + len(closing)
+                i = self._text.find(closing, self._pos[tag])
+            if self._remaining[tag] == 0:
+                del self._remaining[tag]
+            else:
+                # a closing tag split over two deltas is found on the next call
+                self._pos[tag] = max(self._pos[tag], len(self._text) - len(closing) + 1)
+        return not self._remaining
+
+
+def invoke_llm_stream(
+    body: Any, modelId: str = llm_model_id, stop: Optional[dict[str, int]] = None
+) -> tuple[str, int, int, int, int]:
+    """
+    invoke_llm through the response stream
+    returns (text, input tokens, output tokens, cache read tokens, cache write tokens)
+    reading stops as soon as every tag in `stop` has been closed the given number of times;
+    the output tokens of a stream cut off that way are estimated from the text received
+    """
+
+    def read(client: Any, model: str) -> tuple[str, int, int, int, int]:
+        start = time.perf_counter()
+        parser = TagStreamParser(stop or {})
+        input_tokens = output_tokens = cache_read = cache_write = 0
+        early = False
+        response = client.invoke_model_with_response_stream(modelId=model, body=body)  # type: ignore
+        events = response["body"]
+        first = True
+        for event in events:
+            if "chunk" not in event:
+                # modeled stream errors, e.g. {"throttlingException": {"message": ...}}
+                name, detail = next(iter(event.items()))
+                raise RuntimeError(f"({name[0].upper() + name[1:]}) {detail}")
+            data = json.loads(event["chunk"]["bytes"])
+            if data["type"] == "message_start":
+                usage = data["message"].get("usage", {})
+                input_tokens = usage.get("input_tokens", 0)
+                cache_read = usage.get("cache_read_input_tokens", 0)
+                cache_write = usage.get("cache_creation_input_tokens", 0)
+            elif data["type"] == "content_block_delta":
+                if first:
+                    metrics.observe("bedrock_first_token", time.perf_counter() - start, op="llm")
+                    first = False
+                if parser.feed(data["delta"].get("text", "")) and stop:
+                    early = True
+                    break
+            elif data["type"] == "message_delta":
+                output_tokens = data.get("usage", {}).get("output_tokens", output_tokens)
+                if data.get("delta", {}).get("stop_reason") == "max_tokens":
+                    metrics.incr("llm_truncated")
+            invocation = data.get("amazon-bedrock-invocationMetrics")
+            if invocation:
+                input_tokens = invocation.get("inputTokenCount", input_tokens)
+                output_tokens = invocation.get("outputTokenCount", output_tokens)
+                cache_read = invocation.get("cacheReadInputTokenCount", cache_read)
+                cache_write = invocation.get("cacheWriteInputTokenCount", cache_write)
+        if early:
+            metrics.incr("llm_early_stops")
+            output_tokens = max(output_tokens, -(-len(parser.text) // 4))
+            close = getattr(events, "close", None)
+            if close is not None:
+                close()
+        return parser.text, input_tokens, output_tokens, cache_read, cache_write
+
+    return _routed("llm", modelId, read)
+
+
+def _llm_text_and_usage(response: dict[str, Any]) -> tuple[str, int, int, int, int]:
+    headers = response["ResponseMetadata"]["HTTPHeaders"]
+    body = json.loads(response["body"].read())
+    usage = body.get("usage", {})
+    return (
+        body["content"][0]["text"],
+        json.loads(headers["x-amzn-bedrock-input-token-count"]),
+        json.loads(headers["x-amzn-bedrock-output-token-count"]),
+        usage.get("cache_read_input_tokens") or 0,
+        usage.get("cache_creation_input_tokens") or 0,
+    )
+
+
+def complete(request_body: dict[str, Any], stop: dict[str, int], modelId: str = llm_model_id) -> tuple[str, int, int]:
+    """
+    runs an LLM request, streamed unless disabled, returns (text, input tokens, output tokens)
+    `stop` lists the closing tags (and how many of each) that end the answer
+
+    the request waits for room in the LLM budget, reserving its prompt size and max_tokens,
+    and is charged what Bedrock reports once it is done
+    """
+    body = json.dumps(request_body)
+    estimate_in = estimate_tokens(body)
+    estimate_out = int(request_body.get("max_tokens", 0))
+    reservation = budget.reserve(estimate_in + estimate_out, llm_cost(estimate_in, estimate_out))
     try:
-        return client.invoke_model(modelId=embedding_model_id, body=body)  # type: ignore
-    except Exception as e:
-        if "(ThrottlingException)" in str(e) and retries < 3:
-            time.sleep((retries + 1) * 8)
-            return invoke_embedding(
-                body,
-                retries + 1,
-            )
-        print(e)
-        exit(1)
+        if streaming:
+            text, input_tokens, output_tokens, cache_read, cache_write = invoke_llm_stream(body, modelId, stop)
+        else:
+            text, input_tokens, output_tokens, cache_read, cache_write = _llm_text_and_usage(invoke_llm(body, modelId))
+    except BaseException:
+        budget.cancel(reservation)
+        raise
+    _record_cache_usage(cache_read, cache_write)
+    dollars = llm_cost(input_tokens, output_tokens, cache_read, cache_write)
+    budget.settle(reservation, input_tokens, output_tokens, cache_read, cache_write, dollars)
+    metrics.incr("llm_tokens", input_tokens, kind="input")
+    metrics.incr("llm_tokens", output_tokens, kind="output")
+    metrics.incr("llm_dollars", dollars)
+    return text, input_tokens, output_tokens
+
+
+def validated_soft_attributes(text: str) -> Optional[str]:
+    """
+    the answer re-serialized from its SoftAttributes record, None if it does not validate
+    """
+    try:
+        return parse_soft_attributes(text).to_xml()
+    except ValueError:
+        metrics.incr("llm_invalid_responses", kind="soft_attributes")
+        return None
 
 
 def llm_inference(text: str) -> tuple[str, int, int]:
@@ -80,53 +489,55 @@ def llm_inference(text: str) -> tuple[str, int, int]:
     1. is the patient pregnant?
     2. recent travel history?
     3. patient's occupation?
+    the answer is validated into a records.SoftAttributes; one that does not validate (e.g.
+    cut off) is asked for again with SOFT_ATTRIBUTE_RETRY_MAX_TOKENS, and if that one does
+    not validate either it is returned as the model wrote it
+    token counts cover both requests
+    """
+    input_tokens = output_tokens = 0
+    answer = ""
+    for attempt, max_tokens in enumerate([soft_attribute_max_tokens(), SOFT_ATTRIBUTE_RETRY_MAX_TOKENS]):
+        if attempt:
+            metrics.incr("llm_retries", kind="soft_attributes")
+        request_body = anthropic_request(
+            SOFT_ATTRIBUTE_INSTRUCTIONS,
+            f"You are analyzing the following text from a patient's record:\n\n{text}",
+            max_tokens,
+        )
+        answer, in_tokens, out_tokens = complete(request_body, soft_attribute_stop_tags())
+        input_tokens += in_tokens
+        output_tokens += out_tokens
+        validated = validated_soft_attributes(answer)
+        if validated is not None:
+            return validated, input_tokens, output_tokens
+    metrics.incr("llm_unvalidated_answers", kind="soft_attributes")
+    return answer, input_tokens, output_tokens
+
+
+def llm_inference_packed(texts: list[str]) -> tuple[list[Optional[str]], int, int]:
     """
-    prompt = (
-        "You are analyzing the following text from a patient's record:\n\n"
-        f"{text}\n\n"
-        "Answer these questions in XML format with the following keys and structure:\n\n"
-        '<pregnancy pregnant="true" or "false" or "null">\n'
-        "<reasoning>explaination of your chain of thought for this record</reasoning>\n"
-        "</pregnancy>\n"
-        '<travel status="true" or "false" or "null">\n'
-        "<recent_travel>\n"
-        "<reasoning>explaination of your chain of thought for this record</reasoning>\n"
-        "<location>string (in City,ST format)</location>\n"
-        "<date>string (in MM/DD/YYYY format)</date>\n"
-        "</recent_travel>\n"
-        "... more recent travels if any\n"
-        "</travel>\n"
-        '<occupation employed="true" or "false" or "null">\n'
-        "<reasoning>explaination of your chain of thought for this record</reasoning>\n"
-        "<job>string</job>\n"
-        "</occupation>\n"
-        'For each field, if the text does not indicate any specific information, return "null" for the boolean value '
-        "and an empty string for the text fields. Do not add any extra keys."
+    llm_inference for several texts in one request, each answered separately
+    returns one answer per text (None where the model left one out or it does not validate)
+    and the request's token counts
+    """
+    records = "".join(f'<record id="{i + 1}">\n{t}\n</record>\n\n' for i, t in enumerate(texts))
+    request_body = anthropic_request(
+        SOFT_ATTRIBUTE_INSTRUCTIONS,
+        f"You are analyzing the following {len(texts)} records from a patient's record, "
+        "each enclosed in a <record> tag with its id:\n\n"
+        f"{records}"
+        "Answer the questions separately for each record. Enclose the answers for each record in "
+        '<answer id="..."></answer> with the record\'s id, in the same order as the records.',
+        soft_attribute_max_tokens() * len(texts),
     )
-    request_body: dict[str, Any] = {
-        "anthropic_version": "bedrock-2023-05-31",
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 500,
-    }
 
-    response = invoke_llm(json.dumps(request_body), llm_model_id)
-    response_vals = (
-        json.loads(response["body"].read())["content"][0]["text"],
-        json.loads(
-            response["ResponseMetadata"]["HTTPHeaders"][
-                "x-amzn-bedrock-input-token-count"
-            ]
-        ),
-        json.loads(
-            response["ResponseMetadata"]["HTTPHeaders"][
-                "x-amzn-bedrock-output-token-count"
-            ]
-        ),
+    text, in_tokens, out_tokens = complete(request_body, {"answer": len(texts)})
+    answers = dict(re.findall(r'<answer id="(\d+)">\s*(.*?)\s*</answer>', text, re.S))
+    return (
+        [validated_soft_attributes(answers[str(i + 1)]) if str(i + 1) in answers else None for i in range(len(texts))],
+        in_tokens,
+        out_tokens,
     )
-    try:
-        return response_vals
-    except Exception:
-        return None  # type: ignore
 
 
 if __name__ == "__main__":
@@ -0,0 +1,4 @@
+"""
+offline benchmarking helpers: synthetic eICR documents, a fake Bedrock client and
+a throwaway workspace to run the pipeline scripts in (see benchmark.py)
+"""
@@ -0,0 +1,306 @@
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, Iterator
+
+import numpy as np
+
+from bench.synth import SECTION_TYPES
+
+# words that point at each synthetic category, used to answer category prompts
+CATEGORY_HINTS: dict[str, set[str]] = {}
+for _, _, _, _category, _, _topic in SECTION_TYPES:
+    CATEGORY_HINTS.setdefault(_category, set()).update(
+        re.findall(r"[a-z]+", " ".join(_topic + [_category]).lower())
+    )
+
+
+class ThrottlingError(Exception):
+    pass
+
+
+def _token_count(text: str) -> int:
+    # rough chars-per-token ratio of the real tokenizers
+    return max(1, len(text) // 4)
+
+
+def _event(data: dict[str, Any]) -> dict[str, Any]:
+    return {"chunk": {"bytes": json.dumps(data).encode("utf-8")}}
+
+
+class FakeEventStream:
+    """
+    response body of invoke_model_with_response_stream: Anthropic message events, the text
+    in deltas of about 4 tokens, then the usage and Bedrock invocation metrics
+    """
+
+    def __init__(self, client: "FakeBedrockClient", text: str, usage: dict[str, int], stop_reason: str):
+        self.client = client
+        self.text = text
+        self.usage = usage
+        self.stop_reason = stop_reason
+        self.closed = False
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        yield _event({"type": "message_start", "message": {"usage": {**self.usage, "output_tokens": 1}}})
+        yield _event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for i in range(0, len(self.text), 16):
+            if self.closed:
+                return
+            if self.client.token_latency > 0:
+                time.sleep(self.client.token_latency * 4)
+            yield _event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": self.text[i : i + 16]}})
+        yield _event({"type": "content_block_stop", "index": 0})
+        yield _event(
+            {"type": "message_delta", "delta": {"stop_reason": self.stop_reason}, "usage": {"output_tokens": self.usage["output_tokens"]}}
+        )
+        yield _event(
+            {
+                "type": "message_stop",
+                "amazon-bedrock-invocationMetrics": {
+                    "inputTokenCount": self.usage["input_tokens"],
+                    "outputTokenCount": self.usage["output_tokens"],
+                    "cacheReadInputTokenCount": self.usage["cache_read_input_tokens"],
+                    "cacheWriteInputTokenCount": self.usage["cache_creation_input_tokens"],
+                },
+            }
+        )
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            with self.client._lock:
+                self.client.calls["stream_closed_early"] += 1
+
+
+class FakeBedrockClient:
+    """
+    offline stand-in for the boto3 bedrock-runtime client
+
+    - embeddings are deterministic hashed bag-of-words vectors, so texts sharing
+      words get similar vectors and classification behaves sensibly
+    - category prompts are answered with the listed category whose name (and, for the
+      synthetic categories, topic words) shares the most words with the text
+    - soft-attribute prompts are answered from simple patterns in the text, per record
+      for packed prompts
+    - latency (seconds, plus uniform jitter) and a throttling rate can be injected
+    - answers are cut at the request's max_tokens; trailing_text is appended to every LLM
+      answer (models often add a closing remark) and streamed at token_latency seconds per token
+    - cache_control points are honoured: the prefix is written to an in-memory prompt cache
+      on first use and read from it afterwards, if it has at least cache_min_tokens tokens
+
+    install it with bedrock.set_client("bedrock-runtime", FakeBedrockClient(...))
+    """
+
+    def __init__(
+        self,
+        llm_latency: float = 0.0,
+        embedding_latency: float = 0.0,
+        jitter: float = 0.0,
+        throttle_rate: float = 0.0,
+        dimensions: int = 1024,
+        seed: int = 0,
+        token_latency: float = 0.0,
+        trailing_text: str = "",
+        cache_min_tokens: int = 1024,
+    ):
+        self.llm_latency = llm_latency
+        self.embedding_latency = embedding_latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.token_latency = token_latency
+        self.trailing_text = trailing_text
+        self.cache_min_tokens = cache_min_tokens
+        self._prompt_cache: set[str] = set()
+        self.dimensions = dimensions
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._word_vectors: dict[str, np.ndarray] = {}
+        self.calls = {"llm": 0, "embedding": 0, "throttled": 0, "streamed": 0, "stream_closed_early": 0}
+
+    def _sleep(self, base: float) -> None:
+        with self._lock:
+            delay = base + self._rng.uniform(0, self.jitter)
+            throttle = self._rng.random() < self.throttle_rate
+        if delay > 0:
+            time.sleep(delay)
+        if throttle:
+            with self._lock:
+                self.calls["throttled"] += 1
+            raise ThrottlingError(
+                "An error occurred (ThrottlingException) when calling the InvokeModel operation: "
+                "Too many requests, please wait before trying again."
+            )
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        v = self._word_vectors.get(word)
+        if v is None:
+            seed = int.from_bytes(hashlib.sha256(word.encode()).digest()[:8], "little")
+            v = np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+            self._word_vectors[word] = v
+        return v
+
+    def embed(self, text: str) -> list[float]:
+        words = re.findall(r"[a-z]+", text.lower()) or ["empty"]
+        v = np.zeros(self.dimensions, dtype=np.float32)
+        for w in words:
+            v += self._word_vector(w)
+        v /= np.linalg.norm(v) or 1.0
+        return v.tolist()
+
+    @staticmethod
+    def _blocks(request: dict[str, Any]) -> list[dict[str, Any]]:
+        """
+        the request's text blocks in prompt order: system prompt, then messages
+        """
+        system = request.get("system", [])
+        blocks = [{"text": system}] if isinstance(system, str) else list(system)
+        for m in request.get("messages", []):
+            content = m["content"]
+            blocks.extend([{"text": content}] if isinstance(content, str) else content)
+        return blocks
+
+    @classmethod
+    def _prompt_text(cls, request: dict[str, Any]) -> str:
+        return "\n".join(b.get("text", "") for b in cls._blocks(request))
+
+    def _cache_usage(self, request: dict[str, Any]) -> tuple[int, int]:
+        """
+        (cache read, cache write) tokens of the prefix up to the last cache point
+        like Bedrock, prefixes shorter than cache_min_tokens are not cached
+        """
+        blocks = self._blocks(request)
+        points = [i for i, b in enumerate(blocks) if "cache_control" in b]
+        if not points:
+            return 0, 0
+        prefix = "\n".join(b.get("text", "") for b in blocks[: points[-1] + 1])
+        tokens = _token_count(prefix)
+        if tokens < self.cache_min_tokens:
+            return 0, 0
+        key = hashlib.sha256(prefix.encode()).hexdigest()
+        with self._lock:
+            hit = key in self._prompt_cache
+            self._prompt_cache.add(key)
+        return (tokens, 0) if hit else (0, tokens)
+
+    @staticmethod
+    def answer_category(prompt: str) -> str:
+        listed = re.search(r"The available categories are:(.*?)\n\n", prompt, re.S)
+        categories = [
+            c.strip(" ,.\n") for c in re.split(r"\d+\.\s", listed.group(1) if listed else "")
+        ]
+        categories = [c for c in categories if c]
+        text = prompt.split("Text block:", 1)[-1].lower()
+        words = set(re.findall(r"[a-z]+", text))
+
+        def score(c: str) -> int:
+            hints = CATEGORY_HINTS.get(c) or set(re.findall(r"[a-z]+", c.lower()))
+            return len(words & hints)
+
+        best = max(categories, key=score) if categories else ""
+        return f"<category>{best.strip()}</category>"
+
+    @staticmethod
+    def answer_soft_attributes(text: str) -> str:
+        pregnant = re.search(r"(\d+) weeks pregnant", text, re.I)
+        travel = re.search(r"traveled to ([A-Za-z ]+,\s?[A-Z]{2}) on (\d\d/\d\d/\d{4})", text)
+        job = re.search(r"works as an? ([a-z ]+)", text, re.I)
+        out = (
+            f'<pregnancy pregnant="{"true" if pregnant else "null"}">'
+            "<reasoning>synthetic answer</reasoning></pregnancy>\n"
+            f'<travel status="{"true" if travel else "null"}">\n'
+        )
+        if travel:
+            out += (
+                "<recent_travel><reasoning>synthetic answer</reasoning>"
+                f"<location>{travel.group(1)}</location><date>{travel.group(2)}</date></recent_travel>\n"
+            )
+        out += (
+            "</travel>\n"
+            f'<occupation employed="{"true" if job else "null"}">'
+            f"<reasoning>synthetic answer</reasoning><job>{job.group(1).strip() if job else ''}</job>"
+            "</occupation>"
+        )
+        return out
+
+    def _llm_text(self, prompt: str) -> str:
+        if "<category>" in prompt:
+            return self.answer_category(prompt)
+        records = re.findall(r'<record id="(\d+)">\n(.*?)\n</record>', prompt, re.S)
+        if records:
+            return "\n".join(
+                f'<answer id="{i}">\n{self.answer_soft_attributes(text)}\n</answer>' for i, text in records
+            )
+        return self.answer_soft_attributes(prompt)
+
+    def _llm_response(self, request: dict[str, Any]) -> tuple[str, dict[str, int], str]:
+        """
+        (text, usage, stop reason) of an LLM request, usage in the Anthropic format
+        """
+        with self._lock:
+            self.calls["llm"] += 1
+        self._sleep(self.llm_latency)
+        prompt = self._prompt_text(request)
+        text = self._llm_text(prompt) + self.trailing_text
+        stop_reason = "end_turn"
+        limit = request.get("max_tokens", 0) * 4
+        if limit and len(text) > limit:
+            text, stop_reason = text[:limit], "max_tokens"
+        cache_read, cache_write = self._cache_usage(request)
+        usage = {
+            # like Anthropic, input_tokens excludes the tokens read from or written to the cache
+            "input_tokens": max(_token_count(prompt) - cache_read - cache_write, 0),
+            "output_tokens": _token_count(text),
+            "cache_read_input_tokens": cache_read,
+            "cache_creation_input_tokens": cache_write,
+        }
+        return text, usage, stop_reason
+
+    def invoke_model_with_response_stream(self, modelId: str, body: Any, **kwargs: Any) -> dict[str, Any]:
+        request = json.loads(body)
+        text, usage, stop_reason = self._llm_response(request)
+        with self._lock:
+            self.calls["streamed"] += 1
+        return {"body": FakeEventStream(self, text, usage, stop_reason)}
+
+    def invoke_model(self, modelId: str, body: Any, **kwargs: Any) -> dict[str, Any]:
+        request = json.loads(body)
+        if "inputText" in request:
+            with self._lock:
+                self.calls["embedding"] += 1
+            self._sleep(self.embedding_latency)
+            text = request["inputText"]
+            payload: dict[str, Any] = {
+                "embedding": self.embed(text),
+                "inputTextTokenCount": _token_count(text),
+            }
+            input_tokens, output_tokens = _token_count(text), 0
+        else:
+            text, usage, stop_reason = self._llm_response(request)
+            input_tokens, output_tokens = usage["input_tokens"], usage["output_tokens"]
+            # the whole answer is generated before anything is returned
+            if self.token_latency > 0:
+                time.sleep(self.token_latency * output_tokens)
+            payload = {
+                "content": [{"type": "text", "text": text}],
+                "stop_reason": stop_reason,
+                "usage": usage,
+            }
+        headers = {
+            "x-amzn-bedrock-input-token-count": str(input_tokens),
+            "x-amzn-bedrock-output-token-count": str(output_tokens),
+        }
+        if "usage" in payload:
+            headers["x-amzn-bedrock-cache-read-input-token-count"] = str(payload["usage"]["cache_read_input_tokens"])
+            headers["x-amzn-bedrock-cache-write-input-token-count"] = str(payload["usage"]["cache_creation_input_tokens"])
+        return {
+            "body": io.BytesIO(json.dumps(payload).encode("utf-8")),
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": headers},
+        }
+
+    def list_foundation_models(self, **kwargs: Any) -> dict[str, Any]:
+        return {"modelSummaries": [{"modelName": "Fake", "modelId": "fake.model-v1:0"}]}
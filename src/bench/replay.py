@@ -0,0 +1,181 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+# recorded Bedrock responses, so runs can be repeated offline on real model answers
+#
+# RecordingClient wraps a real bedrock-runtime client and appends every request it sees
+# with its response to a cassette (ndjson, one record per distinct request); ReplayClient
+# answers the same requests from the cassette, optionally taking as long as they took when
+# recorded. requests are matched on model id and body, so a replayed run must send exactly
+# the requests of a recorded one: record with every setting that is going to be replayed
+
+# a stream read only up to an early stop is recorded as far as it was read; a replay of
+# the same request stops at the same place
+
+
+def request_key(modelId: str, body: Any) -> str:
+    """
+    first 16 hex chars of a hash of the model id and the request body
+    """
+    data = body if isinstance(body, bytes) else str(body).encode("utf-8")
+    return hashlib.sha256(modelId.encode("utf-8") + b"\0" + data).hexdigest()[:16]
+
+
+def _op(body: Any) -> str:
+    return "embedding" if b'"inputText"' in (body if isinstance(body, bytes) else str(body).encode("utf-8")) else "llm"
+
+
+class RecordingStream:
+    """
+    passes the events of a response stream through, recording them as they are read
+    """
+
+    def __init__(self, client: "RecordingClient", key: str, events: Any, start: float):
+        self.client = client
+        self.key = key
+        self.events = events
+        self.start = start
+        self.read: list[dict[str, Any]] = []
+        self.done = False
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        for event in self.events:
+            if "chunk" in event:
+                self.read.append({"chunk": {"bytes": event["chunk"]["bytes"].decode("utf-8")}})
+            else:
+                self.read.append(event)
+            yield event
+        self._finish()
+
+    def _finish(self) -> None:
+        if not self.done:
+            self.done = True
+            self.client._save(
+                {"key": self.key, "kind": "stream", "seconds": round(time.perf_counter() - self.start, 4), "events": self.read}
+            )
+
+    def close(self) -> None:
+        close = getattr(self.events, "close", None)
+        if close is not None:
+            close()
+        self._finish()
+
+
+class RecordingClient:
+    """
+    bedrock-runtime client recording the requests of a real one to a cassette
+
+    install it with bedrock.set_client("bedrock-runtime", RecordingClient(real client, path))
+    """
+
+    def __init__(self, client: Any, path: str):
+        self.client = client
+        self.path = path
+        self._lock = threading.Lock()
+        self.recorded = {r["key"] for r in load_cassette(path).values()}
+        self.calls = {"llm": 0, "embedding": 0, "recorded": 0}
+
+    def _save(self, record: dict[str, Any]) -> None:
+        with self._lock:
+            if record["key"] in self.recorded:
+                return
+            self.recorded.add(record["key"])
+            self.calls["recorded"] += 1
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def invoke_model_with_response_stream(self, modelId: str, body: Any, **kwargs: Any) -> dict[str, Any]:
+        with self._lock:
+            self.calls["llm"] += 1
+        start = time.perf_counter()
+        response = self.client.invoke_model_with_response_stream(modelId=modelId, body=body, **kwargs)
+        return {**response, "body": RecordingStream(self, request_key(modelId, body), response["body"], start)}
+
+    def invoke_model(self, modelId: str, body: Any, **kwargs: Any) -> dict[str, Any]:
+        with self._lock:
+            self.calls[_op(body)] += 1
+        start = time.perf_counter()
+        response = self.client.invoke_model(modelId=modelId, body=body, **kwargs)
+        data = response["body"].read()
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        self._save(
+            {
+                "key": request_key(modelId, body),
+                "kind": "invoke",
+                "seconds": round(time.perf_counter() - start, 4),
+                "body": data.decode("utf-8"),
+                "headers": dict(headers),
+            }
+        )
+        return {**response, "body": io.BytesIO(data)}
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+
+def load_cassette(path: str) -> dict[str, dict[str, Any]]:
+    """
+    {request key: record} of a cassette, empty if it does not exist yet
+    """
+    records: dict[str, dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, "r") as f:
+        for line in f:
+            if line.endswith("\n"):
+                record = json.loads(line)
+                records.setdefault(record["key"], record)
+    return records
+
+
+class ReplayClient:
+    """
+    bedrock-runtime client answering from a cassette written by RecordingClient
+
+    latency=True waits as long as the request took when it was recorded. a request that
+    was not recorded goes to `fallback` if one is given (e.g. a FakeBedrockClient) and
+    raises KeyError otherwise
+    """
+
+    def __init__(self, path: str, latency: bool = False, fallback: Optional[Any] = None):
+        self.path = path
+        self.records = load_cassette(path)
+        self.latency = latency
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self.calls = {"llm": 0, "embedding": 0, "replayed": 0, "missed": 0}
+
+    def _record(self, modelId: str, body: Any) -> Optional[dict[str, Any]]:
+        record = self.records.get(request_key(modelId, body))
+        with self._lock:
+            self.calls[_op(body)] += 1
+            self.calls["replayed" if record is not None else "missed"] += 1
+        if record is None and self.fallback is None:
+            raise KeyError(f"request {request_key(modelId, body)} to {modelId} is not in {self.path}; record it first")
+        if record is not None and self.latency:
+            time.sleep(record["seconds"])
+        return record
+
+    def invoke_model_with_response_stream(self, modelId: str, body: Any, **kwargs: Any) -> dict[str, Any]:
+        record = self._record(modelId, body)
+        if record is None:
+            return self.fallback.invoke_model_with_response_stream(modelId=modelId, body=body, **kwargs)  # type: ignore
+        events = [
+            {"chunk": {"bytes": e["chunk"]["bytes"].encode("utf-8")}} if "chunk" in e else e for e in record["events"]
+        ]
+        return {"body": events}
+
+    def invoke_model(self, modelId: str, body: Any, **kwargs: Any) -> dict[str, Any]:
+        record = self._record(modelId, body)
+        if record is None:
+            return self.fallback.invoke_model(modelId=modelId, body=body, **kwargs)  # type: ignore
+        return {
+            "body": io.BytesIO(record["body"].encode("utf-8")),
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": dict(record["headers"])},
+        }
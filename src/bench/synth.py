@@ -0,0 +1,213 @@
+import json
+import random
+from typing import Any
+from xml.sax.saxutils import escape
+
+# (loinc code, title, template id, category, kind, topic words)
+# kind is "text" for narrative sections and "table" for tabular ones
+SECTION_TYPES: list[tuple[str, str, str, str, str, list[str]]] = [
+    ("29762-2", "Social History", "2.16.840.1.113883.10.20.22.2.17", "eICR Social History", "text",
+     ["tobacco", "alcohol", "lives", "household", "smoker", "exposure", "residence"]),
+    ("10164-2", "History of Present Illness", "1.3.6.1.4.1.19376.1.5.3.1.3.4", "eICR History of Present Illness", "text",
+     ["fever", "cough", "onset", "symptoms", "days", "reports", "denies", "headache"]),
+    ("29299-5", "Reason for Visit", "2.16.840.1.113883.10.20.22.2.12", "eICR Reason for Visit", "text",
+     ["presents", "complaint", "chief", "evaluation", "visit", "referred"]),
+    ("46240-8", "Encounters", "2.16.840.1.113883.10.20.22.2.22.1", "eICR Encounter", "text",
+     ["encounter", "emergency", "department", "admitted", "discharged", "facility", "provider"]),
+    ("18776-5", "Plan of Treatment", "2.16.840.1.113883.10.20.22.2.10", "eICR Plan of Treatment", "text",
+     ["plan", "monitor", "recheck", "hydration", "rest", "counseling", "isolation", "instructed"]),
+    ("90767-5", "Pregnancy", "2.16.840.1.113883.10.20.22.2.80", "Pregnancy Status", "text",
+     ["pregnancy", "gestational", "weeks", "prenatal", "delivery", "estimated"]),
+    ("8716-3", "Vital Signs", "2.16.840.1.113883.10.20.22.2.4.1", "eICR Vital Signs", "table",
+     ["temperature", "pulse", "respiratory", "blood pressure", "oxygen", "weight", "height"]),
+    ("11369-6", "Immunizations", "2.16.840.1.113883.10.20.22.2.2.1", "eICR Immunization", "table",
+     ["vaccine", "influenza", "dose", "administered", "lot", "series"]),
+    ("30954-2", "Results", "2.16.840.1.113883.10.20.22.2.3.1", "eICR Lab Results", "table",
+     ["specimen", "culture", "positive", "negative", "pcr", "antigen", "panel"]),
+    ("10160-0", "Medications", "2.16.840.1.113883.10.20.22.2.1.1", "eICR Medications", "table",
+     ["tablet", "mg", "oral", "daily", "prescribed", "capsule", "refill"]),
+    ("11450-4", "Problems", "2.16.840.1.113883.10.20.22.2.5.1", "eICR Problems", "table",
+     ["diagnosis", "chronic", "active", "resolved", "condition", "onset"]),
+]
+
+# narrative sections that do not record soft attributes: they state none, as in real
+# documents, so a sweep has sections the pre-filter can skip
+ROUTINE_CODES = {"46240-8", "18776-5"}
+
+FILLER = (
+    "the patient was seen today and noted to be in stable condition with no acute distress "
+    "follow up was arranged and instructions were reviewed with the patient and family members "
+    "records were reconciled and the care team was notified of the findings documented below"
+).split()
+
+CITIES = ["Phoenix,AZ", "Fresno,CA", "Reno,NV", "Austin,TX", "Denver,CO", "Portland,OR"]
+JOBS = ["nurse", "teacher", "farm worker", "poultry processor", "truck driver", "cashier"]
+
+SIZES: dict[str, dict[str, int]] = {
+    "small": {"sections": 10, "references": 5, "tables": 4, "narrative": 300, "rows": 5},
+    "medium": {"sections": 40, "references": 40, "tables": 16, "narrative": 1200, "rows": 15},
+    "large": {"sections": 150, "references": 200, "tables": 60, "narrative": 3000, "rows": 40},
+}
+
+
+def _narrative(rng: random.Random, topic: list[str], length: int) -> str:
+    words: list[str] = []
+    while sum(len(w) + 1 for w in words) < length:
+        words.append(rng.choice(topic) if rng.random() < 0.35 else rng.choice(FILLER))
+    return " ".join(words)
+
+
+def _soft_attributes(rng: random.Random, rate: float) -> tuple[dict[str, Any], str]:
+    """
+    randomly picks soft attributes stated in a section and the sentences stating them
+    """
+    labels: dict[str, Any] = {"pregnant": None, "travel": None, "occupation": None}
+    sentences: list[str] = []
+    if rng.random() < rate:
+        labels["pregnant"] = True
+        sentences.append(f"Patient is {rng.randint(6, 38)} weeks pregnant.")
+    if rng.random() < rate:
+        city = rng.choice(CITIES)
+        labels["travel"] = city
+        sentences.append(
+            f"Patient traveled to {city} on {rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2025."
+        )
+    if rng.random() < rate:
+        job = rng.choice(JOBS)
+        labels["occupation"] = job
+        sentences.append(f"Patient works as a {job}.")
+    return labels, " ".join(sentences)
+
+
+def _table(rng: random.Random, topic: list[str], rows: int, ids: list[str], prefix: str) -> str:
+    headers = ["Name", "Value", "Unit", "Date"]
+    out = "<table><thead><tr>" + "".join(f"<th>{h}</th>" for h in headers) + "</tr></thead><tbody>"
+    for r in range(rows):
+        cell_id = f"{prefix}r{r}"
+        ids.append(cell_id)
+        out += (
+            f'<tr><td ID="{cell_id}">{escape(rng.choice(topic))} {r}</td>'
+            f"<td>{rng.randint(1, 200)}</td><td>{rng.choice(['mg', 'mmHg', 'C', 'mL'])}</td>"
+            f"<td>{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2025</td></tr>"
+        )
+    return out + "</tbody></table>"
+
+
+def generate_eicr(
+    sections: int = 10,
+    references: int = 5,
+    tables: int = 4,
+    narrative: int = 300,
+    rows: int = 5,
+    attribute_rate: float = 0.15,
+    seed: int = 0,
+) -> tuple[str, list[dict[str, Any]]]:
+    """
+    generates a synthetic HL7 CDA eICR document
+    - sections: number of <section> elements
+    - references: number of <reference value="#id"/> elements pointing into narrative/table content
+    - tables: how many of the sections are tabular
+    - narrative: approximate characters of narrative text per text section
+    - rows: table rows per tabular section
+    - attribute_rate: chance of each soft attribute being stated in a text section outside ROUTINE_CODES
+    returns the xml string and one label per section in document order:
+      {"index", "code", "template_id", "title", "category", "is_table", "pregnant", "travel", "occupation"}
+    """
+    rng = random.Random(seed)
+    text_types = [t for t in SECTION_TYPES if t[4] == "text"]
+    table_types = [t for t in SECTION_TYPES if t[4] == "table"]
+    kinds = ["table"] * min(tables, sections) + ["text"] * max(sections - tables, 0)
+    rng.shuffle(kinds)
+
+    bodies: list[str] = []
+    labels: list[dict[str, Any]] = []
+    ids: list[str] = []
+    for i, kind in enumerate(kinds):
+        code, title, template_id, category, _, topic = rng.choice(
+            table_types if kind == "table" else text_types
+        )
+        attrs: dict[str, Any] = {"pregnant": None, "travel": None, "occupation": None}
+        if kind == "table":
+            text = _table(rng, topic, rows, ids, f"s{i}")
+        else:
+            attrs, stated = _soft_attributes(rng, 0.0 if code in ROUTINE_CODES else attribute_rate)
+            content_id = f"s{i}n"
+            ids.append(content_id)
+            text = (
+                escape(_narrative(rng, topic, narrative) + " " + stated)
+                + f' <content ID="{content_id}">{escape(_narrative(rng, topic, 60))}</content>'
+            )
+        labels.append(
+            {
+                "index": i,
+                "code": code,
+                "template_id": template_id,
+                "title": title,
+                "category": category,
+                "is_table": kind == "table",
+                **attrs,
+            }
+        )
+        bodies.append(
+            f'<templateId root="{template_id}"/>'
+            f'<code code="{code}" codeSystem="2.16.840.1.113883.6.1" displayName="{title}"/>'
+            f"<title>{title}</title><text>{text}</text>"
+        )
+
+    # spread the references over the sections' entries
+    entries: list[list[str]] = [[] for _ in bodies]
+    for r in range(references):
+        if not ids or not bodies:
+            break
+        target = rng.choice(ids)
+        entries[rng.randrange(len(bodies))].append(
+            '<entry><observation classCode="OBS" moodCode="EVN">'
+            f'<code code="{r}"/><text><reference value="#{target}"/></text>'
+            "</observation></entry>"
+        )
+
+    components = "".join(
+        f"<component><section>{body}{''.join(e)}</section></component>"
+        for body, e in zip(bodies, entries)
+    )
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<ClinicalDocument xmlns="urn:hl7-org:v3" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xmlns:sdtc="urn:hl7-org:sdtc">\n'
+        '<realmCode code="US"/><templateId root="2.16.840.1.113883.10.20.15.2" extension="2016-12-01"/>'
+        f'<id root="{rng.randint(10**8, 10**9)}"/><code code="55751-2" displayName="Public Health Case Report"/>'
+        "<title>Initial Public Health Case Report</title>"
+        '<recordTarget><patientRole><patient><name><given>Test</given><family>Patient</family></name>'
+        '<administrativeGenderCode code="F"/></patient></patientRole></recordTarget>'
+        f"<component><structuredBody>{components}</structuredBody></component>\n"
+        "</ClinicalDocument>\n"
+    )
+    return xml, labels
+
+
+def generate_size(size: str, seed: int = 0) -> tuple[str, list[dict[str, Any]]]:
+    """
+    generates a document from one of the SIZES presets
+    """
+    return generate_eicr(**SIZES[size], seed=seed)
+
+
+def schema() -> dict[str, Any]:
+    """
+    schema covering every synthetic category, in the format of src/assets/<type>_schema.json
+    """
+    categories = sorted({t[3] for t in SECTION_TYPES})
+    return {
+        "type": "object",
+        "properties": {
+            c: {"additionalProperties": False, "description": f"Description of {c}"}
+            for c in categories
+        },
+        "required": [],
+        "additionalProperties": False,
+    }
+
+
+def write_schema(path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(schema(), f, indent=2)
@@ -0,0 +1,58 @@
+import multiprocessing
+import os
+import resource
+import time
+from typing import Any
+
+import numpy as np
+
+from store import EmbeddingStore
+
+
+def memory_mb() -> dict[str, float]:
+    """
+    resident (rss) and proportional (pss) memory of this process in MB
+    pss splits shared pages between the processes that map them, so summed over
+    workers it is the physical memory they use together; 0.0 where /proc is not available
+    """
+    usage: dict[str, float] = {"rss_mb": 0.0, "pss_mb": 0.0}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if name in ("Rss", "Pss"):
+                    usage[f"{name.lower()}_mb"] = round(int(rest.split()[0]) / 1024, 2)
+    except OSError:
+        # ru_maxrss is in KB on Linux, bytes on macOS
+        usage["rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    return usage
+
+
+def _worker(store_path: str, mapped: bool, queries: np.ndarray, barrier: Any, results: Any) -> None:
+    start = time.perf_counter()
+    store = EmbeddingStore(store_path, mapped)
+    store.scores(queries)
+    seconds = time.perf_counter() - start
+    # measured while every worker holds its store, so shared pages are split between all of them
+    barrier.wait()
+    results.put({"pid": os.getpid(), "seconds": seconds, **memory_mb()})
+    barrier.wait()
+
+
+def score_in_workers(store_path: str, mapped: bool, queries: np.ndarray, workers: int) -> list[dict[str, Any]]:
+    """
+    opens the store and scores the queries in `workers` fresh processes at the same time
+    returns each worker's time and memory
+    """
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=_worker, args=(store_path, mapped, queries, barrier, results)) for _ in range(workers)
+    ]
+    for p in processes:
+        p.start()
+    stats = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return stats
@@ -0,0 +1,89 @@
+import contextlib
+import io
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+from typing import Any, Optional
+
+import bedrock
+from bench.fake_bedrock import FakeBedrockClient
+from bench.synth import generate_eicr, write_schema
+from metrics import metrics
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_script(script: str, args: list[str], quiet: bool = True) -> dict[str, Any]:
+    """
+    runs one of the pipeline scripts (e.g. "test.py") in-process as __main__
+    returns the script's globals
+    """
+    argv = sys.argv
+    sys.argv = [script] + args
+    out = io.StringIO() if quiet else sys.stdout
+    try:
+        with contextlib.redirect_stdout(out):
+            return runpy.run_path(os.path.join(SRC_DIR, script), run_name="__main__")
+    finally:
+        sys.argv = argv
+
+
+class Workspace:
+    """
+    temporary working directory laid out like the repository root
+      src/assets/hl7_schema.json   schema covering the synthetic categories
+      assets/ref<i>.xml            synthetic reference documents
+      embeddings/assets/ref<i>.json their embeddings, built with embed.py
+      docs/<name>.xml              documents to classify
+    with a FakeBedrockClient installed in bedrock.py for the lifetime of the workspace
+    """
+
+    def __init__(self, client: Optional[FakeBedrockClient] = None, keep: bool = False):
+        self.root = tempfile.mkdtemp(prefix="ecr-bench-")
+        self.keep = keep
+        self.client = client or FakeBedrockClient()
+        self._cwd = os.getcwd()
+        self._previous_client = bedrock._clients.get("bedrock-runtime")
+
+    def __enter__(self) -> "Workspace":
+        os.makedirs(os.path.join(self.root, "src", "assets"))
+        os.makedirs(os.path.join(self.root, "assets"))
+        os.makedirs(os.path.join(self.root, "docs"))
+        write_schema(os.path.join(self.root, "src", "assets", "hl7_schema.json"))
+        bedrock.set_client("bedrock-runtime", self.client)
+        os.chdir(self.root)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        os.chdir(self._cwd)
+        if self._previous_client is not None:
+            bedrock.set_client("bedrock-runtime", self._previous_client)
+        else:
+            bedrock._clients.pop("bedrock-runtime", None)
+        if not self.keep:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def add_document(self, name: str, xml: str, folder: str = "docs") -> str:
+        """
+        writes a document into the workspace, returns its path relative to the workspace root
+        """
+        path = os.path.join(folder, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(xml)
+        return path
+
+    def build_corpus(self, documents: int = 3, seed: int = 100, **spec: Any) -> list[str]:
+        """
+        generates reference documents and embeds them with embed.py
+        spec is passed to generate_eicr (sections, references, tables, narrative, rows)
+        """
+        paths: list[str] = []
+        for i in range(documents):
+            xml, _ = generate_eicr(seed=seed + i, **spec)
+            paths.append(self.add_document(f"ref{i}.xml", xml, "assets"))
+        for p in paths:
+            metrics.reset()
+            run_script("embed.py", [p])
+        return paths
@@ -0,0 +1,355 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable
+
+import numpy as np
+
+from bench.fake_bedrock import FakeBedrockClient
+from bench.synth import SIZES, generate_size
+from bench.workspace import Workspace, run_script
+from chunky import chunkify_by_hierarchy_text_tables
+from metrics import metrics
+from pathy import get_xml_element
+from preprocess import resolve_references, strip_namespaces
+
+BENCHMARKS: dict[str, Callable[..., list[dict[str, Any]]]] = {}
+
+
+def benchmark(name: str) -> Callable[..., Any]:
+    def register(fn: Callable[..., list[dict[str, Any]]]) -> Callable[..., list[dict[str, Any]]]:
+        BENCHMARKS[name] = fn
+        return fn
+
+    return register
+
+
+def measure(
+    name: str, size: str, fn: Callable[[], int], unit: str, repeat: int
+) -> dict[str, Any]:
+    """
+    runs fn `repeat` times for timing, then once more under tracemalloc for peak memory
+    fn returns the number of items it processed, throughput is items / best time
+    """
+    times: list[float] = []
+    items = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(times)
+    return {
+        "benchmark": name,
+        "size": size,
+        "items": items,
+        "unit": unit,
+        "best_seconds": round(best, 6),
+        "median_seconds": round(statistics.median(times), 6),
+        "throughput": round(items / best, 3) if best > 0 else 0.0,
+        "peak_mb": round(peak / 2**20, 3),
+    }
+
+
+@benchmark("resolve_references")
+def bench_resolve(ws: Workspace, size: str, doc: str, repeat: int, **_: Any) -> list[dict[str, Any]]:
+    mb = os.path.getsize(doc) / 2**20
+
+    def run() -> int:
+        resolve_references(doc)
+        return 1
+
+    r = measure("resolve_references", size, run, "docs/s", repeat)
+    r["mb_per_second"] = round(mb / r["best_seconds"], 3)
+    return [r]
+
+
+@benchmark("chunkify")
+def bench_chunkify(ws: Workspace, size: str, doc: str, repeat: int, **_: Any) -> list[dict[str, Any]]:
+    tree = resolve_references(doc)
+    strip_namespaces(tree)
+    root = tree.getroot()
+
+    def run() -> int:
+        return len(chunkify_by_hierarchy_text_tables(root, 6000, True, True))
+
+    return [measure("chunkify_by_hierarchy_text_tables", size, run, "chunks/s", repeat)]
+
+
+@benchmark("get_xml_element")
+def bench_get_xml_element(ws: Workspace, size: str, doc: str, repeat: int, **_: Any) -> list[dict[str, Any]]:
+    tree = resolve_references(doc)
+    chunks = chunkify_by_hierarchy_text_tables(tree.getroot(), 6000, True, True)
+    paths = [c["path"].split(".section.")[0] for c in chunks]
+
+    def run() -> int:
+        for p in paths:
+            get_xml_element(doc, p)
+        return len(paths)
+
+    return [measure("get_xml_element", size, run, "lookups/s", repeat)]
+
+
+@benchmark("transform")
+def bench_transform(ws: Workspace, size: str, doc: str, repeat: int, **_: Any) -> list[dict[str, Any]]:
+    from lxml import etree  # type: ignore
+    from xmljson import element_to_json, stream_to_json
+
+    mb = os.path.getsize(doc) / 2**20
+
+    def run_tree() -> int:
+        tree = etree.parse(doc, etree.XMLParser(remove_blank_text=True))  # type: ignore
+        json.dumps(element_to_json(tree.getroot()))
+        return 1
+
+    def run_stream() -> int:
+        with open(os.devnull, "w") as out:
+            stream_to_json(doc, out)
+        return 1
+
+    results = [
+        measure("element_to_json", size, run_tree, "docs/s", repeat),
+        measure("stream_to_json", size, run_stream, "docs/s", repeat),
+    ]
+    for r in results:
+        r["mb_per_second"] = round(mb / r["best_seconds"], 3)
+    return results
+
+
+@benchmark("similarity")
+def bench_similarity(ws: Workspace, size: str, doc: str, repeat: int, **_: Any) -> list[dict[str, Any]]:
+    import test as pipeline
+    from vectoring import get_bedrock_embeddings
+
+    tree = resolve_references(doc)
+    strip_namespaces(tree)
+    chunks = chunkify_by_hierarchy_text_tables(tree.getroot(), 6000, True, True)
+    embeddings = [get_bedrock_embeddings(c) for c in chunks]
+    references = len(pipeline.load_all_embeddings())
+
+    def run() -> int:
+        pipeline.compute_similarities(doc, embeddings, chunks)
+        return len(chunks) * references
+
+    def run_additive() -> int:
+        pipeline.additive_scores(pipeline.compute_similarities(doc, embeddings, chunks))
+        return len(chunks)
+
+    return [
+        measure("compute_similarities", size, run, "pairs/s", repeat),
+        measure("similarity+additive_scores", size, run_additive, "chunks/s", repeat),
+    ]
+
+
+@benchmark("quantization")
+def bench_quantization(ws: Workspace, size: str, doc: str, repeat: int, **_: Any) -> list[dict[str, Any]]:
+    import test as pipeline
+    from store import QUANTIZATIONS, EmbeddingStore
+    from vectoring import get_bedrock_embeddings
+
+    tree = resolve_references(doc)
+    strip_namespaces(tree)
+    chunks = chunkify_by_hierarchy_text_tables(tree.getroot(), 6000, True, True)
+    embeddings = [get_bedrock_embeddings(c) for c in chunks]
+
+    # memory held by the current path: json embeddings loaded as python lists
+    tracemalloc.start()
+    references = pipeline.load_all_embeddings()
+    float_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del references
+
+    baseline = pipeline.additive_scores(pipeline.compute_similarities(doc, embeddings, chunks))
+    results: list[dict[str, Any]] = []
+    for quantization in QUANTIZATIONS:
+        store = EmbeddingStore.build(f"store-{quantization}", "embeddings", quantization)
+
+        def run() -> int:
+            pipeline.compute_similarities(doc, embeddings, chunks, store)
+            return len(chunks) * len(store)
+
+        r = measure(f"store_similarities[{quantization}]", size, run, "pairs/s", repeat)
+        scored = pipeline.additive_scores(pipeline.compute_similarities(doc, embeddings, chunks, store))
+        n = max(len(scored), 1)
+        r["matrix_mb"] = round(store.nbytes / 2**20, 4)
+        r["json_lists_mb"] = round(float_bytes / 2**20, 4)
+        r["memory_reduction"] = round(float_bytes / max(store.nbytes, 1), 1)
+        r["top_category_agreement"] = round(
+            sum(a["category"] == b["category"] for a, b in zip(scored, baseline)) / n, 4
+        )
+        r["additive_category_agreement"] = round(
+            sum(a["additive_top_category"] == b["additive_top_category"] for a, b in zip(scored, baseline)) / n, 4
+        )
+        results.append(r)
+    return results
+
+
+# reference rows of the synthetic store scored by the workers benchmark
+WORKER_STORE_ROWS = {"small": 5000, "medium": 20000, "large": 50000}
+
+
+@benchmark("workers")
+def bench_workers(ws: Workspace, size: str, doc: str, repeat: int, workers: int = 4, **_: Any) -> list[dict[str, Any]]:
+    from bench.workers import score_in_workers
+    from store import EmbeddingStore
+
+    rng = np.random.default_rng(0)
+    rows, dimensions = WORKER_STORE_ROWS.get(size, 5000), 1024
+    store = EmbeddingStore.create(f"store-workers-{size}", dimensions, "int8")
+    for start in range(0, rows, 5000):
+        vectors = rng.standard_normal((min(5000, rows - start), dimensions)).astype(np.float32)
+        store.append(
+            f"synthetic/{start}.json",
+            [
+                {"embedding": v, "chunk_id": i, "path": "", "chunk_size": 0, "category": "synthetic"}
+                for i, v in enumerate(vectors)
+            ],
+            reload=False,
+        )
+    store.reload()
+    queries = rng.standard_normal((8, dimensions)).astype(np.float32)
+
+    results: list[dict[str, Any]] = []
+    for mapped in (False, True):
+        times: list[float] = []
+        stats: list[dict[str, Any]] = []
+        for _ in range(repeat):
+            stats = score_in_workers(store.path, mapped, queries, workers)
+            times.append(max(w["seconds"] for w in stats))
+        best = min(times)
+        results.append(
+            {
+                "benchmark": f"workers[{'mapped' if mapped else 'loaded'} x{workers}]",
+                "size": size,
+                "items": rows * len(queries) * workers,
+                "unit": "pairs/s",
+                "best_seconds": round(best, 6),
+                "median_seconds": round(statistics.median(times), 6),
+                "throughput": round(rows * len(queries) * workers / best, 3) if best > 0 else 0.0,
+                "peak_mb": max(w["rss_mb"] for w in stats),
+                "worker_rss_mb": [w["rss_mb"] for w in stats],
+                "worker_pss_mb": [w["pss_mb"] for w in stats],
+                "total_pss_mb": round(sum(w["pss_mb"] for w in stats), 2),
+                "matrix_mb": round(store.nbytes / 2**20, 2),
+            }
+        )
+    return results
+
+
+@benchmark("end_to_end")
+def bench_end_to_end(ws: Workspace, size: str, doc: str, repeat: int, **_: Any) -> list[dict[str, Any]]:
+    results: list[dict[str, Any]] = []
+    for script in ["test.py", "tag.py"]:
+
+        def run() -> int:
+            metrics.reset()
+            g = run_script(script, [doc, "--fresh"])
+            return len(g["unique_chunks"])
+
+        r = measure(script, size, run, "chunks/s", repeat)
+        report = metrics.report()
+        r["bedrock_requests"] = report["counters"]
+        results.append(r)
+    return results
+
+
+def compare(results: list[dict[str, Any]], baseline_path: str, tolerance: float) -> list[str]:
+    """
+    returns a line for every benchmark whose throughput dropped or peak memory grew by more than tolerance
+    """
+    with open(baseline_path) as f:
+        baseline = {(b["benchmark"], b["size"]): b for b in json.load(f)["results"]}
+    regressions: list[str] = []
+    for r in results:
+        b = baseline.get((r["benchmark"], r["size"]))
+        if b is None:
+            continue
+        if b["throughput"] and r["throughput"] < b["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{r['benchmark']} [{r['size']}]: throughput {r['throughput']} < baseline {b['throughput']} {r['unit']}"
+            )
+        if b["peak_mb"] and r["peak_mb"] > b["peak_mb"] * (1 + tolerance):
+            regressions.append(
+                f"{r['benchmark']} [{r['size']}]: peak memory {r['peak_mb']} MB > baseline {b['peak_mb']} MB"
+            )
+    return regressions
+
+
+def print_table(results: list[dict[str, Any]]) -> None:
+    print(f"{'benchmark':<34} {'size':<8} {'items':>7} {'best s':>10} {'throughput':>14} {'unit':<10} {'peak MB':>9}")
+    print("-" * 98)
+    for r in results:
+        print(
+            f"{r['benchmark']:<34} {r['size']:<8} {r['items']:>7} {r['best_seconds']:>10.4f} "
+            f"{r['throughput']:>14.2f} {r['unit']:<10} {r['peak_mb']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="offline benchmarks on synthetic eICRs with a fake Bedrock client"
+    )
+    parser.add_argument("--sizes", default="small,medium", help=f"comma separated, from {list(SIZES)}")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help=f"comma separated, from {list(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--corpus", type=int, default=3, help="number of reference documents")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="injected seconds per LLM call")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="injected seconds per embedding call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform random latency, seconds")
+    parser.add_argument("--workers", type=int, default=4, help="processes of the workers benchmark")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="injected seconds per generated LLM token")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="results json of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    client = FakeBedrockClient(
+        llm_latency=args.llm_latency,
+        embedding_latency=args.embedding_latency,
+        jitter=args.jitter,
+        token_latency=args.token_latency,
+    )
+    results: list[dict[str, Any]] = []
+    with Workspace(client) as ws:
+        print(f"Building reference corpus of {args.corpus} documents...")
+        ws.build_corpus(args.corpus, **SIZES["small"])
+        for size in args.sizes.split(","):
+            xml, _ = generate_size(size)
+            doc = ws.add_document(f"{size}.xml", xml)
+            for name in args.only.split(","):
+                print(f"Running {name} [{size}]...")
+                results.extend(BENCHMARKS[name](ws, size, doc, args.repeat, workers=args.workers))
+
+    print_table(results)
+    for r in results:
+        if "memory_reduction" in r:
+            print(
+                f"{r['benchmark']} [{r['size']}]: {r['matrix_mb']} MB vs {r['json_lists_mb']} MB of json lists "
+                f"({r['memory_reduction']}x smaller), top category agreement {r['top_category_agreement']:.2%}, "
+                f"additive category agreement {r['additive_category_agreement']:.2%}"
+            )
+    for r in results:
+        if "worker_rss_mb" in r:
+            print(
+                f"{r['benchmark']} [{r['size']}]: {r['matrix_mb']} MB scoring matrix, per-worker RSS {r['worker_rss_mb']} MB, "
+                f"PSS {r['worker_pss_mb']} MB, {r['total_pss_mb']} MB in total"
+            )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print("REGRESSION:", line)
+        if regressions:
+            sys.exit(1)
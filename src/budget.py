@@ -0,0 +1,197 @@
+import collections
+import os
+import threading
+import time
+from typing import Any, Callable, Optional
+
+# limits on LLM usage shared by every request of the process
+#   tokens per minute  input tokens (prompt cache reads and writes included) plus output tokens
+#   dollars per hour   the cost of those tokens at bedrock.LLM_PRICING
+# both are rolling windows. a request reserves its estimate before it is sent (its prompt
+# size and its whole max_tokens) and is settled with the usage Bedrock reports, so the
+# limits hold while requests are in flight and the totals are the exact reported usage
+
+TOKEN_WINDOW = 60.0
+DOLLAR_WINDOW = 3600.0
+
+# rough size of a token, for estimates before a request is sent
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+class Budget:
+    """
+    tokens/minute and dollars/hour limits (None = unlimited) with the spend so far
+
+    safe to use from several threads; a request that does not fit waits until enough
+    earlier usage has left the window. a single request larger than a limit is let
+    through once nothing else is in the window, so it cannot wait forever
+    """
+
+    def __init__(
+        self,
+        tokens_per_minute: Optional[int] = None,
+        dollars_per_hour: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.tokens_per_minute = tokens_per_minute
+        self.dollars_per_hour = dollars_per_hour
+        self._clock = clock
+        self._cond = threading.Condition()
+        # (time, tokens, dollars) of settled requests, kept for the longest window
+        self._events: collections.deque[tuple[float, int, float]] = collections.deque()
+        # reservation id -> (tokens, dollars) of requests in flight
+        self._reserved: dict[int, tuple[int, float]] = {}
+        self._next_id = 0
+        self.requests = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self.dollars = 0.0
+        self.waited = 0.0
+
+    @classmethod
+    def from_env(cls) -> "Budget":
+        """
+        limits from LLM_TOKENS_PER_MINUTE and LLM_DOLLARS_PER_HOUR, unlimited if unset
+        """
+        tokens = os.getenv("LLM_TOKENS_PER_MINUTE")
+        dollars = os.getenv("LLM_DOLLARS_PER_HOUR")
+        return cls(int(tokens) if tokens else None, float(dollars) if dollars else None)
+
+    def _window(self, now: float) -> tuple[int, float]:
+        """
+        (tokens in the last minute, dollars in the last hour), requests in flight included
+        """
+        while self._events and self._events[0][0] <= now - DOLLAR_WINDOW:
+            self._events.popleft()
+        tokens = sum(t for when, t, _ in self._events if when > now - TOKEN_WINDOW)
+        dollars = sum(d for _, _, d in self._events)
+        for t, d in self._reserved.values():
+            tokens += t
+            dollars += d
+        return tokens, dollars
+
+    def _wait_time(self, tokens: int, dollars: float, now: float) -> Optional[float]:
+        """
+        0 if a request of this size fits now, otherwise how long until the window changes
+        (None: only when a request in flight is settled)
+        """
+        used_tokens, used_dollars = self._window(now)
+        waits: list[Optional[float]] = []
+        if self.tokens_per_minute is not None and used_tokens and used_tokens + tokens > self.tokens_per_minute:
+            recent = [when for when, _, _ in self._events if when > now - TOKEN_WINDOW]
+            waits.append(recent[0] + TOKEN_WINDOW - now if recent else None)
+        if self.dollars_per_hour is not None and used_dollars and used_dollars + dollars > self.dollars_per_hour:
+            waits.append(self._events[0][0] + DOLLAR_WINDOW - now if self._events else None)
+        if not waits:
+            return 0.0
+        if all(w is None for w in waits):
+            return None
+        return max(w for w in waits if w is not None)
+
+    def _wait(self, tokens: int, dollars: float) -> float:
+        start = self._clock()
+        while True:
+            delay = self._wait_time(tokens, dollars, self._clock())
+            if delay == 0.0:
+                break
+            self._cond.wait(delay if delay is None else max(delay, 0.01))
+        waited = self._clock() - start
+        self.waited += waited
+        return waited
+
+    def admit(self, tokens: int, dollars: float) -> float:
+        """
+        waits until work of this size fits the limits, without reserving anything
+        (used to hold back a whole document); returns the seconds waited
+        """
+        with self._cond:
+            if self.tokens_per_minute is not None:
+                tokens = min(tokens, self.tokens_per_minute)
+            if self.dollars_per_hour is not None:
+                dollars = min(dollars, self.dollars_per_hour)
+            return self._wait(tokens, dollars)
+
+    def reserve(self, tokens: int, dollars: float) -> int:
+        """
+        waits until a request of (at most) this size fits and holds it until settle() or cancel()
+        """
+        with self._cond:
+            self._wait(tokens, dollars)
+            self._next_id += 1
+            self._reserved[self._next_id] = (tokens, dollars)
+            return self._next_id
+
+    def settle(
+        self,
+        reservation: int,
+        input_tokens: int,
+        output_tokens: int,
+        cache_read_tokens: int,
+        cache_write_tokens: int,
+        dollars: float,
+    ) -> None:
+        """
+        replaces a reservation with the usage the request actually reported
+        """
+        with self._cond:
+            self._reserved.pop(reservation, None)
+            tokens = input_tokens + output_tokens + cache_read_tokens + cache_write_tokens
+            self._events.append((self._clock(), tokens, dollars))
+            self.requests += 1
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.cache_read_tokens += cache_read_tokens
+            self.cache_write_tokens += cache_write_tokens
+            self.dollars += dollars
+            self._cond.notify_all()
+
+    def cancel(self, reservation: int) -> None:
+        with self._cond:
+            self._reserved.pop(reservation, None)
+            self._cond.notify_all()
+
+    def spend(self) -> dict[str, Any]:
+        """
+        usage settled so far
+        """
+        with self._cond:
+            return {
+                "requests": self.requests,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "cache_read_tokens": self.cache_read_tokens,
+                "cache_write_tokens": self.cache_write_tokens,
+                "dollars": round(self.dollars, 6),
+            }
+
+    def status(self) -> dict[str, Any]:
+        """
+        spend so far, current use of each window and time spent waiting for the limits
+        """
+        with self._cond:
+            tokens, dollars = self._window(self._clock())
+            in_flight = len(self._reserved)
+        return {
+            **self.spend(),
+            "in_flight": in_flight,
+            "tokens_last_minute": tokens,
+            "tokens_per_minute": self.tokens_per_minute,
+            "dollars_last_hour": round(dollars, 6),
+            "dollars_per_hour": self.dollars_per_hour,
+            "waited_seconds": round(self.waited, 3),
+        }
+
+    def line(self) -> str:
+        s = self.status()
+        tokens = f"{s['tokens_last_minute']}" + (f" / {s['tokens_per_minute']}" if s["tokens_per_minute"] else "")
+        dollars = f"${s['dollars_last_hour']:.4f}" + (f" / ${s['dollars_per_hour']:.2f}" if s["dollars_per_hour"] else "")
+        return (
+            f"LLM spend ${s['dollars']:.4f} ({s['requests']} requests, {s['input_tokens']} in, "
+            f"{s['output_tokens']} out), last minute {tokens} tokens, last hour {dollars}"
+        )
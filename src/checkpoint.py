@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+from typing import Any, Callable, Optional, Union
+
+from metrics import metrics
+from sources import Document, as_document
+from writer import NdjsonJournal
+
+tempext = "temp/"
+outext = "out/"
+
+
+def document_key(source: Union[str, Document]) -> str:
+    """
+    run directory name for a document: <document name>-<first 12 hex chars of its hash>
+    the same document always maps to the same directory, whether it is read plain,
+    compressed, from an archive or from stdin; different documents never share one
+    """
+    document = as_document(source)
+    return f"{document.name}-{document.digest[:12]}"
+
+
+class RunDir:
+    """
+    per-document working directories temp/<key>/ and out/<key>/
+
+    every pipeline step saves its result here as soon as it finishes, so a rerun on
+    the same document only redoes the steps that are missing
+    """
+
+    def __init__(self, source: Union[str, Document], fresh: bool = False):
+        self.key = document_key(source)
+        self.temp = os.path.join(tempext, self.key)
+        self.out = os.path.join(outext, self.key)
+        if fresh:
+            for p in [self.temp, self.out]:
+                shutil.rmtree(p, ignore_errors=True)
+        for p in [self.temp, self.out]:
+            os.makedirs(p, exist_ok=True)
+
+    def temp_path(self, name: str) -> str:
+        return os.path.join(self.temp, name)
+
+    def out_path(self, name: str) -> str:
+        return os.path.join(self.out, name)
+
+    def has(self, name: str) -> bool:
+        return os.path.exists(self.temp_path(name))
+
+    def load(self, name: str) -> Any:
+        """
+        returns the saved json for a step, or None if it has not completed
+        """
+        if not self.has(name):
+            return None
+        with open(self.temp_path(name), "r") as f:
+            return json.load(f)
+
+    def save(self, name: str, data: Any, indent: Optional[int] = None) -> None:
+        """
+        saves a step's json atomically, so a crash never leaves a half written checkpoint
+        """
+        path = self.temp_path(name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, indent=indent)
+        os.replace(path + ".tmp", path)
+
+    def changed(self, name: str, version: str) -> bool:
+        """
+        True if the checkpoints were computed under another version of an input (e.g. the
+        classification schema) than `version`; the current version is recorded as `name`
+        """
+        previous = self.load(name)
+        if previous != version:
+            self.save(name, version)
+        return previous is not None and previous != version
+
+    def discard(self, *names: str) -> None:
+        """
+        removes saved steps so that they are recomputed
+        """
+        for name in names:
+            if self.has(name):
+                os.remove(self.temp_path(name))
+
+    def cached(self, name: str, compute: Callable[[], Any], indent: Optional[int] = None) -> Any:
+        """
+        loads a step's result if saved, otherwise computes and saves it
+        """
+        data = self.load(name)
+        metrics.cache("checkpoint", data is not None)
+        if data is None:
+            data = compute()
+            self.save(name, data, indent)
+        else:
+            print(f"Resuming: loaded {self.temp_path(name)}")
+        return data
+
+    def journal(self, name: str) -> tuple[dict[int, dict[str, Any]], NdjsonJournal]:
+        """
+        opens a per-item journal for a step that completes item by item
+        returns the items already done (by index) and the journal to append new ones to
+        """
+        path = self.temp_path(name)
+        done = {r["index"]: r for r in NdjsonJournal.read(path)}
+        return done, NdjsonJournal(path)
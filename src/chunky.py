@@ -1,9 +1,23 @@
 import re
 import xml.etree.ElementTree as ET
-from typing import Any
+from typing import Any, Callable, Optional
 
 from bs4 import BeautifulSoup
 
+# bump when a change here alters the chunks of a document, so the reference
+# embeddings built with the old chunker are reported as stale (see corpus.py)
+CHUNKER_VERSION = "1"
+
+# characters of text a chunk holds at most
+MAX_CHUNK_SIZE = 6000
+
+# how the repeated chunks of a document are dropped before they are embedded and inferred
+#   normalized  same text once normalized (case, punctuation and whitespace ignored)
+#   exact       same text, character for character
+#   none        every chunk is kept
+DEDUPE_STRATEGIES = ("normalized", "exact", "none")
+
+
 def clean_text(text: str) -> str:
     text = re.sub(r"\s+", " ", text)
     # text = re.sub(r"[^a-zA-Z0-9\s]", "", text)
@@ -68,6 +82,28 @@ def chunkify_table_list(table: list[list[str]], max_chunk_size: int) -> list[str
     return chunk
 
 
+def section_info(section: Optional[ET.Element]) -> dict[str, Optional[str]]:
+    """
+    LOINC code and first templateId root of a <section> element
+    """
+    info: dict[str, Optional[str]] = {"section_code": None, "section_template_id": None}
+    if section is None:
+        return info
+    for child in section:
+        tag = manipulate_tag(child.tag) if isinstance(child.tag, str) else ""
+        if tag == "code" and info["section_code"] is None:
+            info["section_code"] = child.get("code")
+        elif tag == "templateId" and info["section_template_id"] is None:
+            info["section_template_id"] = child.get("root")
+    return info
+
+
+def contains_table(element: ET.Element) -> bool:
+    return any(
+        isinstance(e.tag, str) and manipulate_tag(e.tag) == "table" for e in element.iter()
+    )
+
+
 def chunkify_by_hierarchy_text_tables(
     element: ET.Element,
     max_chunk_size: int,
@@ -79,11 +115,29 @@ def chunkify_by_hierarchy_text_tables(
     It can extract:
       - <table> elements (if include_tables is True)
       - <text> elements that do not contain any <table> descendants (if include_text is True)
+    Besides its text, every chunk records structural metadata so later stages do not
+    have to parse its XML again:
+      - is_table: the chunk is a table
+      - section_path: path of the element used as the chunk's section (everything before ".section.")
+      - section_has_table: that element contains a table
+      - section_code, section_template_id: code and templateId of the enclosing <section>
+      - element_count, text_length: elements and cleaned text characters of the source element
     """
     chunks: list[dict[str, Any]] = []
     chunk_id = 0
+    # elements outside any section, by path, to look up each chunk's section element
+    outer_elements: dict[str, ET.Element] = {}
+
+    def metadata(el: ET.Element, parent_path: str, section: Optional[ET.Element], is_table: bool, text_length: int) -> dict[str, Any]:
+        return {
+            "is_table": is_table,
+            "section_path": parent_path.split(".section.")[0],
+            **section_info(section),
+            "element_count": sum(1 for _ in el.iter()),
+            "text_length": text_length,
+        }
 
-    def process_element(el: ET.Element, parent_path: str):
+    def process_element(el: ET.Element, parent_path: str, section: Optional[ET.Element]):
         nonlocal chunk_id
         if include_tables and el.tag.endswith("table"):
             t = table_to_list(el)
@@ -97,7 +151,8 @@ def chunkify_by_hierarchy_text_tables(
                         "text": combined_text,
                         "path": parent_path,
                         "chunk_size": len(combined_text),
-                        "xml" : clean_xml_string(xml_string)
+                        "xml" : clean_xml_string(xml_string),
+                        **metadata(el, parent_path, section, True, len(combined_text)),
                     }
                 )
                 chunk_id += 1
@@ -108,6 +163,7 @@ def chunkify_by_hierarchy_text_tables(
                 clean_el_text_length = len(clean_el_text)
                 xml_string = ET.tostring(el, encoding='unicode')
                 if clean_el_text_length > 0:
+                    meta = metadata(el, parent_path, section, False, clean_el_text_length)
                     if clean_el_text_length <= max_chunk_size:
                         chunks.append(
                             {
@@ -115,7 +171,8 @@ def chunkify_by_hierarchy_text_tables(
                                 "text": clean_el_text,
                                 "path": parent_path,
                                 "chunk_size": clean_el_text_length,
-                                "xml" : clean_xml_string(xml_string)
+                                "xml" : clean_xml_string(xml_string),
+                                **meta,
                             }
                         )
                         chunk_id += 1
@@ -131,14 +188,19 @@ def chunkify_by_hierarchy_text_tables(
                                     "text": chunk_text,
                                     "path": parent_path,
                                     "chunk_size": len(chunk_text),
-                                    "xml" : clean_xml_string(xml_string)
+                                    "xml" : clean_xml_string(xml_string),
+                                    **meta,
                                 }
                             )
                             chunk_id += 1
                             start = end
 
-    def traverse_xml_tree(el: ET.Element, parent_path: str):
-        process_element(el, parent_path)
+    def traverse_xml_tree(el: ET.Element, parent_path: str, section: Optional[ET.Element]):
+        if ".section." not in parent_path:
+            outer_elements[parent_path] = el
+        if isinstance(el.tag, str) and manipulate_tag(el.tag) == "section":
+            section = el
+        process_element(el, parent_path, section)
         for child in el:
             child_tag = manipulate_tag(child.tag)
             siblings = [c for c in el if manipulate_tag(c.tag) == child_tag]
@@ -146,14 +208,22 @@ def chunkify_by_hierarchy_text_tables(
             if len(siblings) > 1:
                 child_tag = f"{index}"
             new_parent_path = f"{parent_path}.{child_tag}"
-            traverse_xml_tree(child, new_parent_path)
+            traverse_xml_tree(child, new_parent_path, section)
 
-    traverse_xml_tree(element, "root")
+    traverse_xml_tree(element, "root", None)
+
+    section_tables: dict[str, bool] = {}
+    for chunk in chunks:
+        path = chunk["section_path"]
+        if path not in section_tables:
+            section_el = outer_elements.get(path)
+            section_tables[path] = section_el is not None and contains_table(section_el)
+        chunk["section_has_table"] = section_tables[path]
     return chunks
 
 
 def extract_relevant_chunks_file(
-    filename: str, max_chunk_size: int = 6000
+    filename: str, max_chunk_size: int = MAX_CHUNK_SIZE
 ) -> list[dict[str, Any]]:
     """
     extract chunks of a file using XML parsing and dynamic chunking
@@ -167,7 +237,7 @@ def extract_relevant_chunks_file(
 
 
 def extract_relevant_chunks(
-    tree: ET.ElementTree, max_chunk_size: int = 6000
+    tree: ET.ElementTree, max_chunk_size: int = MAX_CHUNK_SIZE
 ) -> list[dict[str, Any]]:
     """
     extract chunks of a tree using XML parsing and dynamic chunking
@@ -176,3 +246,25 @@ def extract_relevant_chunks(
     # chunks = chunkify_by_hierarchy(root, max_chunk_size)
     chunks = chunkify_by_hierarchy_text_tables(root, max_chunk_size, True, True)
     return chunks
+
+
+def dedupe_chunks(
+    chunks: list[dict[str, Any]], strategy: str = "normalized", normalize: Callable[[str], str] = clean_text
+) -> list[dict[str, Any]]:
+    """
+    the first chunk of every text, in document order, under one of DEDUPE_STRATEGIES
+    `normalize` is the text normalization of the "normalized" strategy
+    """
+    if strategy not in DEDUPE_STRATEGIES:
+        raise ValueError(f"unknown dedupe strategy {strategy!r}, expected one of {DEDUPE_STRATEGIES}")
+    if strategy == "none":
+        return list(chunks)
+    seen: set[str] = set()
+    unique: list[dict[str, Any]] = []
+    for chunk in chunks:
+        text = chunk.get("text", "")
+        key = normalize(text) if strategy == "normalized" else text
+        if key not in seen:
+            seen.add(key)
+            unique.append(chunk)
+    return unique
@@ -0,0 +1,248 @@
+import argparse
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+from pathy import embedding_to_source_xml, get_local_tag, get_xml_element
+
+# section code -> category index learned from the labeled reference corpus
+#
+# eICR sections carry a LOINC <code> and a <templateId> that mostly decide their category.
+# for every code and template id seen in embeddings/, the index counts the categories of the
+# reference chunks under it; a key whose chunks agree (at least MIN_SUPPORT chunks, at least
+# MIN_CONSISTENCY of them in one category) answers for that category directly, so embed.py
+# skips the category LLM call and test.py skips the embedding and similarity search.
+# unknown and ambiguous keys fall back to those as before
+#
+# the index is rebuilt whenever a file under embeddings/ is added, removed or rewritten
+
+CODE_INDEX = "code_index.json"
+EMBEDDINGS_DIR = "embeddings"
+
+MIN_SUPPORT = 3
+MIN_CONSISTENCY = 0.95
+
+# the section <code> is tried first, the templateId when the code does not decide
+KEYS = [("code", "section_code"), ("template_id", "section_template_id")]
+
+# reference chunks kept per key and category, shown as the matches of a lookup
+EXAMPLES = 3
+
+
+def _embedding_files(embeddings_dir: str) -> list[str]:
+    files: list[str] = []
+    for root, _, names in os.walk(embeddings_dir):
+        files.extend(os.path.join(root, n) for n in names if n.endswith(".json"))
+    return sorted(files)
+
+
+def corpus_signature(embeddings_dir: str = EMBEDDINGS_DIR) -> str:
+    """
+    first 12 hex chars of a hash of the name, size and modification time of every embeddings file
+    """
+    h = hashlib.sha256()
+    for f in _embedding_files(embeddings_dir):
+        st = os.stat(f)
+        h.update(f"{f}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()[:12]
+
+
+def _section_element(xml_path: str, chunk_path: str) -> Any:
+    """
+    the <section> element a chunk path points into, None if the path is outside any section
+    """
+    if ".section." not in chunk_path and not chunk_path.endswith(".section"):
+        return None
+    return get_xml_element(xml_path, chunk_path.split(".section.")[0] + ".section")
+
+
+def section_keys(xml_path: str, chunk_path: str) -> dict[str, Optional[str]]:
+    """
+    section_code and section_template_id of a reference chunk, read from its source document
+    (for embeddings written before chunks recorded them)
+    """
+    keys: dict[str, Optional[str]] = {"section_code": None, "section_template_id": None}
+    try:
+        section = _section_element(xml_path, chunk_path)
+    except FileNotFoundError:
+        return keys
+    if section is None or get_local_tag(section.tag) != "section":
+        return keys
+    for child in section:
+        tag = get_local_tag(child.tag)
+        if tag == "code" and keys["section_code"] is None:
+            keys["section_code"] = child.get("code")
+        elif tag == "templateId" and keys["section_template_id"] is None:
+            keys["section_template_id"] = child.get("root")
+    return keys
+
+
+class Lookup:
+    """
+    the category an index key decides, with the evidence for it
+    """
+
+    def __init__(self, key: str, value: str, category: str, support: int, consistency: float, examples: list[dict[str, Any]]):
+        self.key = key
+        self.value = value
+        self.category = category
+        self.support = support
+        self.consistency = consistency
+        self.examples = examples
+
+    def label(self) -> str:
+        return f"{self.key}:{self.value}"
+
+
+class CodeIndex:
+    """
+    {"code": {code: entry}, "template_id": {root: entry}} where an entry is
+    {"total": chunks, "categories": {category: chunks}, "examples": {category: [reference chunks]}}
+    """
+
+    def __init__(
+        self,
+        keys: dict[str, dict[str, Any]],
+        signature: str = "",
+        min_support: int = MIN_SUPPORT,
+        min_consistency: float = MIN_CONSISTENCY,
+    ):
+        self.keys = keys
+        self.signature = signature
+        self.min_support = min_support
+        self.min_consistency = min_consistency
+
+    @classmethod
+    def build(cls, embeddings_dir: str = EMBEDDINGS_DIR) -> "CodeIndex":
+        """
+        counts the categories of every reference chunk under its section code and template id
+        """
+        signature = corpus_signature(embeddings_dir)
+        keys: dict[str, dict[str, Any]] = {key: {} for key, _ in KEYS}
+        for f in _embedding_files(embeddings_dir):
+            rel_path = os.path.relpath(f, embeddings_dir)
+            with open(f, "r") as fh:
+                records = json.load(fh)
+            if not isinstance(records, list):
+                continue
+            xml_path = embedding_to_source_xml(rel_path)
+            for e in records:
+                if not e.get("category"):
+                    continue
+                chunk_keys = (
+                    {field: e.get(field) for _, field in KEYS}
+                    if "section_code" in e
+                    else section_keys(xml_path, e["path"])
+                )
+                for key, field in KEYS:
+                    value = chunk_keys[field]
+                    if not value:
+                        continue
+                    entry = keys[key].setdefault(value, {"total": 0, "categories": {}, "examples": {}})
+                    entry["total"] += 1
+                    entry["categories"][e["category"]] = entry["categories"].get(e["category"], 0) + 1
+                    examples = entry["examples"].setdefault(e["category"], [])
+                    if len(examples) < EXAMPLES:
+                        examples.append(
+                            {"file": f"{embeddings_dir}/{rel_path}", "chunk_id": e["chunk_id"], "path": e["path"]}
+                        )
+        return cls(keys, signature)
+
+    @classmethod
+    def load(cls, path: str = CODE_INDEX, embeddings_dir: str = EMBEDDINGS_DIR) -> "CodeIndex":
+        """
+        the saved index, rebuilt (and saved) if the reference embeddings changed since it was built
+        """
+        signature = corpus_signature(embeddings_dir)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("signature") == signature:
+                return cls(data["keys"], signature)
+        index = cls.build(embeddings_dir)
+        index.save(path)
+        return index
+
+    def save(self, path: str = CODE_INDEX) -> None:
+        with open(path + ".tmp", "w") as f:
+            json.dump({"signature": self.signature, "keys": self.keys}, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+    def decide(self, key: str, value: Optional[str]) -> Optional[Lookup]:
+        """
+        the category of one key, None if the key is unknown or its chunks disagree
+        """
+        entry = self.keys.get(key, {}).get(value) if value else None
+        if entry is None or entry["total"] < self.min_support:
+            return None
+        category, count = max(entry["categories"].items(), key=lambda c: c[1])
+        consistency = count / entry["total"]
+        if consistency < self.min_consistency:
+            return None
+        return Lookup(key, value, category, entry["total"], consistency, entry["examples"][category])  # type: ignore
+
+    def lookup(self, chunk: dict[str, Any]) -> Optional[Lookup]:
+        """
+        the category of a chunk from its section code, else its template id; None to fall
+        back to the similarity search
+        """
+        for key, field in KEYS:
+            decided = self.decide(key, chunk.get(field))
+            if decided is not None:
+                return decided
+        return None
+
+    def table(self) -> list[dict[str, Any]]:
+        """
+        one row per key: its categories by frequency, consistency and whether it decides
+        """
+        rows: list[dict[str, Any]] = []
+        for key, _ in KEYS:
+            for value, entry in sorted(self.keys.get(key, {}).items(), key=lambda kv: -kv[1]["total"]):
+                categories = sorted(entry["categories"].items(), key=lambda c: -c[1])
+                rows.append(
+                    {
+                        "key": key,
+                        "value": value,
+                        "total": entry["total"],
+                        "categories": dict(categories),
+                        "consistency": round(categories[0][1] / entry["total"], 4),
+                        "decides": self.decide(key, value) is not None,
+                    }
+                )
+        return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="python codeindex.py {build,show} [--min-support N] [--min-consistency R] [--json]"
+    )
+    parser.add_argument("command", choices=["build", "show"])
+    parser.add_argument("--embeddings", default=EMBEDDINGS_DIR, help="directory of json embedding files")
+    parser.add_argument("--index", default=CODE_INDEX)
+    parser.add_argument("--min-support", type=int, default=MIN_SUPPORT, help="show which keys would decide at this support")
+    parser.add_argument("--min-consistency", type=float, default=MIN_CONSISTENCY, help="show which keys would decide at this consistency")
+    parser.add_argument("--json", action="store_true", help="print the table as json")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = CodeIndex.build(args.embeddings)
+        index.save(args.index)
+    else:
+        index = CodeIndex.load(args.index, args.embeddings)
+    index.min_support = args.min_support
+    index.min_consistency = args.min_consistency
+
+    rows = index.table()
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        for r in rows:
+            categories = ", ".join(f"{c} {n}" for c, n in r["categories"].items())
+            mark = "decides" if r["decides"] else "falls back"
+            print(f"{r['key']:<12} {r['value']:<36} {r['total']:>6} chunks  {r['consistency']:>7.1%}  {mark:<10}  {categories}")
+        deciding = sum(r["decides"] for r in rows)
+        print(f"{len(rows)} keys, {deciding} decide a category (support >= {args.min_support}, consistency >= {args.min_consistency:.0%})")
+        if args.command == "build":
+            print(f"Saved {args.index}")
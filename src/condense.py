@@ -0,0 +1,252 @@
+import argparse
+import glob
+import json
+import math
+import os
+from typing import Any, Optional
+
+import numpy as np
+
+from store import DEFAULT_STORE, QUANTIZATIONS, EmbeddingStore, normalize
+
+# reference-corpus condensation
+#
+# the additive score of a category sums the similarity of a chunk to every reference row of
+# that category, so near-duplicate references (dozens of alike "Social History" sections)
+# add cost and noise. the rows of each category are clustered with weighted k-medoids on
+# cosine similarity and only the medoids are kept, each weighted by the rows of its cluster:
+# sum over a cluster of sim(q, row) ~ weight * sim(q, medoid), so additive scores are kept
+# approximately while the store shrinks. test.py multiplies similarities by the weights
+#
+# the report compares the categories chosen with the condensed store against the full one
+
+DEFAULT_OUTPUT = "embeddings_store_condensed"
+
+# rows of the similarity matrix computed at a time
+BLOCK_ROWS = 4096
+
+# reference rows sampled as queries when no test run embeddings are given
+SAMPLE_QUERIES = 500
+
+
+def _assign(vectors: np.ndarray, medoids: np.ndarray) -> np.ndarray:
+    """
+    index (into medoids) of the most similar medoid of every vector
+    """
+    labels = np.empty(len(vectors), dtype=np.int64)
+    centers = vectors[medoids].T
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        labels[start : start + BLOCK_ROWS] = np.argmax(vectors[start : start + BLOCK_ROWS] @ centers, axis=1)
+    return labels
+
+
+def weighted_kmedoids(
+    vectors: np.ndarray, weights: np.ndarray, k: int, iterations: int = 20, seed: int = 0
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    k medoids of unit row vectors under cosine distance, each vector counted with its weight
+    returns (row of every medoid, medoid index of every row)
+
+    seeded like k-means++ (weighted by distance to the nearest medoid so far), then
+    alternates assignment and medoid update until the medoids stop changing. on unit
+    vectors the member with the least weighted distance to its cluster is the one most
+    similar to the cluster's weighted sum, so an update is linear in the cluster size
+    """
+    n = len(vectors)
+    if k >= n:
+        return np.arange(n), np.arange(n)
+    rng = np.random.default_rng(seed)
+    medoids = [int(rng.choice(n, p=weights / weights.sum()))]
+    distance = 1.0 - vectors @ vectors[medoids[0]]
+    while len(medoids) < k:
+        p = weights * np.maximum(distance, 0.0)
+        if p.sum() <= 0:
+            break  # every row coincides with a medoid already
+        medoids.append(int(rng.choice(n, p=p / p.sum())))
+        distance = np.minimum(distance, 1.0 - vectors @ vectors[medoids[-1]])
+    current = np.array(medoids, dtype=np.int64)
+    for _ in range(iterations):
+        labels = _assign(vectors, current)
+        updated = current.copy()
+        for c in range(len(current)):
+            members = np.flatnonzero(labels == c)
+            if len(members) == 0:
+                continue
+            center = weights[members] @ vectors[members]
+            updated[c] = members[int(np.argmax(vectors[members] @ center))]
+        if np.array_equal(updated, current):
+            break
+        current = updated
+    return current, _assign(vectors, current)
+
+
+def condense(
+    store: EmbeddingStore,
+    output: str,
+    ratio: float = 0.25,
+    min_rows: int = 1,
+    quantization: Optional[str] = None,
+    seed: int = 0,
+) -> tuple[EmbeddingStore, dict[str, dict[str, Any]]]:
+    """
+    writes a store holding, per category, ceil(ratio * rows) (at least min_rows) weighted medoids
+    returns the new store and {category: {"rows", "medoids", "weight"}}
+    """
+    vectors = normalize(np.asarray(store.full[store.row_ids], dtype=np.float32))
+    meta = list(store.meta)
+    weights = np.array([float(m.get("weight", 1)) for m in meta], dtype=np.float64)
+    by_category: dict[str, list[int]] = {}
+    for i, m in enumerate(meta):
+        by_category.setdefault(m["category"], []).append(i)
+
+    kept: dict[str, list[dict[str, Any]]] = {}
+    summary: dict[str, dict[str, Any]] = {}
+    for category, rows in sorted(by_category.items()):
+        idx = np.array(rows, dtype=np.int64)
+        k = max(min_rows, math.ceil(ratio * len(idx)))
+        medoids, labels = weighted_kmedoids(vectors[idx], weights[idx], k, seed=seed)
+        cluster_weights = np.bincount(labels, weights=weights[idx], minlength=len(medoids))
+        for c, medoid in enumerate(medoids):
+            row = int(idx[medoid])
+            m = meta[row]
+            kept.setdefault(m["file"], []).append(
+                {**m, "embedding": vectors[row], "weight": round(float(cluster_weights[c]), 6)}
+            )
+        summary[category] = {
+            "rows": len(idx),
+            "medoids": len(medoids),
+            "weight": round(float(weights[idx].sum()), 6),
+        }
+
+    condensed = EmbeddingStore.create(output, store.dimensions, quantization or store.quantization)
+    for file, embeddings in sorted(kept.items()):
+        condensed.append(file, sorted(embeddings, key=lambda e: e["chunk_id"]), reload=False)
+    condensed.reload()
+    return condensed, summary
+
+
+def load_queries(paths: list[str]) -> np.ndarray:
+    """
+    query vectors: the embeddings.ndjson journals of test.py runs (under directories such
+    as temp/, searched recursively) and json embedding files named directly
+    """
+    vectors: list[list[float]] = []
+    for p in paths:
+        if os.path.isdir(p):
+            for f in sorted(glob.glob(os.path.join(p, "**", "embeddings.ndjson"), recursive=True)):
+                with open(f, "r") as fh:
+                    vectors.extend(json.loads(line)["embedding"] for line in fh if line.endswith("\n"))
+        else:
+            with open(p, "r") as fh:
+                if p.endswith(".ndjson"):
+                    vectors.extend(json.loads(line)["embedding"] for line in fh if line.endswith("\n"))
+                else:
+                    vectors.extend(e["embedding"] for e in json.load(fh))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def _categories(store: EmbeddingStore, queries: np.ndarray) -> tuple[list[str], list[str], np.ndarray]:
+    """
+    (top match category, additive top category, additive top score) of each query, at full precision
+    """
+    meta = list(store.meta)
+    names = sorted({m["category"] for m in meta})
+    column = np.array([names.index(m["category"]) for m in meta], dtype=np.int64)
+    weights = np.array([float(m.get("weight", 1)) for m in meta], dtype=np.float32)
+    full = normalize(np.asarray(store.full[store.row_ids], dtype=np.float32))
+    top: list[str] = []
+    additive: list[str] = []
+    scores: list[float] = []
+    q = normalize(queries)
+    for start in range(0, len(q), 256):
+        s = q[start : start + 256] @ full.T
+        per_category = np.zeros((len(s), len(names)), dtype=np.float64)
+        for c in range(len(names)):
+            per_category[:, c] = (s[:, column == c] * weights[column == c]).sum(axis=1)
+        top.extend(meta[j]["category"] for j in np.argmax(s, axis=1))
+        best = np.argmax(per_category, axis=1)
+        additive.extend(names[c] for c in best)
+        scores.extend(per_category[np.arange(len(s)), best].tolist())
+    return top, additive, np.array(scores)
+
+
+def agreement(full: EmbeddingStore, condensed: EmbeddingStore, queries: np.ndarray) -> dict[str, Any]:
+    """
+    how often the condensed store picks the full store's categories for the same queries,
+    and how far off its additive top scores are
+    """
+    if len(queries) == 0 or len(full) == 0:
+        return {"queries": 0}
+    full_top, full_additive, full_scores = _categories(full, queries)
+    top, additive, scores = _categories(condensed, queries)
+    n = len(queries)
+    same = np.array([a == b for a, b in zip(additive, full_additive)])
+    error = np.abs(scores - full_scores) / np.maximum(np.abs(full_scores), 1e-9)
+    return {
+        "queries": n,
+        "top_category_agreement": round(sum(a == b for a, b in zip(top, full_top)) / n, 4),
+        "additive_category_agreement": round(float(same.mean()), 4),
+        # relative error of the additive top score where both pick the same category
+        "additive_score_error": round(float(error[same].mean()), 4) if same.any() else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="python condense.py [--store DIR] [--output DIR] [--ratio R] [--queries PATH ...] [--report FILE]"
+    )
+    parser.add_argument("--store", default=DEFAULT_STORE, help="store to condense (build one with store.py build)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--ratio", type=float, default=0.25, help="share of each category's rows kept as medoids")
+    parser.add_argument("--min-rows", type=int, default=1, help="medoids kept per category at least")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, help="of the condensed store (default: the source's)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--queries",
+        nargs="*",
+        default=["temp"],
+        help="embeddings of test documents for the agreement report: temp/<key>/ run dirs or embedding files "
+        f"(default temp/; without any, {SAMPLE_QUERIES} reference rows are sampled)",
+    )
+    parser.add_argument("--report", default="out/condense_report.json")
+    args = parser.parse_args()
+
+    if os.path.abspath(args.store) == os.path.abspath(args.output):
+        raise SystemExit("--output must differ from --store, the full store is kept for comparison")
+    full = EmbeddingStore(args.store)
+    condensed, summary = condense(full, args.output, args.ratio, args.min_rows, args.quantization, args.seed)
+
+    queries = load_queries([p for p in args.queries if os.path.exists(p)])
+    query_source = "test run embeddings"
+    if len(queries) == 0 and len(full):
+        rng = np.random.default_rng(args.seed)
+        rows = rng.choice(len(full), min(SAMPLE_QUERIES, len(full)), replace=False)
+        queries = np.asarray(full.full[full.row_ids[np.sort(rows)]], dtype=np.float32)
+        query_source = "sampled reference rows"
+    report = {
+        "store": args.store,
+        "output": args.output,
+        "ratio": args.ratio,
+        "rows": {"full": len(full), "condensed": len(condensed)},
+        "reduction": round(len(full) / max(len(condensed), 1), 2),
+        "matrix_mb": {"full": round(full.nbytes / 2**20, 4), "condensed": round(condensed.nbytes / 2**20, 4)},
+        "categories": summary,
+        "query_source": query_source,
+        **agreement(full, condensed, queries),
+    }
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{args.store}: {len(full)} rows -> {args.output}: {len(condensed)} rows ({report['reduction']}x smaller)")
+    for category, c in summary.items():
+        print(f"  {category}: {c['rows']} rows -> {c['medoids']} medoids")
+    if report["queries"]:
+        print(
+            f"Agreement with the full store over {report['queries']} queries ({query_source}): "
+            f"top category {report['top_category_agreement']:.1%}, "
+            f"additive category {report['additive_category_agreement']:.1%}, "
+            f"additive score error {report['additive_score_error'] or 0:.2%}"
+        )
+    print(f"Report: {args.report}")
+    print(f"Use it with: python src/test.py <xml_file> --store {args.output}")
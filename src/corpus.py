@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import time
+from typing import Any, Optional, Union
+
+from bedrock import embedding_model_id
+from chunky import CHUNKER_VERSION
+from codeindex import CodeIndex
+from schemas import get_schema
+from sources import Document, as_document, document_path, find_documents, open_documents
+from store import DEFAULT_STORE, QUANTIZATIONS, EmbeddingStore
+from vectoring import SCHEMA_TYPE
+
+MANIFEST = "manifest.json"
+
+
+def schema_version() -> str:
+    """
+    first 12 hex chars of the hash of the classification schema the categories come from
+    """
+    return get_schema(SCHEMA_TYPE).version
+
+
+def relative_path(source: Union[str, Document]) -> str:
+    """
+    key of a reference document in the store and manifest: its json path under embeddings/
+    (derived from the plain xml path of the document, see sources.py)
+    """
+    path = source.path if isinstance(source, Document) else document_path(source)
+    return path.replace(".xml", ".json")
+
+
+def load_manifest(store_path: str = DEFAULT_STORE) -> dict[str, dict[str, Any]]:
+    path = os.path.join(store_path, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict[str, dict[str, Any]], store_path: str = DEFAULT_STORE) -> None:
+    path = os.path.join(store_path, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def stale_reasons(entry: dict[str, Any]) -> list[str]:
+    """
+    why a manifest entry no longer matches its source document and the current pipeline
+    an empty list means its embeddings are up to date
+    """
+    try:
+        digest = as_document(entry["source"]).digest
+    except FileNotFoundError:
+        return ["source deleted"]
+    reasons: list[str] = []
+    if digest != entry["source_hash"]:
+        reasons.append("source changed")
+    if entry["model_id"] != embedding_model_id:
+        reasons.append(f"model {entry['model_id']} -> {embedding_model_id}")
+    if entry["schema_version"] != schema_version():
+        reasons.append("schema changed")
+    if entry["chunker_version"] != CHUNKER_VERSION:
+        reasons.append(f"chunker {entry['chunker_version']} -> {CHUNKER_VERSION}")
+    return reasons
+
+
+def register(
+    source: Union[str, Document],
+    embeddings: list[dict[str, Any]],
+    store_path: str = DEFAULT_STORE,
+    quantization: str = "int8",
+) -> int:
+    """
+    replaces the store rows of a reference document with its new embeddings and records
+    it in the manifest, creating the store if needed
+    returns the number of rows written
+    """
+    document = as_document(source)
+    rel_path = relative_path(document)
+    if os.path.exists(os.path.join(store_path, "store.json")):
+        store = EmbeddingStore(store_path)
+    else:
+        dimensions = len(embeddings[0]["embedding"]) if embeddings else 0
+        store = EmbeddingStore.create(store_path, dimensions, quantization)
+    store.delete(rel_path)
+    store.append(rel_path, embeddings)
+
+    manifest = load_manifest(store_path)
+    manifest[rel_path] = {
+        "source": document.label,
+        "source_hash": document.digest,
+        "model_id": embedding_model_id,
+        "schema_version": schema_version(),
+        "chunker_version": CHUNKER_VERSION,
+        "rows": len(embeddings),
+        "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    save_manifest(manifest, store_path)
+    return len(embeddings)
+
+
+def unregister(file: str, store_path: str = DEFAULT_STORE) -> int:
+    """
+    removes a reference document from the store, the manifest and embeddings/
+    returns the number of rows deleted
+    """
+    rel_path = relative_path(file)
+    deleted = EmbeddingStore(store_path).delete(rel_path)
+    manifest = load_manifest(store_path)
+    if manifest.pop(rel_path, None) is not None:
+        save_manifest(manifest, store_path)
+    json_path = os.path.join("embeddings", rel_path)
+    if os.path.exists(json_path):
+        os.remove(json_path)
+    return deleted
+
+
+def add(
+    source: Union[str, Document],
+    store_path: str = DEFAULT_STORE,
+    quantization: str = "int8",
+    index: Optional[CodeIndex] = None,
+) -> int:
+    """
+    embeds a reference document and adds (or replaces) it in the store
+    (with categories from the section code index where it decides them)
+    """
+    from embed import embed_document
+
+    document = as_document(source)
+    _, embeddings = embed_document(document, index)
+    return register(document, embeddings, store_path, quantization)
+
+
+def find_sources(paths: list[str]) -> list[str]:
+    """
+    xml files (compressed or not) and xml members of tar archives, named directly or
+    found under the given directories
+    """
+    return find_documents(paths)
+
+
+def sync(
+    paths: list[str],
+    store_path: str = DEFAULT_STORE,
+    quantization: str = "int8",
+    index: Optional[CodeIndex] = None,
+) -> dict[str, int]:
+    """
+    brings the store in line with the reference documents:
+    adds sources not in the manifest, re-embeds stale ones and deletes those whose source is gone
+    """
+    manifest = load_manifest(store_path)
+    known = {entry["source"] for entry in manifest.values()}
+    counts = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    for source in find_sources(paths):
+        if source not in known:
+            print(f"Adding {source}")
+            add(source, store_path, quantization, index)
+            counts["added"] += 1
+    for rel_path, entry in sorted(manifest.items()):
+        reasons = stale_reasons(entry)
+        if reasons == ["source deleted"]:
+            print(f"Deleting {entry['source']}: source deleted")
+            unregister(entry["source"], store_path)
+            counts["deleted"] += 1
+        elif reasons:
+            print(f"Updating {entry['source']}: {', '.join(reasons)}")
+            add(entry["source"], store_path, quantization, index)
+            counts["updated"] += 1
+        else:
+            counts["unchanged"] += 1
+    return counts
+
+
+def print_status(store_path: str = DEFAULT_STORE, stale_only: bool = False) -> None:
+    manifest = load_manifest(store_path)
+    stale = 0
+    for rel_path, entry in sorted(manifest.items()):
+        reasons = stale_reasons(entry)
+        stale += bool(reasons)
+        if reasons or not stale_only:
+            state = "STALE (" + ", ".join(reasons) + ")" if reasons else "ok"
+            print(f"{entry['source']}: {entry['rows']} rows, updated {entry['updated']}, {state}")
+    store = EmbeddingStore(store_path)
+    print(
+        f"{len(manifest)} documents, {stale} stale, {len(store)} rows, "
+        f"{store.deleted} deleted rows awaiting compaction"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="incremental maintenance of the reference corpus in the binary embedding store",
+        usage="python corpus.py {add,update,delete,sync,stale,status,compact} [xml ...] [--store DIR] [--no-code-index]",
+    )
+    parser.add_argument("command", choices=["add", "update", "delete", "sync", "stale", "status", "compact"])
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="reference xml files, compressed or not, tar archives or <archive>:<member> (sync also accepts directories)",
+    )
+    parser.add_argument("--store", default=DEFAULT_STORE)
+    parser.add_argument("--quantization", default="int8", choices=QUANTIZATIONS, help="used when creating the store")
+    parser.add_argument(
+        "--no-code-index",
+        action="store_true",
+        help="ask the LLM for every chunk's category instead of taking it from the section code index",
+    )
+    args = parser.parse_args()
+    index = None if args.no_code_index or args.command not in ("add", "update", "sync") else CodeIndex.load()
+
+    if args.command in ("add", "update"):
+        for document in [d for f in args.files for d in open_documents(f)]:
+            if document.file is None:
+                print(f"{document.label}: skipped, the store only holds documents it can read again (not stdin)")
+                continue
+            entry: Optional[dict[str, Any]] = load_manifest(args.store).get(relative_path(document))
+            if args.command == "update" and entry is not None and not stale_reasons(entry):
+                print(f"{document.label}: up to date")
+                continue
+            rows = add(document, args.store, args.quantization, index)
+            print(f"{document.label}: {rows} rows written")
+    elif args.command == "delete":
+        for file in args.files:
+            print(f"{file}: {unregister(file, args.store)} rows deleted")
+    elif args.command == "sync":
+        counts = sync(args.files, args.store, args.quantization, index)
+        print(", ".join(f"{v} {k}" for k, v in counts.items()))
+    elif args.command == "compact":
+        dropped = EmbeddingStore(args.store).compact()
+        print(f"Compacted {args.store}: {dropped} deleted rows removed")
+    else:
+        print_status(args.store, stale_only=args.command == "stale")
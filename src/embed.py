@@ -1,39 +1,46 @@
+import argparse
 import json
 import os
-import sys
+from typing import Any, Optional, Union
 
+from checkpoint import RunDir
+from codeindex import CodeIndex
+from corpus import register, relative_path
 from chunky import extract_relevant_chunks_file, extract_relevant_chunks
+from metrics import metrics
 from preprocess import resolve_references, strip_namespaces, write_preprocessed_file
+from sources import Document, as_document, open_documents
+from store import DEFAULT_STORE
 from vectoring import get_bedrock_embeddings_with_category
 from test import normalize_text
 
-tempext = "temp/"
 
+def embeddings_path(source: Union[str, Document]) -> str:
+    """
+    json file holding the reference embeddings of an xml document
+    """
+    return "embeddings/" + relative_path(source)
 
-def cleanup():
-    if os.path.exists(tempext):
-        for file in os.listdir(tempext):
-            os.remove(os.path.join(tempext, file))
-    else:
-        os.mkdir(tempext)
 
-
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("usage: python embed.py <xml_file>")
-        sys.exit(1)
-    cleanup()
-    file = sys.argv[1]
+def embed_document(source: Union[str, Document], index: Optional[CodeIndex] = None) -> tuple[str, list[dict[str, Any]]]:
+    """
+    preprocesses, chunks and embeds one reference document
+    writes embeddings/<document path>.json and returns (that path, the embeddings)
+    with an index, chunks whose section code decides a category take it from there
+    instead of asking the LLM
+    """
+    document = as_document(source)
+    # temp/<key>/ is private to this document, so concurrent runs do not collide
+    run = RunDir(document, fresh=True)
 
     # Preprocess: resolve references
     print("Preprocessing: resolving references...")
-    resolved_tree = resolve_references(file)
+    resolved_tree = resolve_references(document)
     strip_namespaces(resolved_tree)
 
     # Save preprocessed file (no XML declaration, no namespace prefixes)
-    preprocessed_path = os.path.join("out", os.path.basename(file).replace(".xml", "_preprocessed.xml"))
-    os.makedirs("out", exist_ok=True)
-    write_preprocessed_file(resolved_tree, preprocessed_path, file)
+    preprocessed_path = run.out_path(f"{document.name}_preprocessed.xml")
+    write_preprocessed_file(resolved_tree, preprocessed_path, document)
     print(f"Saved preprocessed file: {preprocessed_path}")
     
     # Extract chunks from resolved tree
@@ -49,12 +56,54 @@ if __name__ == "__main__":
     )
     chunks = unique_chunks
 
-    with open(tempext + "chunks.json", "w") as f:
-        json.dump(chunks, f)
+    run.save("chunks.json", chunks)
 
     # choose between hl7 and ecr (makedata golden template) schemas in vectoring.py
-    embeddings = [get_bedrock_embeddings_with_category(chunk) for chunk in chunks]
-    output_path = "embeddings/" + file.replace(".xml", ".json")
+    lookups = [index.lookup(chunk) if index is not None else None for chunk in chunks]
+    embeddings = []
+    for chunk, lookup in zip(chunks, lookups):
+        e = get_bedrock_embeddings_with_category(chunk, lookup.category if lookup is not None else None)
+        if e is None:
+            # an empty category would be counted in every store and additive score
+            print(f"No category for chunk {chunk['chunk_id']} ({chunk['path']}), left out of the embeddings")
+            metrics.incr("chunks_uncategorized")
+            continue
+        embeddings.append(e)
+    short_circuited = sum(lookup is not None for lookup in lookups)
+    metrics.cache("code_index", True, short_circuited)
+    metrics.cache("code_index", False, len(chunks) - short_circuited)
+    metrics.incr("llm_calls_saved", short_circuited, reason="code_index")
+    if index is not None:
+        print(
+            f"Categories: {short_circuited} / {len(chunks)} chunks from the section code index, "
+            f"{len(chunks) - short_circuited} asked of the LLM"
+        )
+    output_path = embeddings_path(document)
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     with open(output_path, "w") as f:
         json.dump(embeddings, f, indent=4)
+    return output_path, embeddings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python embed.py <xml_file | archive | -> [--no-code-index]")
+    parser.add_argument("file", help="xml file, compressed or not, tar archive, <archive>:<member>, or - for stdin")
+    parser.add_argument(
+        "--no-code-index",
+        action="store_true",
+        help="ask the LLM for every chunk's category instead of taking it from the section code index",
+    )
+    args = parser.parse_args()
+    # built from the embeddings already written, before this run adds to them
+    index = None if args.no_code_index else CodeIndex.load()
+    for document in open_documents(args.file):
+        output_path, embeddings = embed_document(document, index)
+
+        # keep an existing binary store in step without rebuilding it
+        if os.path.exists(os.path.join(DEFAULT_STORE, "store.json")):
+            if document.file is None:
+                # the store's manifest re-reads its sources to notice changes, stdin cannot be read again
+                print(f"Not added to the embedding store (read from stdin): {output_path}")
+                continue
+            register(document, embeddings)
+            print(f"Updated embedding store: {DEFAULT_STORE}")
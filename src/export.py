@@ -0,0 +1,193 @@
+import argparse
+import dataclasses
+import glob
+import hashlib
+import os
+from typing import Any, Iterator, Optional
+
+from records import parse_soft_attributes
+from writer import NdjsonJournal
+
+RESULTS = "results.ndjson"
+SECTIONS = "sections.ndjson"
+
+# matches of the top additive category kept per chunk
+TOP_K = 5
+
+
+def section_id(file: str, path: str) -> str:
+    """
+    stable id of a section of a document: first 12 hex chars of the hash of file and element path
+    """
+    return hashlib.sha256(f"{file}#{path}".encode("utf-8")).hexdigest()[:12]
+
+
+def section_text(element: Any) -> str:
+    return " ".join("".join(element.itertext()).split()) if element is not None else ""
+
+
+def inference_fields(inference: str) -> Optional[dict[str, Any]]:
+    """
+    the soft attribute answer as a dict of records.SoftAttributes fields, None if it does not parse
+    """
+    try:
+        return dataclasses.asdict(parse_soft_attributes(inference))
+    except ValueError:
+        return None
+
+
+class ResultExporter:
+    """
+    compact per-chunk export of a test.py run, next to the XML report
+
+      results.ndjson   one record per chunk: ids, paths, categories, scores, top-k
+                       matches and the parsed inference fields
+      sections.ndjson  the text of every section referenced by a result, once
+
+    both files are appended as the run goes; on resume the records already exported
+    are skipped, so every chunk and every section appears exactly once
+    """
+
+    def __init__(self, out_dir: str):
+        self.results_path = os.path.join(out_dir, RESULTS)
+        self.sections_path = os.path.join(out_dir, SECTIONS)
+        self.exported = {r["index"] for r in NdjsonJournal.read(self.results_path)}
+        self.sections = {r["section_id"] for r in NdjsonJournal.read(self.sections_path)}
+        self._results = NdjsonJournal(self.results_path)
+        self._sections = NdjsonJournal(self.sections_path)
+
+    def section(self, file: str, path: str, element: Any) -> str:
+        """
+        id of a section, exporting its text the first time it is seen
+        """
+        sid = section_id(file, path)
+        if sid not in self.sections:
+            self.sections.add(sid)
+            self._sections.append({"section_id": sid, "file": file, "path": path, "text": section_text(element)})
+        return sid
+
+    def write(
+        self,
+        index: int,
+        entry: dict[str, Any],
+        chunk: dict[str, Any],
+        test_section: str,
+        reference_section: str,
+        inference: Optional[str],
+        prefiltered: bool = False,
+    ) -> None:
+        """
+        exports one chunk's result; `entry` is its additive_scores entry, `inference`
+        the soft attribute answer (None for table sections, which are not inferred),
+        `prefiltered` whether that answer was given by the prefilter instead of the LLM
+        """
+        if index in self.exported:
+            return
+        self.exported.add(index)
+        # matches of a section code lookup have no similarity and keep their order
+        matches = sorted(entry["highest_category_matches"], key=lambda m: m["similarity"] or 0.0, reverse=True)[:TOP_K]
+        fields = inference_fields(inference) if inference is not None else None
+        self._results.append(
+            {
+                "index": index,
+                "chunk_id": entry["test_file"]["chunk_id"],
+                "document": entry["test_file"]["file"],
+                "path": entry["test_file"]["path"],
+                "section_id": test_section,
+                "is_table": chunk.get("is_table", False),
+                "section_has_table": chunk.get("section_has_table", False),
+                "section_code": chunk.get("section_code"),
+                "category": entry["category"],
+                "similarity": entry["similarity"],
+                "additive_top_category": entry["additive_top_category"],
+                "additive_top_score": entry["additive_top_score"],
+                "lookup": entry.get("lookup"),
+                "top_match": {
+                    "file": entry["existing_file"]["file"],
+                    "chunk_id": entry["existing_file"]["chunk_id"],
+                    "path": entry["existing_file"]["path"],
+                    "section_id": reference_section,
+                },
+                "top_matches": [
+                    {"file": m["file"], "path": m["path"], "similarity": m["similarity"]} for m in matches
+                ],
+                "inferred": inference is not None,
+                "prefiltered": prefiltered,
+                "inference_valid": fields is not None,
+                "inference": fields,
+            }
+        )
+
+    def close(self) -> None:
+        self._results.close()
+        self._sections.close()
+
+
+def iter_records(paths: list[str], name: str) -> Iterator[dict[str, Any]]:
+    """
+    records of `name` (results.ndjson or sections.ndjson) from run directories or files
+    """
+    for p in paths:
+        if os.path.isdir(p):
+            files = sorted(glob.glob(os.path.join(p, "**", name), recursive=True))
+        else:
+            # results.ndjson and sections.ndjson of a run sit side by side
+            files = [os.path.join(os.path.dirname(p), name)]
+        for f in files:
+            yield from NdjsonJournal.read(f)
+
+
+def _flatten(record: dict[str, Any]) -> dict[str, Any]:
+    """
+    result record with nested objects spread into columns (top_match.file -> top_match_file)
+    """
+    flat: dict[str, Any] = {}
+    for k, v in record.items():
+        if isinstance(v, dict):
+            for k2, v2 in v.items():
+                flat[f"{k}_{k2}"] = v2
+        elif k in ("inference", "lookup") and v is None:
+            continue
+        else:
+            flat[k] = v
+    return flat
+
+
+def to_parquet(paths: list[str], output_dir: str) -> tuple[str, str]:
+    """
+    writes results.parquet and sections.parquet for every run under paths (requires pyarrow)
+    sections shared by several runs are written once
+    """
+    try:
+        import pyarrow as pa  # type: ignore
+        import pyarrow.parquet as pq  # type: ignore
+    except ImportError:
+        raise SystemExit("Parquet export needs pyarrow: pip install pyarrow")
+
+    os.makedirs(output_dir, exist_ok=True)
+    flat = [_flatten(r) for r in iter_records(paths, RESULTS)]
+    # records without parsed inference fields lack those columns
+    columns = dict.fromkeys(k for r in flat for k in r)
+    results = [{k: r.get(k) for k in columns} for r in flat]
+    seen: set[str] = set()
+    sections = []
+    for s in iter_records(paths, SECTIONS):
+        if s["section_id"] not in seen:
+            seen.add(s["section_id"])
+            sections.append(s)
+    results_path = os.path.join(output_dir, "results.parquet")
+    sections_path = os.path.join(output_dir, "sections.parquet")
+    pq.write_table(pa.Table.from_pylist(results), results_path)
+    pq.write_table(pa.Table.from_pylist(sections), sections_path)
+    return results_path, sections_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python export.py parquet <run dirs or results files...> [--output DIR]")
+    parser.add_argument("command", choices=["parquet"])
+    parser.add_argument("paths", nargs="+", help="out/<key>/ run directories (searched recursively) or ndjson files")
+    parser.add_argument("--output", default="out/export")
+    args = parser.parse_args()
+
+    results_path, sections_path = to_parquet(args.paths, args.output)
+    print(f"Wrote {results_path} and {sections_path}")
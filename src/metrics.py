@@ -0,0 +1,209 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "buckets": {
+                ("+Inf" if b == float("inf") else str(b)): n
+                for b, n in zip(LATENCY_BUCKETS, self.buckets)
+            },
+        }
+
+
+class Metrics:
+    """
+    process-wide timing and counter registry for a pipeline run
+    - stages: wall time spent in each pipeline stage (summed over repeated entries)
+    - histograms: per-call latencies, e.g. bedrock requests
+    - counters: retries, throttles, cache hits and misses, ...
+    safe to use from several threads
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.time()
+            self.stages: dict[str, dict[str, float]] = {}
+            self.histograms: dict[tuple[str, Labels], Histogram] = {}
+            self.counters: dict[tuple[str, Labels], float] = {}
+            self.info: dict[str, Any] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        times the enclosed block as part of stage `name`
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                s = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+                s["seconds"] += elapsed
+                s["calls"] += 1
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        with self._lock:
+            key = (name, _labels(labels))
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def incr(self, name: str, amount: float = 1, **labels: Any) -> None:
+        with self._lock:
+            key = (name, _labels(labels))
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def counter(self, name: str, **labels: Any) -> float:
+        """
+        current value of a counter
+        """
+        with self._lock:
+            return self.counters.get((name, _labels(labels)), 0)
+
+    def cache(self, name: str, hit: bool, amount: int = 1) -> None:
+        """
+        records `amount` lookups against cache `name`
+        """
+        self.incr("cache_hits" if hit else "cache_misses", amount, cache=name)
+
+    def set_info(self, **info: Any) -> None:
+        with self._lock:
+            self.info.update(info)
+
+    def report(self) -> dict[str, Any]:
+        """
+        json-serializable summary of everything recorded so far
+        """
+        with self._lock:
+            caches: dict[str, dict[str, Any]] = {}
+            counters: dict[str, Any] = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                label_dict = dict(labels)
+                if name in ("cache_hits", "cache_misses"):
+                    c = caches.setdefault(label_dict["cache"], {"hits": 0, "misses": 0})
+                    c["hits" if name == "cache_hits" else "misses"] += value
+                else:
+                    key = name + "".join(f"[{v}]" for _, v in labels)
+                    counters[key] = value
+            for c in caches.values():
+                total = c["hits"] + c["misses"]
+                c["hit_rate"] = round(c["hits"] / total, 4) if total else 0.0
+
+            return {
+                "info": dict(self.info),
+                "wall_seconds": round(time.time() - self.started, 3),
+                "stages": {
+                    k: {"seconds": round(v["seconds"], 6), "calls": int(v["calls"])}
+                    for k, v in self.stages.items()
+                },
+                "latency": {
+                    name + "".join(f"[{v}]" for _, v in labels): h.to_dict()
+                    for (name, labels), h in sorted(self.histograms.items())
+                },
+                "counters": counters,
+                "caches": caches,
+            }
+
+    def to_openmetrics(self, prefix: str = "ecr") -> str:
+        """
+        renders the recorded metrics in the OpenMetrics text format
+        """
+
+        def fmt(labels: Labels, extra: Labels = ()) -> str:
+            items = labels + extra
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines: list[str] = []
+        with self._lock:
+            lines.append(f"# TYPE {prefix}_stage_seconds counter")
+            lines.append(f"# UNIT {prefix}_stage_seconds seconds")
+            for name, s in self.stages.items():
+                lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {s["seconds"]:.6f}')
+
+            names = sorted({name for name, _ in self.histograms})
+            for name in names:
+                metric = f"{prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                lines.append(f"# UNIT {metric} seconds")
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, h.buckets):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else str(bound)
+                        lines.append(f"{metric}_bucket{fmt(labels, (('le', le),))} {cumulative}")
+                    lines.append(f"{metric}_count{fmt(labels)} {h.count}")
+                    lines.append(f"{metric}_sum{fmt(labels)} {h.sum:.6f}")
+
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                metric = f"{prefix}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{metric}_total{fmt(labels)} {value:g}")
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path: str, openmetrics: bool = False) -> None:
+        """
+        writes the json run report to `path` and, if asked, the OpenMetrics text next to it (.prom)
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        if openmetrics:
+            with open(path.rsplit(".", 1)[0] + ".prom", "w") as f:
+                f.write(self.to_openmetrics())
+
+    def print_summary(self) -> None:
+        stages = self.report()["stages"]
+        total = sum(s["seconds"] for s in stages.values()) or 1.0
+        for name, s in sorted(stages.items(), key=lambda x: -x[1]["seconds"]):
+            print(
+                f"  {name:<12} {s['seconds']:>9.3f}s  {100 * s['seconds'] / total:5.1f}%  ({s['calls']} calls)"
+            )
+
+
+metrics = Metrics()
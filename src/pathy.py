@@ -1,8 +1,15 @@
+import os
 import sys
+from functools import lru_cache
 from typing import Any
 
 from lxml import etree  # type: ignore
 
+from sources import Document, locate
+
+# documents found by locate() for xml paths that are not files themselves
+_located: dict[str, Document] = {}
+
 
 def get_local_tag(tag: Any) -> str:
     """Get the local name of a tag, stripping any namespace URI."""
@@ -11,13 +18,51 @@ def get_local_tag(tag: Any) -> str:
     return tag if isinstance(tag, str) else ""
 
 
+@lru_cache(maxsize=64)
+def _parse_tree(filepath: str, mtime_ns: int, size: int) -> Any:  # etree.ElementTree
+    parser = etree.XMLParser(remove_blank_text=True)  # type: ignore # To preserve line numbers
+    return etree.parse(filepath, parser)  # type: ignore
+
+
+@lru_cache(maxsize=64)
+def _parse_document(filepath: str, stamp: tuple[Any, ...]) -> Any:  # etree.ElementTree
+    parser = etree.XMLParser(remove_blank_text=True)  # type: ignore # To preserve line numbers
+    with _located[filepath].open() as f:
+        return etree.parse(f, parser)  # type: ignore
+
+
+def load_tree(filepath: str) -> Any:  # etree.ElementTree
+    """
+    parses an xml file once and returns the same tree on later calls
+    the cache is keyed on modification time and size, so a rewritten file is parsed again
+    callers must not modify the returned tree
+
+    a path that is not a file is looked up with sources.locate, so reference documents
+    stored compressed or in tar archives are read from there
+    """
+    if not os.path.exists(filepath):
+        document = _located.get(filepath)
+        if document is None:
+            document = locate(filepath)
+            if document is None:
+                raise FileNotFoundError(f"No such file: {filepath}")
+            _located[filepath] = document
+        return _parse_document(filepath, document.stamp())
+    st = os.stat(filepath)
+    return _parse_tree(os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+
+
 def get_xml_element(filepath: str, path: str) -> Any:  # etree.Element
     """
-    parses an xml file and returns the element at the given path
+    returns the element at the given path of an xml file (parsed once, see load_tree)
+    """
+    return find_element(load_tree(filepath).getroot(), path)  # type: ignore
+
+
+def find_element(element: Any, path: str) -> Any:  # etree.Element
+    """
+    returns the element at the given path below a root element
     """
-    parser = etree.XMLParser(remove_blank_text=True)  # type: ignore # To preserve line numbers
-    tree = etree.parse(filepath, parser)  # type: ignore
-    element = tree.getroot()  # type: ignore
     path_parts = path.split(".")
     for part in path_parts:
         # skip processing comments
@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import re
+import sys
+from typing import Any, Iterator, Optional
+
+from export import RESULTS, SECTIONS, iter_records
+from records import SoftAttributes
+
+# local relevance check run before a soft attribute request: a section is sent to the LLM
+# only if it could state pregnancy, travel or occupation, i.e. its text matches a term of
+# the lexicon or its <section> code is one where these are routinely recorded. every other
+# section gets a null answer without a request
+#
+# the check is tuned for recall, a missed mention is lost while a needless request only
+# costs tokens; measure a change with `python src/prefilter.py report` before using it
+
+ATTRIBUTES = ["pregnancy", "travel", "occupation"]
+
+# case-insensitive patterns per attribute, searched anywhere in the section text
+LEXICON: dict[str, list[str]] = {
+    "pregnancy": [
+        r"pregnan",
+        r"gestation",
+        r"gravid",
+        r"\bG\d+\s*P\d+",
+        r"trimester",
+        r"pre-?natal|ante-?natal|obstetric|\bOB\b",
+        r"post-?partum|delivery|deliver(ed|s)\b",
+        r"\bLMP\b|last menstrual",
+        r"\bEDD\b|\bEDC\b|due date",
+        r"\bweeks?\s+(pregnant|gestation|ga)\b",
+    ],
+    "travel": [
+        r"travel",
+        r"\btrips?\b",
+        r"returned from|recently (in|visited|been)",
+        r"abroad|overseas|international",
+        r"out of (the )?(state|country|town)",
+        r"\bflights?\b|\bflew\b|airport|cruise",
+        r"vacation|visit(ed|ing) (family|relatives|friends)",
+        r"immigra|emigra|migrant|refugee|arrived from",
+    ],
+    "occupation": [
+        r"occupation",
+        r"employ",
+        r"\bwork(s|ed|ing|er|ers|place)?\b",
+        r"\bjobs?\b",
+        r"profession|career",
+        r"retired|retiree",
+        r"\bstudent\b|school|day ?care",
+        r"industry|factory|plant\b|farm|processor|facility worker",
+        r"\b(nurse|teacher|driver|cashier|laborer|technician)s?\b",
+    ],
+}
+
+# LOINC codes of sections that record these attributes, always sent to the LLM
+SECTION_CODES: dict[str, str] = {
+    "29762-2": "Social History",
+    "10164-2": "History of Present Illness",
+    "29299-5": "Reason for Visit",
+    "10154-3": "Chief Complaint",
+    "46239-0": "Chief Complaint and Reason for Visit",
+    "90767-5": "Pregnancy",
+    "11348-0": "History of Past Illness",
+}
+
+SKIPPED_REASONING = "Skipped by the local pre-filter: the section does not mention {}"
+
+
+class Prefilter:
+    """
+    decides which sections are worth a soft attribute request
+
+    lexicon: {attribute: [regex, ...]}, codes: section codes always sent
+    """
+
+    def __init__(self, lexicon: Optional[dict[str, list[str]]] = None, codes: Optional[list[str]] = None):
+        self.lexicon = LEXICON if lexicon is None else lexicon
+        self.codes = set(SECTION_CODES if codes is None else codes)
+        self._patterns = {
+            attribute: re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+            for attribute, patterns in self.lexicon.items()
+            if patterns
+        }
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "Prefilter":
+        """
+        the built-in lexicon and codes, or those of a json file
+        {"lexicon": {attribute: [regex, ...]}, "codes": [code, ...]}; a key left out keeps the default
+        """
+        if not path:
+            return cls()
+        with open(path, "r") as f:
+            config = json.load(f)
+        return cls(config.get("lexicon"), config.get("codes"))
+
+    @classmethod
+    def from_env(cls) -> "Prefilter":
+        """
+        the lexicon file named by PREFILTER_LEXICON, the built-in one if unset
+        """
+        return cls.load(os.getenv("PREFILTER_LEXICON"))
+
+    def mentions(self, text: str) -> list[str]:
+        """
+        attributes with a lexicon term in the text
+        """
+        return [attribute for attribute, pattern in self._patterns.items() if pattern.search(text)]
+
+    def reason(self, text: str, code: Optional[str] = None) -> Optional[str]:
+        """
+        why a section is sent to the LLM ("code" or "lexicon"), None if it is skipped
+        """
+        if code and code in self.codes:
+            return "code"
+        if self.mentions(text):
+            return "lexicon"
+        return None
+
+    def keep(self, text: str, code: Optional[str] = None) -> bool:
+        return self.reason(text, code) is not None
+
+
+def skipped_answer() -> str:
+    """
+    the null soft attribute answer given to a section the pre-filter skips
+    """
+    return SoftAttributes(
+        pregnancy_reasoning=SKIPPED_REASONING.format("pregnancy"),
+        travel_reasoning=SKIPPED_REASONING.format("travel"),
+        occupation_reasoning=SKIPPED_REASONING.format("an occupation"),
+    ).to_xml()
+
+
+def is_stated(value: Any) -> bool:
+    # labels are true/false/null flags, or the stated value itself (a city, a job)
+    if isinstance(value, str):
+        return value.strip().lower() not in ("", "false", "null", "none")
+    return bool(value)
+
+
+def labeled_sections(paths: list[str]) -> Iterator[dict[str, Any]]:
+    """
+    labeled sections {"id", "text", "code", "pregnancy", "travel", "occupation"} from
+      - out/<key>/ run directories of test.py (searched recursively): every inferred section,
+        labeled with the LLM's answer; sections skipped by the pre-filter are left out
+      - .json / .jsonl files of {"text", "code", "pregnant", "travel", "occupation"} records
+    """
+    for p in paths:
+        if os.path.isdir(p) or os.path.basename(p) == RESULTS:
+            texts = {s["section_id"]: s for s in iter_records([p], SECTIONS)}
+            seen: set[str] = set()
+            for r in iter_records([p], RESULTS):
+                fields = r.get("inference")
+                if not r.get("inferred") or r.get("prefiltered") or fields is None or r["section_id"] in seen:
+                    continue
+                seen.add(r["section_id"])
+                section = texts.get(r["section_id"])
+                if section is None:
+                    continue
+                yield {
+                    "id": f"{section['file']}#{section['path']}",
+                    "text": section["text"],
+                    "code": r.get("section_code"),
+                    "pregnancy": is_stated(fields["pregnant"]),
+                    "travel": is_stated(fields["travel"]) or bool(fields["travels"]),
+                    "occupation": is_stated(fields["employed"]) or bool(fields["job"]),
+                }
+            continue
+        with open(p, "r") as f:
+            if p.endswith(".jsonl") or p.endswith(".ndjson"):
+                items = [json.loads(line) for line in f if line.strip()]
+            else:
+                items = json.load(f)
+        for n, item in enumerate(items):
+            yield {
+                "id": item.get("id", f"{p}#{n}"),
+                "text": item["text"],
+                "code": item.get("code"),
+                "pregnancy": is_stated(item.get("pregnant", item.get("pregnancy"))),
+                "travel": is_stated(item.get("travel")),
+                "occupation": is_stated(item.get("occupation", item.get("employed"))),
+            }
+
+
+def recall_report(prefilter: Prefilter, sections: list[dict[str, Any]]) -> dict[str, Any]:
+    """
+    per attribute, how many of the labeled sections stating it the pre-filter sends to the
+    LLM (recall), the sections it would have missed, and how many requests it saves overall
+    """
+    kept_by: dict[str, int] = {"code": 0, "lexicon": 0}
+    attributes = {a: {"positives": 0, "kept": 0, "missed": []} for a in ATTRIBUTES}
+    any_positive = {"positives": 0, "kept": 0}
+    for s in sections:
+        reason = prefilter.reason(s["text"], s["code"])
+        if reason is not None:
+            kept_by[reason] += 1
+        positive = False
+        for a in ATTRIBUTES:
+            if not s[a]:
+                continue
+            positive = True
+            attributes[a]["positives"] += 1
+            if reason is not None:
+                attributes[a]["kept"] += 1
+            else:
+                attributes[a]["missed"].append({"id": s["id"], "code": s["code"], "text": s["text"][:200]})
+        if positive:
+            any_positive["positives"] += 1
+            any_positive["kept"] += reason is not None
+
+    def recall(counts: dict[str, Any]) -> Optional[float]:
+        return round(counts["kept"] / counts["positives"], 4) if counts["positives"] else None
+
+    kept = sum(kept_by.values())
+    return {
+        "sections": len(sections),
+        "kept": kept,
+        "kept_by": kept_by,
+        "skipped": len(sections) - kept,
+        "skip_rate": round((len(sections) - kept) / len(sections), 4) if sections else 0.0,
+        "any_attribute": {**any_positive, "recall": recall(any_positive)},
+        "attributes": {a: {**c, "recall": recall(c)} for a, c in attributes.items()},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="python prefilter.py report <run dirs or labeled .json/.jsonl...> [--lexicon FILE] [--min-recall R] [--output FILE]"
+    )
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("paths", nargs="+", help="out/<key>/ run directories of full test.py runs, or labeled section files")
+    parser.add_argument("--lexicon", default=os.getenv("PREFILTER_LEXICON"), help="json lexicon to evaluate (default PREFILTER_LEXICON, built-in)")
+    parser.add_argument("--min-recall", type=float, help="exit with status 1 if any attribute's recall is lower")
+    parser.add_argument("--output", help="also write the report as json")
+    args = parser.parse_args()
+
+    report = recall_report(Prefilter.load(args.lexicon), list(labeled_sections(args.paths)))
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    print(
+        f"Sections: {report['sections']}, sent to the LLM: {report['kept']} "
+        f"({report['kept_by']['code']} by section code, {report['kept_by']['lexicon']} by lexicon), "
+        f"skipped: {report['skipped']} ({report['skip_rate']:.1%})"
+    )
+    failed = False
+    for attribute, counts in report["attributes"].items():
+        recall = counts["recall"]
+        shown = "n/a" if recall is None else f"{recall:.2%}"
+        print(f"  {attribute}: recall {shown} ({counts['kept']} / {counts['positives']} sections stating it)")
+        for m in counts["missed"][:5]:
+            print(f"    missed {m['id']} (code {m['code']}): {m['text'][:100]!r}")
+        if args.min_recall is not None and recall is not None and recall < args.min_recall:
+            failed = True
+    if failed:
+        print(f"Recall below {args.min_recall}")
+        sys.exit(1)
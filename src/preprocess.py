@@ -1,14 +1,24 @@
+import gzip
+import io
 import re
 import xml.etree.ElementTree as ET
 from copy import deepcopy
+from typing import Optional, Union
 
+from sources import Document, as_document, open_documents
 
-def resolve_references(filepath: str) -> ET.ElementTree:
+# first start tag that is not a declaration, processing instruction or comment
+ROOT_TAG = re.compile(r'(<(?![?!])\w[^>]*>)')
+
+
+def resolve_references(source: Union[str, Document]) -> ET.ElementTree:
     """
     Preprocess XML file by replacing <reference> elements with actual referenced content.
-    Returns a modified ElementTree with references resolved.
+    The file may be compressed, an archive member or stdin (see sources.py); it is parsed
+    as it is decompressed. Returns a modified ElementTree with references resolved.
     """
-    tree = ET.parse(filepath)
+    with as_document(source).open() as f:
+        tree = ET.parse(f)
     root = tree.getroot()
 
     # Build ID map
@@ -52,25 +62,91 @@ def strip_namespaces(tree: ET.ElementTree):
         elem.attrib.update(new_attrib)
 
 
-def write_preprocessed_file(tree: ET.ElementTree, output_path: str, original_path: str):
-    """Write preprocessed XML preserving the original root element and self-closing tag style."""
-    content = ET.tostring(tree.getroot(), encoding="unicode")
-    # Remove any residual xmlns declarations the serializer may add
-    content = re.sub(r'\s*xmlns(?::\w+)?="[^"]*"', '', content)
+def _escape_text(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
 
-    # Restore original root element opening tag (preserves xmlns declarations)
-    with open(original_path, 'r', encoding='utf-8') as f:
-        original_text = f.read()
-    root_match = re.search(r'(<(?![?!])\w[^>]*>)', original_text)
-    if root_match:
-        original_root_tag = root_match.group(1)
-        content = re.sub(r'^<\w[^>]*>', original_root_tag, content, count=1)
+def _escape_attribute(value: str) -> str:
+    return (
+        _escape_text(value)
+        .replace('"', "&quot;")
+        .replace("\r", "&#13;")
+        .replace("\n", "&#10;")
+        .replace("\t", "&#09;")
+    )
 
-    # Remove space before /> in self-closing tags to match original format
-    content = re.sub(r' />', '/>', content)
 
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(content)
+def original_root_tag(original: Union[str, Document], chunk_size: int = 64 * 1024) -> Optional[str]:
+    """
+    Opening tag of the original document's root element (with its xmlns declarations),
+    read from the head of the document only.
+    """
+    head = ""
+    with io.TextIOWrapper(as_document(original).open(), encoding='utf-8', errors='replace') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            head += chunk
+            match = ROOT_TAG.search(head)
+            if match:
+                return match.group(1)
+            if not chunk:
+                return None
+
+
+def write_preprocessed_file(
+    tree: ET.ElementTree, output_path: str, original: Union[str, Document], compress: Optional[bool] = None
+):
+    """
+    Write preprocessed XML preserving the original root element and self-closing tag style.
+
+    Elements are serialized one at a time straight to the file, so no copy of the whole
+    document is built in memory. The output is gzip-compressed when `compress` is set or,
+    by default, when output_path ends with .gz.
+    """
+    if compress is None:
+        compress = output_path.endswith('.gz')
+    root = tree.getroot()
+    root_tag = original_root_tag(original)
+
+    opener = gzip.open if compress else open
+    with opener(output_path, 'wt', encoding='utf-8') as f:  # type: ignore
+        # (element, index of the next child) for every open element
+        stack: list[tuple[ET.Element, int]] = []
+        element: Optional[ET.Element] = root
+        while True:
+            if element is not None:
+                empty = not element.text and len(element) == 0
+                if element is root and root_tag is not None:
+                    # the original tag keeps the namespace declarations the tree no longer has
+                    f.write(root_tag)
+                    if root_tag.endswith('/>'):
+                        break
+                    empty = False
+                else:
+                    f.write('<' + str(element.tag))
+                    for key, value in element.attrib.items():
+                        f.write(f' {key}="{_escape_attribute(value)}"')
+                    f.write('/>' if empty else '>')
+                if empty:
+                    if element.tail and element is not root:
+                        f.write(_escape_text(element.tail))
+                else:
+                    if element.text:
+                        f.write(_escape_text(element.text))
+                    stack.append((element, 0))
+                element = None
+                continue
+            if not stack:
+                break
+            parent, index = stack[-1]
+            if index < len(parent):
+                stack[-1] = (parent, index + 1)
+                element = parent[index]
+                continue
+            stack.pop()
+            f.write(f'</{parent.tag}>')
+            if parent.tail and parent is not root:
+                f.write(_escape_text(parent.tail))
         f.write('\n')
 
 
@@ -83,18 +159,21 @@ def find_parent(root: ET.Element, target: ET.Element) -> ET.Element:
 
 
 if __name__ == "__main__":
+    import argparse
     import os
-    import sys
-
-    if len(sys.argv) < 2:
-        print("usage: python preprocess.py <xml_file>")
-        sys.exit(1)
 
-    file = sys.argv[1]
-    tree = resolve_references(file)
-    strip_namespaces(tree)
+    parser = argparse.ArgumentParser(usage="python preprocess.py <xml_file | archive | -> [--gzip]")
+    parser.add_argument("file", help="xml file, compressed or not, tar archive (every xml in it) or - for stdin")
+    parser.add_argument("--gzip", action="store_true", help="write out/<name>_preprocessed.xml.gz")
+    args = parser.parse_args()
 
     os.makedirs("out", exist_ok=True)
-    output_path = os.path.join("out", os.path.basename(file).replace(".xml", "_preprocessed.xml"))
-    write_preprocessed_file(tree, output_path, file)
-    print(f"Saved preprocessed file: {output_path}")
+    for document in open_documents(args.file):
+        tree = resolve_references(document)
+        strip_namespaces(tree)
+
+        output_path = os.path.join("out", f"{document.name}_preprocessed.xml")
+        if args.gzip:
+            output_path += ".gz"
+        write_preprocessed_file(tree, output_path, document)
+        print(f"Saved preprocessed file: {output_path}")
@@ -0,0 +1,56 @@
+import sys
+import threading
+import time
+from typing import Optional, TextIO
+
+
+class Progress:
+    """
+    single-line progress display: done / total, throughput and ETA
+
+    on a terminal the line is redrawn in place, otherwise a line is printed at most
+    every `interval` seconds so logs stay readable
+    """
+
+    def __init__(
+        self,
+        total: int,
+        label: str = "chunks",
+        done: int = 0,
+        interval: float = 1.0,
+        stream: Optional[TextIO] = None,
+    ):
+        self.total = total
+        self.label = label
+        self.done = done
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self._start_done = done
+        self._start = time.perf_counter()
+        self._last_print = 0.0
+        self._lock = threading.Lock()
+
+    def rate(self) -> float:
+        """
+        items completed per second in this run (resumed items excluded)
+        """
+        elapsed = time.perf_counter() - self._start
+        return (self.done - self._start_done) / elapsed if elapsed > 0 else 0.0
+
+    def line(self) -> str:
+        rate = self.rate()
+        remaining = self.total - self.done
+        eta = f"{remaining / rate:.0f}s" if rate > 0 else "?"
+        return f"{self.label} {self.done} / {self.total}, {rate:.2f} {self.label}/s, ETA {eta}"
+
+    def update(self, amount: int = 1) -> None:
+        with self._lock:
+            self.done += amount
+            now = time.perf_counter()
+            if self.done < self.total and now - self._last_print < self.interval:
+                return
+            self._last_print = now
+            tty = self.stream.isatty()
+            end = "" if tty and self.done < self.total else "\n"
+            self.stream.write(("\r" if tty else "") + self.line() + end)
+            self.stream.flush()
@@ -0,0 +1,134 @@
+from dataclasses import dataclass, field
+from typing import Any, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+from lxml import etree  # type: ignore
+
+# attribute values the prompts allow for the soft attribute flags
+FLAGS = {"true": True, "false": False, "null": None}
+
+
+def _flag(value: Optional[bool]) -> str:
+    return "null" if value is None else str(value).lower()
+
+
+def _parse_flag(element: Any, attribute: str) -> Optional[bool]:
+    value = (element.get(attribute) or "null").strip().strip('"').lower()
+    if value not in FLAGS:
+        raise ValueError(f"<{element.tag} {attribute}={value!r}> is not true, false or null")
+    return FLAGS[value]
+
+
+def _text(element: Any, tag: str) -> str:
+    child = element.find(tag)
+    return "".join(child.itertext()).strip() if child is not None else ""
+
+
+def _elements(text: str) -> Any:
+    parser = etree.XMLParser(recover=True)  # type: ignore
+    root = etree.fromstring(f"<answer>{text}</answer>".encode("utf-8"), parser)  # type: ignore
+    if root is None:
+        raise ValueError("response is not XML")
+    return root
+
+
+@dataclass
+class Travel:
+    location: str = ""
+    date: str = ""
+    reasoning: str = ""
+
+
+@dataclass
+class SoftAttributes:
+    """
+    answer to the soft attribute questions of bedrock.llm_inference
+    """
+
+    pregnant: Optional[bool] = None
+    pregnancy_reasoning: str = ""
+    travel: Optional[bool] = None
+    travel_reasoning: str = ""
+    travels: list[Travel] = field(default_factory=list)
+    employed: Optional[bool] = None
+    occupation_reasoning: str = ""
+    job: str = ""
+    # further top-level elements, e.g. fields added to the prompt, kept as XML
+    extra: list[str] = field(default_factory=list)
+
+    def to_xml(self) -> str:
+        """
+        the answer in the XML structure the prompt asks for
+        """
+        travel = "".join(
+            "<recent_travel>"
+            f"<reasoning>{escape(t.reasoning)}</reasoning>"
+            f"<location>{escape(t.location)}</location>"
+            f"<date>{escape(t.date)}</date>"
+            "</recent_travel>\n"
+            for t in self.travels
+        )
+        if self.travel_reasoning:
+            travel = f"<reasoning>{escape(self.travel_reasoning)}</reasoning>" + travel
+        return (
+            f"<pregnancy pregnant={quoteattr(_flag(self.pregnant))}>"
+            f"<reasoning>{escape(self.pregnancy_reasoning)}</reasoning></pregnancy>\n"
+            f"<travel status={quoteattr(_flag(self.travel))}>\n{travel}</travel>\n"
+            f"<occupation employed={quoteattr(_flag(self.employed))}>"
+            f"<reasoning>{escape(self.occupation_reasoning)}</reasoning><job>{escape(self.job)}</job></occupation>"
+            + "".join("\n" + x for x in self.extra)
+        )
+
+
+def parse_soft_attributes(text: str) -> SoftAttributes:
+    """
+    validates a soft attribute answer, raises ValueError if a section is missing or malformed
+    """
+    root = _elements(text)
+    pregnancy, travel, occupation = root.find("pregnancy"), root.find("travel"), root.find("occupation")
+    missing = [
+        tag for tag, el in [("pregnancy", pregnancy), ("travel", travel), ("occupation", occupation)] if el is None
+    ]
+    if missing:
+        raise ValueError(f"response has no <{'>, <'.join(missing)}>")
+    return SoftAttributes(
+        pregnant=_parse_flag(pregnancy, "pregnant"),
+        pregnancy_reasoning=_text(pregnancy, "reasoning"),
+        travel=_parse_flag(travel, "status"),
+        travel_reasoning=_text(travel, "reasoning"),
+        travels=[
+            Travel(
+                location=_text(t, "location"),
+                date=_text(t, "date"),
+                reasoning=_text(t, "reasoning"),
+            )
+            for t in travel.findall("recent_travel")
+        ],
+        employed=_parse_flag(occupation, "employed"),
+        occupation_reasoning=_text(occupation, "reasoning"),
+        job=_text(occupation, "job"),
+        extra=[
+            etree.tostring(el, encoding="unicode", with_tail=False)  # type: ignore
+            for el in root
+            if isinstance(el.tag, str) and el.tag not in ("pregnancy", "travel", "occupation")
+        ],
+    )
+
+
+def parse_category(text: str, categories: list[str]) -> str:
+    """
+    the <category> of a category answer, matched to the listed spelling of the category
+    raises ValueError if there is no <category> or it is not one of the categories
+    """
+    root = _elements(text)
+    el = root.find("category")
+    if el is None:
+        raise ValueError("response has no <category>")
+    answer = "".join(el.itertext()).strip()
+    if answer in categories:
+        return answer
+    folded = {" ".join(c.lower().split()): c for c in categories}
+    key = " ".join(answer.lower().split())
+    if key in folded:
+        return folded[key]
+    raise ValueError(f"{answer!r} is not one of the categories")
@@ -0,0 +1,207 @@
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from metrics import metrics
+
+# errors after which a request is retried on another endpoint; everything else is raised
+# (invoke_model reports "(ThrottlingException)", the response stream "(throttlingException)")
+THROTTLING_ERRORS = ("throttlingexception", "toomanyrequestsexception")
+TRANSIENT_ERRORS = (
+    "serviceunavailableexception",
+    "internalserverexception",
+    "modelnotreadyexception",
+    "modeltimeoutexception",
+)
+
+# geography prefixes of cross-region inference profile ids
+INFERENCE_PROFILE_PREFIXES = ("us", "eu", "apac", "us-gov", "global", "jp", "au", "ca")
+
+
+def error_kind(e: Exception) -> Optional[str]:
+    """
+    "throttled" or "transient" for errors worth retrying elsewhere, None otherwise
+    """
+    message = str(e).lower()
+    if any(f"({name})" in message for name in THROTTLING_ERRORS):
+        return "throttled"
+    if any(f"({name})" in message for name in TRANSIENT_ERRORS):
+        return "transient"
+    return None
+
+
+class Endpoint:
+    """
+    one place a request can be sent: a region, optionally with its own model id or
+    inference profile, and optionally an explicit client (e.g. a fake)
+
+    tracks its own health: requests in flight, a moving average of its latency, and a
+    cool-down after throttling that doubles with every consecutive throttle
+    """
+
+    def __init__(self, region: str, model_id: Optional[str] = None, client: Any = None):
+        self.region = region
+        self.model_id = model_id
+        self.client = client
+        self.name = region + (f"/{model_id}" if model_id else "")
+        self.in_flight = 0
+        self.latency = 0.0
+        self.requests = 0
+        self.throttles = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def model_for(self, default_model: str, model_id: str) -> str:
+        """
+        the model to call here: this endpoint's model replaces the default model only,
+        requests for any other model are passed through
+        """
+        return self.model_id if self.model_id and model_id == default_model else model_id
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "endpoint": self.name,
+            "requests": self.requests,
+            "throttles": self.throttles,
+            "errors": self.errors,
+            "latency_seconds": round(self.latency, 4),
+            "cooling_down_seconds": round(max(self.cooldown_until - time.monotonic(), 0.0), 2),
+        }
+
+
+class Router:
+    """
+    spreads the requests of one operation ("llm" or "embedding") over its endpoints
+
+    each request goes to the available endpoint with the least expected wait, i.e. requests
+    in flight times average latency. a throttled or transient failure cools that endpoint
+    down and the request moves to the next available one straight away; only when every
+    endpoint is cooling down does it wait, for at most `max_retries` rounds
+    """
+
+    def __init__(
+        self,
+        op: str,
+        endpoints: list[Endpoint],
+        client_for: Callable[[Endpoint], Any],
+        cooldown: float = 8.0,
+        max_cooldown: float = 60.0,
+        max_retries: int = 3,
+    ):
+        if not endpoints:
+            raise ValueError(f"no endpoints configured for {op}")
+        self.op = op
+        self.endpoints = endpoints
+        self.client_for = client_for
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> Optional[Endpoint]:
+        with self._lock:
+            now = time.monotonic()
+            available = [e for e in self.endpoints if e.available(now)]
+            if not available:
+                return None
+            # untried endpoints (latency 0) are preferred so every endpoint gets measured
+            best = min(available, key=lambda e: ((e.in_flight + 1) * e.latency, e.in_flight))
+            best.in_flight += 1
+            return best
+
+    def _release(self, endpoint: Endpoint, seconds: float, failure: Optional[str]) -> None:
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.requests += 1
+            if failure is None:
+                endpoint.latency = seconds if endpoint.latency == 0 else 0.8 * endpoint.latency + 0.2 * seconds
+                endpoint.consecutive_failures = 0
+                return
+            if failure == "throttled":
+                endpoint.throttles += 1
+            else:
+                endpoint.errors += 1
+            if failure in ("throttled", "transient"):
+                endpoint.consecutive_failures += 1
+                wait = min(self.cooldown * 2 ** (endpoint.consecutive_failures - 1), self.max_cooldown)
+                endpoint.cooldown_until = time.monotonic() + wait
+
+    def _wait_for_endpoint(self) -> None:
+        with self._lock:
+            soonest = min(e.cooldown_until for e in self.endpoints)
+        time.sleep(max(soonest - time.monotonic(), 0.0))
+
+    def call(self, fn: Callable[[Any, Endpoint], Any]) -> Any:
+        """
+        returns fn(client, endpoint) from the first endpoint that succeeds
+        raises the error of the last attempt once the retries are used up, and any error
+        that is not worth retrying straight away
+        """
+        retries = 0
+        attempts = 0
+        last_error: Optional[Exception] = None
+        failed_on: Optional[Endpoint] = None
+        while True:
+            endpoint = self._acquire() if attempts < (self.max_retries + 1) * len(self.endpoints) else None
+            if endpoint is None:
+                if retries >= self.max_retries:
+                    metrics.incr("bedrock_errors", op=self.op)
+                    raise last_error or RuntimeError(f"no {self.op} endpoint available")
+                retries += 1
+                metrics.incr("bedrock_retries", op=self.op)
+                self._wait_for_endpoint()
+                attempts = 0
+                continue
+            if failed_on is not None and endpoint is not failed_on:
+                metrics.incr("bedrock_failovers", op=self.op, endpoint=failed_on.name)
+
+            attempts += 1
+            start = time.perf_counter()
+            failure: Optional[str] = None
+            try:
+                return fn(self.client_for(endpoint), endpoint)
+            except Exception as e:
+                failure = error_kind(e) or "error"
+                if failure == "throttled":
+                    metrics.incr("bedrock_throttles", op=self.op)
+                if failure == "error":
+                    metrics.incr("bedrock_errors", op=self.op)
+                    raise
+                last_error, failed_on = e, endpoint
+            finally:
+                seconds = time.perf_counter() - start
+                self._release(endpoint, seconds, failure)
+                metrics.observe("bedrock_request", seconds, op=self.op)
+                metrics.incr("bedrock_requests", op=self.op)
+                metrics.incr("bedrock_endpoint_requests", op=self.op, endpoint=endpoint.name)
+
+    def status(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [e.status() for e in self.endpoints]
+
+
+def base_model(model_id: str) -> str:
+    """
+    the model behind a model id or cross-region inference profile ("us.amazon.titan-..." -> "amazon.titan-...")
+    """
+    prefix, _, rest = model_id.partition(".")
+    return rest if prefix in INFERENCE_PROFILE_PREFIXES and rest else model_id
+
+
+def parse_endpoints(spec: str) -> list[Endpoint]:
+    """
+    endpoints from a comma separated list of `region` or `region=model id or inference profile`
+    e.g. "us-west-2, us-east-1=us.anthropic.claude-haiku-4-5-20251001-v1:0"
+    """
+    endpoints: list[Endpoint] = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        region, _, model_id = item.partition("=")
+        endpoints.append(Endpoint(region.strip(), model_id.strip() or None))
+    return endpoints
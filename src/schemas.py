@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Any, Callable
+
+# a compiled validator returns the errors of a value, [] if it is valid
+Validator = Callable[[Any, str], list[str]]
+
+TYPES: dict[str, Callable[[Any], bool]] = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+}
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def schema_path(schema_type: str) -> str:
+    """
+    src/assets/<type>_schema.json of the repository the scripts run from,
+    falling back to the assets next to this module
+    """
+    path = os.path.join("src", "assets", f"{schema_type}_schema.json")
+    if os.path.exists(path):
+        return path
+    return os.path.join(SRC_DIR, "assets", f"{schema_type}_schema.json")
+
+
+def compile_validator(schema: Any) -> Validator:
+    """
+    turns a JSON schema into a validator function, once, so that many values can be
+    checked without walking the schema again
+
+    supports type, enum, const, properties, required, additionalProperties, items,
+    allOf/anyOf/oneOf, minimum/maximum, minLength/maxLength, pattern and
+    minItems/maxItems; other keywords (descriptions, $schema, ...) are ignored
+    """
+    if schema is True or schema == {}:
+        return lambda value, path: []
+    if schema is False:
+        return lambda value, path: [f"{path or '$'}: not allowed"]
+
+    checks: list[Validator] = []
+
+    if "type" in schema:
+        names = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        tests = [TYPES[n] for n in names if n in TYPES]
+
+        def check_type(value: Any, path: str) -> list[str]:
+            return [] if any(t(value) for t in tests) else [f"{path or '$'}: expected {' or '.join(names)}"]
+
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = [json.dumps(v, sort_keys=True) for v in schema["enum"]]
+        checks.append(
+            lambda value, path: [] if json.dumps(value, sort_keys=True) in allowed else [f"{path or '$'}: not one of the allowed values"]
+        )
+    if "const" in schema:
+        const = json.dumps(schema["const"], sort_keys=True)
+        checks.append(lambda value, path: [] if json.dumps(value, sort_keys=True) == const else [f"{path or '$'}: must be {const}"])
+
+    properties = {k: compile_validator(v) for k, v in schema.get("properties", {}).items()}
+    required = list(schema.get("required", []))
+    additional = schema.get("additionalProperties", True)
+    additional_validator = compile_validator(additional) if additional is not True else None
+    if properties or required or additional_validator is not None:
+
+        def check_object(value: Any, path: str) -> list[str]:
+            if not isinstance(value, dict):
+                return []
+            errors = [f"{path or '$'}.{k}: required" for k in required if k not in value]
+            for k, v in value.items():
+                if k in properties:
+                    errors.extend(properties[k](v, f"{path or '$'}.{k}"))
+                elif additional_validator is not None:
+                    errors.extend(
+                        [f"{path or '$'}.{k}: additional property not allowed"]
+                        if additional is False
+                        else additional_validator(v, f"{path or '$'}.{k}")
+                    )
+            return errors
+
+        checks.append(check_object)
+
+    if "items" in schema and isinstance(schema["items"], dict):
+        item_validator = compile_validator(schema["items"])
+
+        def check_items(value: Any, path: str) -> list[str]:
+            if not isinstance(value, list):
+                return []
+            errors: list[str] = []
+            for i, v in enumerate(value):
+                errors.extend(item_validator(v, f"{path}[{i}]"))
+            return errors
+
+        checks.append(check_items)
+
+    for keyword, size, compare in [
+        ("minimum", None, lambda v, b: v >= b),
+        ("maximum", None, lambda v, b: v <= b),
+        ("minLength", str, lambda v, b: len(v) >= b),
+        ("maxLength", str, lambda v, b: len(v) <= b),
+        ("minItems", list, lambda v, b: len(v) >= b),
+        ("maxItems", list, lambda v, b: len(v) <= b),
+    ]:
+        if keyword in schema:
+            bound = schema[keyword]
+            applies = TYPES["number"] if size is None else (lambda v, t=size: isinstance(v, t))
+
+            def check_bound(value: Any, path: str, k=keyword, b=bound, a=applies, c=compare) -> list[str]:
+                return [f"{path or '$'}: {k} {b}"] if a(value) and not c(value, b) else []
+
+            checks.append(check_bound)
+
+    if "pattern" in schema:
+        pattern = re.compile(schema["pattern"])
+        checks.append(
+            lambda value, path: [f"{path or '$'}: does not match {pattern.pattern}"]
+            if isinstance(value, str) and not pattern.search(value)
+            else []
+        )
+
+    for keyword in ("allOf", "anyOf", "oneOf"):
+        if keyword not in schema:
+            continue
+        subs = [compile_validator(s) for s in schema[keyword]]
+
+        def check_combination(value: Any, path: str, k=keyword, subs=subs) -> list[str]:
+            results = [s(value, path) for s in subs]
+            if k == "allOf":
+                return [e for r in results for e in r]
+            passed = sum(1 for r in results if not r)
+            if (k == "anyOf" and passed) or (k == "oneOf" and passed == 1):
+                return []
+            return [f"{path or '$'}: does not match {'any' if k == 'anyOf' else 'exactly one'} of its schemas"]
+
+        checks.append(check_combination)
+
+    def validate(value: Any, path: str = "") -> list[str]:
+        errors: list[str] = []
+        for check in checks:
+            errors.extend(check(value, path))
+        return errors
+
+    return validate
+
+
+class Schema:
+    """
+    one loaded classification schema: its categories in order, each category's schema
+    and a validator compiled on first use
+    """
+
+    def __init__(self, schema_type: str, path: str, data: bytes):
+        self.type = schema_type
+        self.path = path
+        self.version = hashlib.sha256(data).hexdigest()[:12]
+        self.document: dict[str, Any] = json.loads(data)
+        self.properties: dict[str, Any] = self.document["properties"]
+        self.categories: list[str] = list(self.properties)
+        self.index: dict[str, int] = {c: i for i, c in enumerate(self.categories)}
+        self._validators: dict[str, Validator] = {}
+        self._lock = threading.Lock()
+
+    def category(self, name: str) -> dict[str, Any]:
+        """
+        schema of a category, KeyError if the schema has no such category
+        """
+        return self.properties[name]
+
+    def validator(self, name: str) -> Validator:
+        v = self._validators.get(name)
+        if v is None:
+            with self._lock:
+                v = self._validators.setdefault(name, compile_validator(self.category(name)))
+        return v
+
+    def validate(self, name: str, value: Any) -> list[str]:
+        """
+        errors of a json value against a category's schema, [] if it is valid
+        """
+        return self.validator(name)(value, "")
+
+    def validate_many(self, items: list[tuple[str, Any]]) -> list[list[str]]:
+        """
+        validate() for many (category, value) pairs
+        """
+        return [self.validator(name)(value, "") for name, value in items]
+
+
+class SchemaRegistry:
+    """
+    process-wide cache of loaded schemas
+
+    a schema file is read once; later lookups only stat it and re-read it when its
+    size or modification time changed. the version (hash of the file) then tells
+    whether anything keyed on the schema has to be recomputed
+    """
+
+    def __init__(self) -> None:
+        self._schemas: dict[str, tuple[tuple[str, int, int], Schema]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, schema_type: str) -> Schema:
+        path = schema_path(schema_type)
+        st = os.stat(path)
+        stamp = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        cached = self._schemas.get(schema_type)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with open(path, "rb") as f:
+            data = f.read()
+        schema = Schema(schema_type, path, data)
+        with self._lock:
+            # a touched but unchanged file keeps the loaded schema and its compiled validators
+            if cached is not None and cached[1].version == schema.version:
+                schema = cached[1]
+            self._schemas[schema_type] = (stamp, schema)
+        return schema
+
+    def clear(self) -> None:
+        with self._lock:
+            self._schemas.clear()
+
+
+registry = SchemaRegistry()
+
+_compiled: dict[str, Validator] = {}
+
+
+def get_schema(schema_type: str) -> Schema:
+    return registry.get(schema_type)
+
+
+def validator_for(schema: dict[str, Any]) -> Validator:
+    """
+    compiled validator of a schema given as a dict, compiled once per distinct schema
+    """
+    key = hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+    v = _compiled.get(key)
+    if v is None:
+        v = _compiled.setdefault(key, compile_validator(schema))
+    return v
+
@@ -0,0 +1,327 @@
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import sys
+import tarfile
+from typing import IO, Any, Callable, Optional
+
+# input documents: plain, gzip/bzip2/xz/zstd compressed xml files, members of (compressed)
+# tar archives, and stdin ("-"), holding either one xml document or a tar archive
+#
+# a document is always read as a stream, decompressing as it is parsed, never extracted to
+# disk; it can be opened again, so a file may be parsed more than once. stdin can only be
+# read once and is kept in memory as it arrived (still compressed, if it was)
+#
+# every document has
+#   name   stem for the files written for it, whatever the input looked like
+#          (reports/a.xml.gz, bundle.tar:reports/a.xml and a.xml are all "a")
+#   path   where the document would be as a plain xml file: compression suffixes dropped,
+#          and tar members under a directory named after the archive (bundle/reports/a.xml)
+#          reference documents are keyed by it in embeddings/ and found again by locate()
+
+STDIN = "-"
+
+# magic bytes of the compressed formats and the suffix they are usually stored with
+COMPRESSIONS = [
+    (b"\x1f\x8b", ".gz"),
+    (b"BZh", ".bz2"),
+    (b"\xfd7zXZ\x00", ".xz"),
+    (b"\x28\xb5\x2f\xfd", ".zst"),
+]
+TAR_SUFFIXES = [".tar", ".tgz", ".tar.gz", ".tar.bz2", ".tar.xz", ".tar.zst"]
+
+
+def _open_zstd(raw: IO[bytes]) -> IO[bytes]:
+    try:
+        from compression import zstd  # type: ignore # python 3.14+
+
+        return zstd.ZstdFile(raw)  # type: ignore
+    except ImportError:
+        pass
+    try:
+        import zstandard  # type: ignore
+    except ImportError:
+        raise SystemExit("Reading .zst files needs zstandard: pip install zstandard")
+    return zstandard.ZstdDecompressor().stream_reader(raw)  # type: ignore
+
+
+class _Stream(io.RawIOBase):
+    """
+    a stream that also closes the streams it is read through
+    """
+
+    def __init__(self, stream: Any, resources: list[Any]):
+        self._stream = stream
+        self._resources = resources
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        return self._stream.readinto(b)
+
+    def close(self) -> None:
+        if not self.closed:
+            for r in [self._stream, *reversed(self._resources)]:
+                r.close()
+        super().close()
+
+
+def decompress(raw: IO[bytes]) -> IO[bytes]:
+    """
+    the decompressed content of a binary stream, recognized by its first bytes
+    a stream that is not compressed is returned as it is, buffered
+    """
+    buffered = raw if hasattr(raw, "peek") else io.BufferedReader(raw)  # type: ignore
+    head = buffered.peek(6)[:6]  # type: ignore
+    if head.startswith(b"\x1f\x8b"):
+        stream: Any = gzip.GzipFile(fileobj=buffered)
+    elif head.startswith(b"BZh"):
+        stream = bz2.BZ2File(buffered)
+    elif head.startswith(b"\xfd7zXZ\x00"):
+        stream = lzma.LZMAFile(buffered)
+    elif head.startswith(b"\x28\xb5\x2f\xfd"):
+        stream = _open_zstd(buffered)
+    else:
+        return buffered  # type: ignore
+    return io.BufferedReader(_Stream(stream, [buffered]), 1 << 16)  # type: ignore
+
+
+def strip_suffixes(path: str) -> str:
+    """
+    path without its compression and tar suffixes
+    """
+    for suffix in sorted(TAR_SUFFIXES, key=len, reverse=True):
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    for _, suffix in COMPRESSIONS:
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+def is_xml_name(name: str) -> bool:
+    return strip_suffixes(name).endswith(".xml")
+
+
+def is_tar_name(name: str) -> bool:
+    return any(name.endswith(s) for s in TAR_SUFFIXES)
+
+
+def document_path(spec: str) -> str:
+    """
+    Document.path of an input spec, without opening it (the source may be gone)
+    """
+    for i, c in enumerate(spec):
+        if c == ":" and is_tar_name(spec[:i]) and not os.path.exists(spec):
+            return os.path.join(strip_suffixes(spec[:i]), strip_suffixes(spec[i + 1 :]))
+    return strip_suffixes(spec)
+
+
+def _is_tar(stream: IO[bytes]) -> bool:
+    # a tar header has "ustar" at offset 257
+    return stream.peek(262)[257:262] == b"ustar"  # type: ignore
+
+
+class Document:
+    """
+    one xml input document, see the top of this module
+    """
+
+    def __init__(
+        self,
+        label: str,
+        name: str,
+        path: str,
+        opener: Callable[[], IO[bytes]],
+        file: Optional[str] = None,
+    ):
+        self.label = label
+        self.name = name
+        self.path = path
+        self._opener = opener
+        # file on disk the document is read from (the archive for tar members), None for stdin
+        self.file = file
+        self._digest: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f"Document({self.label!r})"
+
+    def open(self) -> IO[bytes]:
+        """
+        a new binary stream of the decompressed xml, to be closed by the caller
+        """
+        return self._opener()
+
+    @property
+    def digest(self) -> str:
+        """
+        sha256 of the decompressed xml, the same for a document however it is stored
+        """
+        if self._digest is None:
+            h = hashlib.sha256()
+            with self.open() as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def stamp(self) -> tuple[Any, ...]:
+        """
+        changes whenever the document may have changed, for caching what is read from it
+        """
+        if self.file is None:
+            return (self.label, self.digest)
+        st = os.stat(self.file)
+        return (os.path.abspath(self.file), self.label, st.st_mtime_ns, st.st_size)
+
+
+def _stem(path: str) -> str:
+    name = os.path.basename(strip_suffixes(path))
+    return name[: -len(".xml")] if name.endswith(".xml") else os.path.splitext(name)[0] or name
+
+
+def _open_member(open_archive: Callable[[], IO[bytes]], member: str) -> IO[bytes]:
+    archive = open_archive()
+    try:
+        tar = tarfile.open(fileobj=archive, mode="r|")
+        for info in tar:
+            if info.name == member:
+                f = tar.extractfile(info)
+                if f is not None:
+                    return decompress(io.BufferedReader(_Stream(f, [archive, tar]), 1 << 16))  # type: ignore
+        raise FileNotFoundError(f"{member} is not in the archive")
+    except BaseException:
+        archive.close()
+        raise
+
+
+def _members(open_archive: Callable[[], IO[bytes]], label: str, path: str, file: Optional[str]) -> list[Document]:
+    """
+    the xml documents of a tar archive, read without extracting it
+    """
+    documents: list[Document] = []
+    with open_archive() as archive:
+        with tarfile.open(fileobj=archive, mode="r|") as tar:
+            for info in tar:
+                if info.isfile() and is_xml_name(info.name):
+                    documents.append(_member(open_archive, label, path, file, info.name))
+    return documents
+
+
+def _member(open_archive: Callable[[], IO[bytes]], label: str, path: str, file: Optional[str], member: str) -> Document:
+    return Document(
+        f"{label}:{member}",
+        _stem(member),
+        os.path.join(strip_suffixes(path), strip_suffixes(member)),
+        lambda: _open_member(open_archive, member),
+        file,
+    )
+
+
+def _file_opener(path: str) -> Callable[[], IO[bytes]]:
+    return lambda: decompress(open(path, "rb"))
+
+
+def open_documents(spec: str) -> list[Document]:
+    """
+    the documents of an input: a file (compressed or not), a tar archive (every xml
+    member), "archive:member" for a single member of an archive, or "-" for stdin
+    """
+    if spec == STDIN:
+        data = sys.stdin.buffer.read()
+
+        def open_stdin() -> IO[bytes]:
+            return decompress(io.BytesIO(data))
+
+        with open_stdin() as f:
+            if _is_tar(f):
+                return _members(open_stdin, "stdin", "stdin", None)
+        digest = hashlib.sha256()
+        with open_stdin() as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        document = Document(STDIN, "stdin", f"stdin-{digest.hexdigest()[:12]}.xml", open_stdin)
+        document._digest = digest.hexdigest()
+        return [document]
+
+    if not os.path.exists(spec):
+        for i, c in enumerate(spec):
+            archive, member = spec[:i], spec[i + 1 :]
+            if c == ":" and os.path.isfile(archive):
+                return [_member(_file_opener(archive), archive, archive, archive, member)]
+        raise FileNotFoundError(f"No such file: {spec}")
+
+    opener = _file_opener(spec)
+    with opener() as f:
+        tar = is_tar_name(spec) or _is_tar(f)
+    if tar:
+        return _members(opener, spec, spec, spec)
+    return [Document(spec, _stem(spec), strip_suffixes(spec), opener, spec)]
+
+
+def open_document(spec: str) -> Document:
+    """
+    the single document of an input, exits if an archive holds several
+    """
+    documents = open_documents(spec)
+    if len(documents) != 1:
+        names = "\n  ".join(d.label for d in documents)
+        raise SystemExit(
+            f"{spec} holds {len(documents)} xml documents, pick one with <archive>:<member>:\n  {names}"
+        )
+    return documents[0]
+
+
+def as_document(source: Any) -> Document:
+    """
+    a Document given either as one or by its input spec
+    """
+    return source if isinstance(source, Document) else open_document(source)
+
+
+def locate(path: str) -> Optional[Document]:
+    """
+    the document stored for a plain xml path (Document.path): the file itself, a compressed
+    copy next to it (path + .gz, ...), or a member of an archive in one of its parent
+    directories (bundle/reports/a.xml in bundle.tar.gz); None if there is none
+    """
+    if os.path.isfile(path):
+        return Document(path, _stem(path), path, _file_opener(path), path)
+    for _, suffix in COMPRESSIONS:
+        if os.path.isfile(path + suffix):
+            return Document(path + suffix, _stem(path), path, _file_opener(path + suffix), path + suffix)
+    parts = os.path.normpath(path).split(os.sep)
+    for i in range(len(parts) - 1, 0, -1):
+        prefix = os.path.join(*parts[:i])
+        member = "/".join(parts[i:])
+        for suffix in TAR_SUFFIXES:
+            archive = prefix + suffix
+            if os.path.isfile(archive):
+                for document in _members(_file_opener(archive), archive, archive, archive):
+                    if strip_suffixes(document.label[len(archive) + 1 :]) == member:
+                        return document
+    return None
+
+
+def find_documents(paths: list[str]) -> list[str]:
+    """
+    input specs of the xml documents named directly or found under the given directories:
+    xml files (compressed or not) and the xml members of tar archives
+    """
+    specs: list[str] = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root, _, files in os.walk(p):
+                for f in sorted(files):
+                    path = os.path.join(root, f)
+                    if is_tar_name(f):
+                        specs.extend(d.label for d in open_documents(path))
+                    elif is_xml_name(f):
+                        specs.append(path)
+        else:
+            specs.extend(d.label for d in open_documents(p))
+    return specs
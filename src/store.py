@@ -0,0 +1,394 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+from typing import Any, Iterator, Optional, Sequence, Union
+
+import numpy as np
+
+# quantization schemes for the in-memory scoring matrix
+# "float32" keeps full precision, "float16" halves it, "int8" stores one byte per
+# dimension plus a float32 scale per vector
+QUANTIZATIONS = ("float32", "float16", "int8")
+
+DEFAULT_STORE = "embeddings_store"
+
+# rows converted to float32 at a time when scoring a quantized matrix
+BLOCK_ROWS = 4096
+
+
+def iter_embedding_files(base_dir: str = "embeddings") -> Iterator[tuple[str, list[dict[str, Any]]]]:
+    """
+    yields (path relative to base_dir, embeddings) for every json file under base_dir
+    """
+    for root, _, files in os.walk(base_dir):
+        for file_path in sorted(files):
+            if not file_path.endswith(".json"):
+                continue
+            full_path = os.path.join(root, file_path)
+            with open(full_path, "r") as f:
+                yield os.path.relpath(full_path, base_dir), json.load(f)
+
+
+def quantize(vectors: np.ndarray, quantization: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    quantizes unit row vectors, returns (quantized matrix, per-row scale)
+    the score of row i against a query q is scale[i] * (matrix[i] . q)
+    """
+    if quantization == "float32":
+        return vectors.astype(np.float32), np.ones(len(vectors), dtype=np.float32)
+    if quantization == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    if quantization == "int8":
+        scale = np.abs(vectors).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        q = np.rint(vectors / scale[:, None]).astype(np.int8)
+        return q, scale.astype(np.float32)
+    raise ValueError(f"unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+QDTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def _read_meta(path: str) -> list[dict[str, Any]]:
+    meta: list[dict[str, Any]] = []
+    with open(os.path.join(path, "meta.ndjson"), "r") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break  # row whose append did not finish
+            meta.append(json.loads(line))
+    return meta
+
+
+class MappedMeta(Sequence[dict[str, Any]]):
+    """
+    the meta.ndjson rows of a store, read from a read-only memory map and parsed on
+    access, so that processes sharing a store share its metadata pages too
+    """
+
+    def __init__(self, path: str):
+        self._file = open(os.path.join(path, "meta.ndjson"), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        # only complete lines count, a row whose append did not finish is ignored
+        ends = np.flatnonzero(np.frombuffer(self._map, dtype=np.uint8) == ord("\n")) if size else np.zeros(0, np.int64)
+        self._starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64) if len(ends) else ends
+        self._ends = ends
+        self.rows: np.ndarray = np.arange(len(ends))
+
+    @property
+    def physical_count(self) -> int:
+        return len(self._ends)
+
+    def select(self, row_ids: np.ndarray) -> None:
+        """
+        exposes only these physical rows, e.g. the ones not tombstoned
+        """
+        self.rows = row_ids
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: Any) -> Any:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        r = int(self.rows[i])
+        return json.loads(self._map[self._starts[r] : self._ends[r]])
+
+
+def _read_tombstones(path: str) -> set[int]:
+    p = os.path.join(path, "tombstones.json")
+    if not os.path.exists(p):
+        return set()
+    with open(p, "r") as f:
+        return set(json.load(f))
+
+
+def _write_json(path: str, data: Any) -> None:
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+class EmbeddingStore:
+    """
+    binary reference-embedding store
+
+    layout of the store directory:
+      store.json       dimensions, row count and quantization
+      meta.ndjson      one line per row: file, chunk_id, path, chunk_size, category, and in a
+                       condensed store (see condense.py) the weight: how many rows it stands for
+      vectors.f32      full precision unit vectors, float32, row-major
+      vectors.q        quantized unit vectors (dtype from the quantization)
+      scales.f32       per-row scale of the quantized vectors
+      tombstones.json  rows deleted since the last compaction
+
+    rows are only ever appended (meta.ndjson last, so a crashed append is ignored)
+    and deleted rows are tombstoned until compact() rewrites the files
+
+    only the quantized matrix is loaded into memory, the full precision vectors are
+    memory-mapped and read back just for the rows being re-ranked
+    """
+
+    def __init__(self, path: str = DEFAULT_STORE, mapped: bool = False):
+        self.path = path
+        self.mapped = mapped
+        self._load()
+
+    def _load(self) -> None:
+        path = self.path
+        with open(os.path.join(path, "store.json"), "r") as f:
+            self.info: dict[str, Any] = json.load(f)
+        self.dimensions: int = self.info["dimensions"]
+        self.quantization: str = self.info["quantization"]
+        mapped_meta = MappedMeta(path) if self.mapped else None
+        all_meta = _read_meta(path) if mapped_meta is None else None
+        count = len(all_meta) if all_meta is not None else mapped_meta.physical_count  # type: ignore
+        # physical rows in the files, deleted ones included; appends continue from here
+        self.physical_count = count
+        tombstones = _read_tombstones(path)
+        self.deleted = len(tombstones)
+        # physical row of every live row
+        self.row_ids = np.array([i for i in range(count) if i not in tombstones], dtype=np.int64)
+        self.meta: Union[list[dict[str, Any]], MappedMeta]
+        if mapped_meta is not None:
+            mapped_meta.select(self.row_ids)
+            self.meta = mapped_meta
+        else:
+            self.meta = [all_meta[i] for i in self.row_ids]  # type: ignore
+
+        qdtype = QDTYPES[self.quantization]
+        # live rows picked out of the scores of every physical row (mapped matrices are never copied)
+        self._select: Optional[np.ndarray] = None
+        if self.mapped and count:
+            self.matrix = np.memmap(
+                os.path.join(path, "vectors.q"), dtype=qdtype, mode="r", shape=(count, self.dimensions)
+            )
+            self.scales = np.memmap(os.path.join(path, "scales.f32"), dtype=np.float32, mode="r", shape=(count,))
+            self._select = self.row_ids if tombstones else None
+        else:
+            matrix = np.fromfile(
+                os.path.join(path, "vectors.q"), dtype=qdtype, count=count * self.dimensions
+            ).reshape(count, self.dimensions)
+            scales = np.fromfile(os.path.join(path, "scales.f32"), dtype=np.float32, count=count)
+            self.matrix = matrix[self.row_ids] if tombstones else matrix
+            self.scales = scales[self.row_ids] if tombstones else scales
+        self.full = np.memmap(
+            os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(count, self.dimensions)
+        ) if count else np.zeros((0, self.dimensions), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        bytes held in memory for scoring (quantized matrix + scales); with mapped=True these
+        are mapped pages shared by every process that maps the store
+        """
+        return int(self.matrix.nbytes + self.scales.nbytes)
+
+    def approximate_scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        cosine similarity of each query row against every stored row, on the quantized matrix
+        """
+        q = normalize(np.atleast_2d(queries).astype(np.float32))
+        if self.quantization == "float32":
+            s = q @ np.asarray(self.matrix).T
+        else:
+            rows = len(self.matrix)
+            s = np.empty((len(q), rows), dtype=np.float32)
+            for start in range(0, rows, BLOCK_ROWS):
+                block = self.matrix[start : start + BLOCK_ROWS].astype(np.float32)
+                s[:, start : start + BLOCK_ROWS] = (q @ block.T) * self.scales[start : start + BLOCK_ROWS]
+        return s if self._select is None else s[:, self._select]
+
+    def scores(self, queries: np.ndarray, rerank: int = 50) -> np.ndarray:
+        """
+        cosine similarity of each query against every stored row
+        scored on the quantized matrix, then the `rerank` best rows per query are
+        recomputed at full precision so the top of the ranking is exact
+        """
+        q = normalize(np.atleast_2d(queries).astype(np.float32))
+        s = self.approximate_scores(q)
+        if self.quantization == "float32" or rerank <= 0 or len(self) == 0:
+            return s
+        k = min(rerank, len(self))
+        top = np.argpartition(-s, k - 1, axis=1)[:, :k]
+        for i in range(len(q)):
+            rows = np.sort(top[i])
+            s[i, rows] = np.asarray(self.full[self.row_ids[rows]]) @ q[i]
+        return s
+
+    @staticmethod
+    def create(path: str, dimensions: int, quantization: str = "int8") -> "EmbeddingStore":
+        """
+        creates an empty store, replacing any store already at path
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+        os.makedirs(path, exist_ok=True)
+        for name in ["vectors.f32", "vectors.q", "scales.f32", "meta.ndjson"]:
+            open(os.path.join(path, name), "wb").close()
+        if os.path.exists(os.path.join(path, "tombstones.json")):
+            os.remove(os.path.join(path, "tombstones.json"))
+        _write_json(
+            os.path.join(path, "store.json"),
+            {"dimensions": dimensions, "count": 0, "quantization": quantization},
+        )
+        return EmbeddingStore(path)
+
+    def append(self, rel_path: str, embeddings: list[dict[str, Any]], reload: bool = True) -> list[int]:
+        """
+        appends the embeddings of one reference file, returns their physical row numbers
+        the store object is reloaded afterwards; appending many files, pass reload=False and
+        call reload() once after the last one (until then the object does not show the new rows)
+        """
+        if not embeddings:
+            return []
+        vectors = np.asarray([e["embedding"] for e in embeddings], dtype=np.float32)
+        if vectors.shape[1] != self.dimensions:
+            raise ValueError(
+                f"{rel_path}: embeddings have {vectors.shape[1]} dimensions, store has {self.dimensions}"
+            )
+        full = normalize(vectors)
+        q, scales = quantize(full, self.quantization)
+        start = self.physical_count
+        # drop bytes left by an append that crashed before its meta rows were written
+        for name, itemsize, width in [
+            ("vectors.f32", 4, self.dimensions),
+            ("vectors.q", np.dtype(QDTYPES[self.quantization]).itemsize, self.dimensions),
+            ("scales.f32", 4, 1),
+        ]:
+            with open(os.path.join(self.path, name), "ab") as f:
+                f.truncate(start * itemsize * width)
+        with open(os.path.join(self.path, "vectors.f32"), "ab") as f:
+            full.tofile(f)
+        with open(os.path.join(self.path, "vectors.q"), "ab") as f:
+            q.tofile(f)
+        with open(os.path.join(self.path, "scales.f32"), "ab") as f:
+            scales.tofile(f)
+        with open(os.path.join(self.path, "meta.ndjson"), "a") as f:
+            for e in embeddings:
+                f.write(
+                    json.dumps(
+                        {
+                            "file": rel_path,
+                            "chunk_id": e["chunk_id"],
+                            "path": e["path"],
+                            "chunk_size": e["chunk_size"],
+                            "category": e["category"],
+                            **({"weight": e["weight"]} if "weight" in e else {}),
+                        }
+                    )
+                    + "\n"
+                )
+        self.physical_count = start + len(embeddings)
+        if reload:
+            self.reload()
+        return list(range(start, start + len(embeddings)))
+
+    def delete(self, rel_path: str) -> int:
+        """
+        tombstones every live row of a reference file, returns how many were deleted
+        """
+        rows = [int(r) for r, m in zip(self.row_ids, self.meta) if m["file"] == rel_path]
+        if rows:
+            tombstones = _read_tombstones(self.path) | set(rows)
+            _write_json(os.path.join(self.path, "tombstones.json"), sorted(tombstones))
+            self.reload()
+        return len(rows)
+
+    def compact(self) -> int:
+        """
+        rewrites the store without tombstoned rows, returns how many rows were dropped
+        """
+        dropped = self.deleted
+        if not dropped:
+            return 0
+        full = np.asarray(self.full[self.row_ids])
+        live = self._select if self._select is not None else slice(None)
+        for name, data in [("vectors.f32", full), ("vectors.q", self.matrix[live]), ("scales.f32", self.scales[live])]:
+            np.asarray(data).tofile(os.path.join(self.path, name + ".tmp"))
+        with open(os.path.join(self.path, "meta.ndjson.tmp"), "w") as f:
+            for m in self.meta:
+                f.write(json.dumps(m) + "\n")
+        del self.full, self.matrix, self.scales, self.meta
+        for name in ["vectors.f32", "vectors.q", "scales.f32", "meta.ndjson"]:
+            os.replace(os.path.join(self.path, name + ".tmp"), os.path.join(self.path, name))
+        os.remove(os.path.join(self.path, "tombstones.json"))
+        self.reload()
+        return dropped
+
+    def reload(self) -> None:
+        """
+        re-reads the store after a change and records the live row count in store.json
+        """
+        self._load()
+        self.info["count"] = len(self)
+        _write_json(os.path.join(self.path, "store.json"), self.info)
+
+    @staticmethod
+    def build(
+        path: str = DEFAULT_STORE,
+        base_dir: str = "embeddings",
+        quantization: str = "int8",
+    ) -> "EmbeddingStore":
+        """
+        (re)builds a store from the json embedding files under base_dir
+        """
+        store: Optional[EmbeddingStore] = None
+        for rel_path, embeddings in iter_embedding_files(base_dir):
+            if not embeddings:
+                continue
+            if store is None:
+                store = EmbeddingStore.create(path, len(embeddings[0]["embedding"]), quantization)
+            # written file by file, read back once at the end
+            store.append(rel_path, embeddings, reload=False)
+        if store is None:
+            store = EmbeddingStore.create(path, 0, quantization)
+        store.reload()
+        return store
+
+
+def store_signature(path: str) -> str:
+    """
+    first 12 hex chars of a hash of the size and modification time of a store's files,
+    which changes whenever rows are appended, deleted or compacted, or the store is rebuilt
+    """
+    h = hashlib.sha256()
+    for name in ["store.json", "meta.ndjson", "tombstones.json"]:
+        f = os.path.join(path, name)
+        if os.path.exists(f):
+            st = os.stat(f)
+            h.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()[:12]
+
+
+def open_store(path: Optional[str], mapped: bool = False) -> Optional[EmbeddingStore]:
+    return EmbeddingStore(path, mapped) if path else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python store.py {build,info} [--store DIR] [--quantization int8]")
+    parser.add_argument("command", choices=["build", "info"])
+    parser.add_argument("--store", default=DEFAULT_STORE)
+    parser.add_argument("--embeddings", default="embeddings", help="directory of json embedding files")
+    parser.add_argument("--quantization", default="int8", choices=QUANTIZATIONS)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        store = EmbeddingStore.build(args.store, args.embeddings, args.quantization)
+    else:
+        store = EmbeddingStore(args.store)
+    full_bytes = len(store) * store.dimensions * 4
+    print(f"store: {store.path}")
+    print(f"rows: {len(store)} ({store.deleted} deleted awaiting compaction), dimensions: {store.dimensions}, quantization: {store.quantization}")
+    print(f"in-memory scoring matrix: {store.nbytes / 2**20:.2f} MB (float32 would be {full_bytes / 2**20:.2f} MB)")
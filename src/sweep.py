@@ -0,0 +1,451 @@
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import os
+import re
+import time
+from typing import Any, Callable, Optional
+
+import bedrock
+from bench.fake_bedrock import FakeBedrockClient
+from bench.replay import RecordingClient, ReplayClient
+from bench.synth import SIZES, generate_eicr
+from bench.workspace import Workspace, run_script
+from export import RESULTS, inference_fields, iter_records
+from metrics import metrics
+from prefilter import is_stated
+from sources import find_documents, open_document
+from writer import NdjsonJournal
+
+# accuracy against throughput over a grid of pipeline settings
+#
+# every combination of the --vary values runs test.py or tag.py (with --fresh) over a
+# labeled document set and is measured: wall time, Bedrock requests, tokens, dollars, and
+# how many chunk categories and section soft attributes match the labels. the documents
+# are synthetic eICRs labeled by their generator, answered by the offline FakeBedrockClient,
+# or labeled local documents answered by Bedrock, optionally recorded to a cassette once
+# and replayed from it afterwards (see bench/replay.py)
+#
+# the configurations no other one beats on time and every accuracy at once are marked as
+# the frontier
+
+BOTH = ("test.py", "tag.py")
+
+
+def _on(value: str) -> bool:
+    return value.lower() in ("on", "true", "yes", "1")
+
+
+# knob -> (scripts that have it, script options for a value); the reference store knobs
+# "store" (json, or a store.py quantization) and "condense" (condense.py ratio, 0 for none)
+# need their stores built first and are turned into options by Stores
+KNOBS: dict[str, tuple[tuple[str, ...], Callable[[str], list[str]]]] = {
+    "max_chunk_size": (BOTH, lambda v: ["--max-chunk-size", v]),
+    "dedupe": (BOTH, lambda v: ["--dedupe", v]),
+    "prefilter": (BOTH, lambda v: ["--prefilter"] if _on(v) else []),
+    "concurrency": (("tag.py",), lambda v: ["--concurrency", v]),
+    "pack_chars": (("test.py",), lambda v: ["--pack-chars", v]),
+    "code_index": (("test.py",), lambda v: [] if _on(v) else ["--no-code-index"]),
+    "min_support": (("test.py",), lambda v: ["--min-support", v]),
+    "min_consistency": (("test.py",), lambda v: ["--min-consistency", v]),
+    "rerank": (("test.py",), lambda v: ["--rerank", v]),
+    "store": (("test.py",), lambda v: []),
+    "condense": (("test.py",), lambda v: []),
+}
+
+DEFAULT_GRID = {
+    "test.py": ["max_chunk_size=1000,6000", "code_index=on,off", "prefilter=off,on"],
+    "tag.py": ["concurrency=1,4", "prefilter=off,on"],
+}
+
+# soft attributes compared with the labels: label key and whether an answer states it
+ATTRIBUTES: list[tuple[str, Callable[[dict[str, Any]], bool]]] = [
+    ("pregnant", lambda f: f["pregnant"] is True),
+    ("travel", lambda f: f["travel"] is True or bool(f["travels"])),
+    ("occupation", lambda f: f["employed"] is True or bool(f["job"])),
+]
+
+ACCURACIES = ["category_accuracy", "attribute_accuracy", "attribute_recall"]
+
+
+def parse_grid(specs: list[str], script: str) -> dict[str, list[str]]:
+    """
+    {knob: [values]} from "knob=value,value" specs, in the order given
+    """
+    grid: dict[str, list[str]] = {}
+    for spec in specs:
+        knob, sep, values = spec.partition("=")
+        knob = knob.strip().replace("-", "_")
+        if not sep or not values:
+            raise ValueError(f"expected knob=value[,value...], got {spec!r}")
+        if knob not in KNOBS:
+            raise ValueError(f"unknown knob {knob!r}, expected one of {sorted(KNOBS)}")
+        if script not in KNOBS[knob][0]:
+            raise ValueError(f"{script} has no {knob} setting")
+        grid[knob] = [v.strip() for v in values.split(",") if v.strip()]
+    return grid
+
+
+def configurations(grid: dict[str, list[str]]) -> list[dict[str, str]]:
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def _value(v: str) -> Any:
+    for kind in (int, float):
+        try:
+            return kind(v)
+        except ValueError:
+            pass
+    return v
+
+
+class Stores:
+    """
+    binary stores of the reference embeddings, built under `directory` the first time a
+    configuration asks for them
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.built: set[str] = set()
+
+    def _build(self, script: str, path: str, options: list[str]) -> None:
+        if path not in self.built:
+            print(f"Building {path}...")
+            run_script(script, options)
+            self.built.add(path)
+
+    def options(self, store: str, condense: float) -> list[str]:
+        if store == "json" and not condense:
+            return []
+        # condensing needs a store to start from
+        quantization = "float32" if store == "json" else store
+        path = os.path.join(self.directory, quantization)
+        self._build("store.py", path, ["build", "--store", path, "--quantization", quantization])
+        if condense:
+            source, path = path, f"{path}-condensed-{condense:g}"
+            self._build(
+                "condense.py",
+                path,
+                ["--store", source, "--output", path, "--ratio", str(condense), "--queries", "--report", path + ".json"],
+            )
+        return ["--store", path]
+
+
+def script_options(config: dict[str, str], stores: Stores) -> list[str]:
+    options: list[str] = []
+    for knob, value in config.items():
+        options.extend(KNOBS[knob][1](value))
+    if "store" in config or "condense" in config:
+        options.extend(stores.options(config.get("store", "json"), float(config.get("condense", 0))))
+    return options
+
+
+def predictions(script: str, scope: dict[str, Any]) -> tuple[list[tuple[str, str]], dict[str, dict[str, bool]]]:
+    """
+    what a run answered: (section path, category) of every categorized chunk and
+    {section path: {attribute: stated}} of every inferred section (a section whose chunks
+    were inferred one by one states what any of them states)
+    """
+    chunks = scope["unique_chunks"]
+    run = scope["run"]
+    categories: list[tuple[str, str]] = []
+    sections: dict[str, dict[str, bool]] = {}
+
+    def add(section_path: str, fields: Optional[dict[str, Any]]) -> None:
+        flags = sections.setdefault(section_path, {a: False for a, _ in ATTRIBUTES})
+        for attribute, states in ATTRIBUTES:
+            flags[attribute] = flags[attribute] or (fields is not None and states(fields))
+
+    if script == "test.py":
+        for r in iter_records([run.out], RESULTS):
+            section_path = chunks[r["index"]]["section_path"]
+            categories.append((section_path, r["category"]))
+            if r["inferred"]:
+                add(section_path, r["inference"])
+    else:
+        for r in NdjsonJournal.read(run.out_path("xml_tagging_inference.xml") + ".ndjson"):
+            chunk = chunks[r["index"]]
+            if chunk["is_table"]:
+                continue
+            answer = re.search(r"<inference>\s*(.*?)\s*</inference>", r["xml"], re.S)
+            add(chunk["section_path"], inference_fields(answer.group(1)) if answer else None)
+    return categories, sections
+
+
+def score(script: str, scope: dict[str, Any], labels: dict[str, dict[str, Any]], counts: dict[str, int]) -> None:
+    """
+    adds a run's matches with the labels of its document to counts
+    """
+    categories, sections = predictions(script, scope)
+    for section_path, category in categories:
+        label = labels.get(section_path)
+        if label is None or not label.get("category"):
+            continue
+        counts["categorized"] += 1
+        counts["category_correct"] += category == label["category"]
+    for section_path, flags in sections.items():
+        label = labels.get(section_path)
+        if label is None:
+            continue
+        for attribute, _ in ATTRIBUTES:
+            stated = is_stated(label.get(attribute))
+            counts["attributes"] += 1
+            counts["attribute_correct"] += flags[attribute] == stated
+            counts["positives"] += stated
+            counts["found"] += stated and flags[attribute]
+
+
+def _ratio(a: int, b: int) -> Optional[float]:
+    return round(a / b, 4) if b else None
+
+
+def run_config(
+    script: str, documents: list[str], labels: dict[str, dict[str, dict[str, Any]]], options: list[str], repeat: int, log_prefix: str
+) -> dict[str, Any]:
+    """
+    runs every document under one configuration `repeat` times; the best total time is kept,
+    the requests, tokens and accuracy are those of the last repetition
+    """
+    times: list[float] = []
+    for _ in range(repeat):
+        metrics.reset()
+        counts = {k: 0 for k in ["categorized", "category_correct", "attributes", "attribute_correct", "positives", "found"]}
+        seconds = 0.0
+        chunks = 0
+        status = "ok"
+        for n, doc in enumerate(documents):
+            log_path = f"{log_prefix}-{n:03d}.log"
+            start = time.perf_counter()
+            try:
+                with open(log_path, "w") as log, contextlib.redirect_stdout(log):
+                    scope = run_script(script, [doc, "--fresh"] + options, quiet=False)
+            except SystemExit as e:
+                status = f"{doc}: exited with {e.code}, see {log_path}"
+                break
+            except Exception as e:
+                status = f"{doc}: failed: {e!r}, see {log_path}"
+                break
+            seconds += time.perf_counter() - start
+            chunks += len(scope["unique_chunks"])
+            score(script, scope, labels.get(doc, {}), counts)
+        if status != "ok":
+            return {"status": status}
+        times.append(seconds)
+
+    c = metrics.report()["counters"]
+    best = min(times)
+    return {
+        "status": "ok",
+        "documents": len(documents),
+        "chunks": chunks,
+        "seconds": round(best, 4),
+        "docs_per_second": round(len(documents) / best, 3) if best > 0 else 0.0,
+        "llm_requests": c.get("bedrock_requests[llm]", 0),
+        "embedding_requests": c.get("bedrock_requests[embedding]", 0),
+        "input_tokens": c.get("llm_tokens[input]", 0),
+        "output_tokens": c.get("llm_tokens[output]", 0),
+        "cache_read_tokens": c.get("llm_cache_tokens[read]", 0),
+        "cache_write_tokens": c.get("llm_cache_tokens[write]", 0),
+        "dollars": round(c.get("llm_dollars", 0.0), 6),
+        "category_accuracy": _ratio(counts["category_correct"], counts["categorized"]),
+        "attribute_accuracy": _ratio(counts["attribute_correct"], counts["attributes"]),
+        "attribute_recall": _ratio(counts["found"], counts["positives"]),
+        "labeled": {"chunks": counts["categorized"], "attributes": counts["attributes"], "positives": counts["positives"]},
+    }
+
+
+def mark_frontier(results: list[dict[str, Any]]) -> None:
+    """
+    sets "frontier" on every completed result no other one matches or beats on time and
+    on every accuracy, while beating it on at least one
+    """
+    done = [r for r in results if r["status"] == "ok"]
+
+    def better_or_equal(a: dict[str, Any], b: dict[str, Any]) -> bool:
+        return a["seconds"] <= b["seconds"] and all(
+            a[k] is None or b[k] is None or a[k] >= b[k] for k in ACCURACIES
+        )
+
+    def strictly_better(a: dict[str, Any], b: dict[str, Any]) -> bool:
+        return a["seconds"] < b["seconds"] or any(
+            a[k] is not None and b[k] is not None and a[k] > b[k] for k in ACCURACIES
+        )
+
+    for r in results:
+        r["frontier"] = r["status"] == "ok" and not any(
+            o is not r and better_or_equal(o, r) and strictly_better(o, r) for o in done
+        )
+
+
+def synthetic_documents(ws: Workspace, count: int, size: str, attribute_rate: float, seed: int) -> tuple[list[str], dict[str, Any]]:
+    """
+    generated documents and their labels {document: {section path: label}}
+    """
+    documents: list[str] = []
+    labels: dict[str, dict[str, dict[str, Any]]] = {}
+    for i in range(count):
+        xml, sections = generate_eicr(**SIZES[size], attribute_rate=attribute_rate, seed=seed + i)
+        path = ws.add_document(f"doc{i}.xml", xml)
+        documents.append(path)
+        labels[path] = {f"root.component.structuredBody.{s['index']}": s for s in sections}
+    return documents, labels
+
+
+def load_labels(path: str, documents: list[str]) -> dict[str, dict[str, dict[str, Any]]]:
+    """
+    labels of local documents from a json file {document: [{"section_path", "category",
+    "pregnant", "travel", "occupation"}, ...]}, a document named by its input, path or name
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    labels: dict[str, dict[str, dict[str, Any]]] = {}
+    for spec in documents:
+        document = open_document(spec)
+        sections = next((data[k] for k in (spec, document.path, document.name) if k in data), [])
+        labels[spec] = {s["section_path"]: s for s in sections}
+    return labels
+
+
+def print_table(results: list[dict[str, Any]]) -> None:
+    def shown(v: Optional[float]) -> str:
+        return "n/a" if v is None else f"{v:.1%}"
+
+    configs = [" ".join(f"{k}={v}" for k, v in r["config"].items()) or "(defaults)" for r in results]
+    width = max([len("configuration")] + [len(c) for c in configs])
+    print(
+        f"{'':<2}{'configuration':<{width}} {'seconds':>8} {'docs/s':>7} {'LLM':>5} {'emb':>5} "
+        f"{'in tok':>8} {'out tok':>8} {'dollars':>8} {'category':>9} {'attr acc':>9} {'recall':>7}"
+    )
+    print("-" * (width + 86))
+    for r, config in zip(results, configs):
+        if r["status"] != "ok":
+            print(f"  {config:<{width}} {r['status']}")
+            continue
+        print(
+            f"{'*' if r['frontier'] else '':<2}{config:<{width}} {r['seconds']:>8.3f} {r['docs_per_second']:>7.2f} "
+            f"{r['llm_requests']:>5} {r['embedding_requests']:>5} {r['input_tokens']:>8} {r['output_tokens']:>8} "
+            f"{r['dollars']:>8.4f} {shown(r['category_accuracy']):>9} {shown(r['attribute_accuracy']):>9} "
+            f"{shown(r['attribute_recall']):>7}"
+        )
+    print("* frontier: no other configuration is as fast and as accurate on every measure")
+
+
+def write_csv(results: list[dict[str, Any]], path: str) -> None:
+    knobs = list(dict.fromkeys(k for r in results for k in r["config"]))
+    columns = [
+        "status", "documents", "chunks", "seconds", "docs_per_second", "llm_requests", "embedding_requests",
+        "input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens", "dollars",
+    ] + ACCURACIES + ["frontier"]
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(knobs + columns)
+        for r in results:
+            w.writerow([r["config"].get(k, "") for k in knobs] + [r.get(c, "") for c in columns])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="python sweep.py [--script test|tag] [--vary knob=v1,v2 ...] [--documents N] [--size S] "
+        "[--docs PATH ... --labels FILE] [--record FILE | --replay FILE] [--repeat N] [--report FILE] [--csv FILE]"
+    )
+    parser.add_argument("--script", choices=["test", "tag"], default="test")
+    parser.add_argument(
+        "--vary",
+        action="append",
+        default=[],
+        metavar="KNOB=V1,V2",
+        help=f"values of a setting to try, every combination runs; knobs: {', '.join(KNOBS)}",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="runs per configuration, the best time is kept")
+    synthetic = parser.add_argument_group("synthetic documents (default)")
+    synthetic.add_argument("--documents", type=int, default=3, help="generated documents to classify")
+    synthetic.add_argument("--size", choices=list(SIZES), default="small")
+    synthetic.add_argument("--corpus", type=int, default=3, help="generated reference documents")
+    synthetic.add_argument("--attribute-rate", type=float, default=0.3, help="share of text sections stating soft attributes")
+    synthetic.add_argument("--seed", type=int, default=0)
+    synthetic.add_argument("--llm-latency", type=float, default=0.0, help="injected seconds per fake LLM call")
+    synthetic.add_argument("--embedding-latency", type=float, default=0.0, help="injected seconds per fake embedding call")
+    synthetic.add_argument("--token-latency", type=float, default=0.0, help="injected seconds per fake generated token")
+    local = parser.add_argument_group("labeled local documents, run in the current directory against embeddings/")
+    local.add_argument("--docs", nargs="+", help="xml files (compressed or not), tar archives or directories")
+    local.add_argument("--labels", help="json of {document: [{section_path, category, pregnant, travel, occupation}]}")
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument("--record", help="send requests to Bedrock and record them to this cassette")
+    backend.add_argument("--replay", help="answer requests from this cassette instead of Bedrock")
+    parser.add_argument("--replay-latency", action="store_true", help="with --replay, take as long as the recorded requests")
+    parser.add_argument("--report", default="out/sweep_report.json")
+    parser.add_argument("--csv", help="also write the results as csv")
+    parser.add_argument("--log-dir", default="out/sweep", help="output of every run")
+    args = parser.parse_args()
+
+    script = f"{args.script}.py"
+    try:
+        grid = parse_grid(args.vary or DEFAULT_GRID[script], script)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.docs and not args.labels:
+        parser.error("--docs needs --labels")
+    # the workspace of synthetic documents is a temporary directory, so paths are resolved first
+    report_path = os.path.abspath(args.report)
+    csv_path = os.path.abspath(args.csv) if args.csv else None
+    log_dir = os.path.abspath(args.log_dir)
+    os.makedirs(log_dir, exist_ok=True)
+
+    # connection pools are sized before the client is installed, resizing drops the clients
+    bedrock.configure(max([int(v) for v in grid.get("concurrency", ["1"])]))
+    client: Any = None
+    if args.replay:
+        client = ReplayClient(os.path.abspath(args.replay), latency=args.replay_latency)
+    elif args.record:
+        client = RecordingClient(bedrock.get_client("bedrock-runtime"), os.path.abspath(args.record))
+    elif not args.docs:
+        client = FakeBedrockClient(
+            llm_latency=args.llm_latency, embedding_latency=args.embedding_latency, token_latency=args.token_latency
+        )
+    backend_name = "replay" if args.replay else "bedrock (recorded)" if args.record else "bedrock" if client is None else "fake"
+
+    with contextlib.ExitStack() as stack:
+        if args.docs:
+            documents = find_documents(args.docs)
+            labels = load_labels(args.labels, documents)
+            if client is not None:
+                bedrock.set_client("bedrock-runtime", client)
+        else:
+            ws = stack.enter_context(Workspace(client))
+            print(f"Building reference corpus of {args.corpus} documents...")
+            ws.build_corpus(args.corpus, **SIZES["small"])
+            documents, labels = synthetic_documents(ws, args.documents, args.size, args.attribute_rate, args.seed)
+        stores = Stores(os.path.join("out", "sweep_stores"))
+
+        results: list[dict[str, Any]] = []
+        configs = configurations(grid)
+        for n, config in enumerate(configs):
+            shown = " ".join(f"{k}={v}" for k, v in config.items()) or "(defaults)"
+            print(f"[{n + 1}/{len(configs)}] {script} {shown}")
+            options = script_options(config, stores)
+            result = run_config(script, documents, labels, options, args.repeat, os.path.join(log_dir, f"{n + 1:03d}"))
+            results.append({"config": {k: _value(v) for k, v in config.items()}, "options": options, **result})
+
+    mark_frontier(results)
+    report = {
+        "script": script,
+        "backend": backend_name,
+        "documents": "synthetic" if not args.docs else args.docs,
+        "grid": grid,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if client is not None:
+        report["backend_calls"] = dict(client.calls)
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    if csv_path:
+        write_csv(results, csv_path)
+
+    print_table(results)
+    print(f"Report: {report_path}" + (f", {csv_path}" if csv_path else ""))
+    print(f"Run output: {log_dir}")
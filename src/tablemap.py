@@ -0,0 +1,301 @@
+import argparse
+import copy
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Optional
+
+from metrics import metrics
+
+DEFAULT_MAPPINGS = "table_mappings.json"
+
+# a table layout is mapped locally once the LLM has transformed it this way
+# mapping format, keyed by schema hash + header signature:
+#   header    the column headers the layout was learned from
+#   path      keys leading from the top of the json to the list of row objects ([] = the json is the list)
+#   template  the json around that list (null at the list's place), copied for every table
+#   fields    per row object field: [key path, column index, "string" or "number", value of an empty cell]
+#             or [key path, null, "const", value] for a value that is the same in every row of a
+#             table with at least two rows and is not a rewrite of any cell
+#   hits      tables transformed with it; save() adds the hits of this process to the stored ones,
+#             so processes sharing the file do not overwrite each other's counts
+
+
+def parse_table(data: str) -> tuple[list[str], list[list[str]]]:
+    """
+    (header, rows) of tab separated table text, the first line being the header
+    """
+    lines = [line for line in data.split("\n") if line.strip()]
+    if not lines:
+        return [], []
+    header = lines[0].split("\t")
+    rows: list[list[str]] = []
+    for line in lines[1:]:
+        cells = line.split("\t")
+        rows.append(cells + [""] * (len(header) - len(cells)))
+    return header, rows
+
+
+def header_signature(header: list[str]) -> str:
+    return "|".join(" ".join(h.lower().split()) for h in header)
+
+
+def schema_hash(schema: dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def _key(schema: dict[str, Any], header: list[str]) -> str:
+    return f"{schema_hash(schema)}:{header_signature(header)}"
+
+
+def _find_rows(value: Any, count: int, path: list[Any]) -> Optional[list[Any]]:
+    """
+    path to the first list of `count` objects in value, depth first
+    """
+    if isinstance(value, list) and len(value) == count and value and all(isinstance(v, dict) for v in value):
+        return path
+    children = value.items() if isinstance(value, dict) else enumerate(value) if isinstance(value, list) else []
+    for k, v in children:
+        found = _find_rows(v, count, path + [k])
+        if found is not None:
+            return found
+    return None
+
+
+def _leaves(value: dict[str, Any], prefix: tuple[str, ...] = ()) -> list[tuple[tuple[str, ...], Any]]:
+    leaves: list[tuple[tuple[str, ...], Any]] = []
+    for k, v in value.items():
+        if isinstance(v, dict):
+            leaves.extend(_leaves(v, prefix + (k,)))
+        else:
+            leaves.append((prefix + (k,), v))
+    return leaves
+
+
+def _get(value: Any, path: list[Any]) -> Any:
+    for k in path:
+        value = value[k]
+    return value
+
+
+def _set(value: Any, path: list[Any], item: Any) -> Any:
+    if not path:
+        return item
+    _get(value, path[:-1])[path[-1]] = item
+    return value
+
+
+def _number(text: str) -> Optional[float]:
+    try:
+        return float(text.replace(",", ""))
+    except ValueError:
+        return None
+
+
+def _matches(cell: str, value: Any, kind: str, empty: Any) -> bool:
+    cell = cell.strip()
+    if cell == "":
+        return value == empty
+    if kind == "number":
+        return not isinstance(value, bool) and _number(cell) == value
+    return isinstance(value, str) and value.strip() == cell
+
+
+def _resembles(value: Any, cell: str) -> bool:
+    """
+    whether value could be cell rewritten by the LLM: the same letters and digits ignoring
+    case and punctuation ("Positive" / "positive"), or the same digits reordered ("01/05/2024" / "2024-01-05")
+    """
+    text = json.dumps(value) if not isinstance(value, str) else value
+    a = "".join(ch for ch in text.lower() if ch.isalnum())
+    b = "".join(ch for ch in cell.lower() if ch.isalnum())
+    if not a or not b:
+        return False
+    digits = sorted(ch for ch in a if ch.isdigit())
+    return a == b or (bool(digits) and digits == sorted(ch for ch in b if ch.isdigit()))
+
+
+def _field(values: list[Any], rows: list[list[str]]) -> Optional[tuple[Optional[int], str, Any]]:
+    """
+    (column, kind, empty cell value) reproducing values from the rows, or (None, "const", value)
+
+    a value that matches no column is only taken as a constant when at least two rows agree
+    on it and it does not resemble a cell; otherwise it is a cell the LLM rewrote, and
+    copying it to every later table would make up values, so there is no field
+    """
+    numeric = any(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values)
+    kind = "number" if numeric else "string"
+    for column in range(max(len(r) for r in rows)):
+        cells = [r[column] if column < len(r) else "" for r in rows]
+        empties = [v for v, c in zip(values, cells) if c.strip() == ""]
+        empty = empties[0] if empties else ""
+        if all(_matches(c, v, kind, empty) for c, v in zip(cells, values)):
+            return column, kind, empty
+    if (
+        len(values) >= 2
+        and all(json.dumps(v) == json.dumps(values[0]) for v in values)
+        and not any(_resembles(values[0], c) for r in rows for c in r)
+    ):
+        return None, "const", values[0]
+    return None
+
+
+class TableMapper:
+    """
+    deterministic transform of known table layouts, learned from LLM transforms
+
+    a layout is recognized by the schema it is mapped into and its column headers. when
+    the LLM's json for a table is a list of row objects (possibly inside a fixed wrapper)
+    whose values are the table's cells, the column behind every field is recorded, and
+    the next table with the same headers is transformed without the LLM
+    """
+
+    def __init__(self, path: str = DEFAULT_MAPPINGS):
+        self.path = path
+        self._lock = threading.Lock()
+        self.mappings: dict[str, dict[str, Any]] = _read(path)
+        # hits per layout since the last save
+        self.unsaved_hits: dict[str, int] = {}
+
+    def save(self) -> None:
+        """
+        writes the mappings, with the hits counted since the last save added to the stored counts
+        and the layouts other processes stored since this one loaded them kept
+        """
+        with self._lock:
+            stored = _read(self.path)
+            for key, n in self.unsaved_hits.items():
+                if key in self.mappings and key in stored:
+                    self.mappings[key]["hits"] = stored[key].get("hits", 0) + n
+            self.unsaved_hits = {}
+            for key, mapping in stored.items():
+                self.mappings.setdefault(key, mapping)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.mappings, f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+
+    def forget(self) -> None:
+        """
+        removes every layout, also from the file
+        """
+        with self._lock:
+            self.mappings = {}
+            self.unsaved_hits = {}
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.mappings, f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+
+    def apply(self, data: str, schema: dict[str, Any]) -> Optional[Any]:
+        """
+        the schema json of a table with a known layout, None if the layout is not known
+        or a cell does not fit the mapping (e.g. text in a number column)
+        """
+        header, rows = parse_table(data)
+        key = _key(schema, header)
+        mapping = self.mappings.get(key) if rows else None
+        result = _apply(mapping, rows) if mapping is not None else None
+        metrics.cache("table_mapping", result is not None)
+        if result is not None:
+            with self._lock:
+                mapping["hits"] = mapping.get("hits", 0) + 1
+                self.unsaved_hits[key] = self.unsaved_hits.get(key, 0) + 1
+        return result
+
+    def learn(self, data: str, schema: dict[str, Any], result: Any) -> bool:
+        """
+        records the layout of a table from its LLM transform, returns True if a mapping was learned
+        the mapping must reproduce `result` exactly from the table
+        """
+        header, rows = parse_table(data)
+        if not rows or not header_signature(header).strip("|"):
+            return False
+        path = _find_rows(result, len(rows), [])
+        if path is None:
+            return False
+        items = _get(result, path)
+        paths = [p for p, _ in _leaves(items[0])]
+        if any([p for p, _ in _leaves(item)] != paths for item in items):
+            return False
+        fields: list[list[Any]] = []
+        for p in paths:
+            field = _field([_get(item, list(p)) for item in items], rows)
+            if field is None:
+                return False
+            fields.append([list(p), *field])
+        mapping = {
+            "header": header,
+            "path": path,
+            "template": _set(copy.deepcopy(result), path, None),
+            "fields": fields,
+            "hits": 0,
+        }
+        if _apply(mapping, rows) != result:
+            return False
+        with self._lock:
+            self.mappings[_key(schema, header)] = mapping
+        metrics.incr("table_mappings_learned")
+        self.save()
+        return True
+
+    def report(self) -> dict[str, Any]:
+        """
+        hit rate of this process and the stored layouts with their hits
+        """
+        hits = metrics.counter("cache_hits", cache="table_mapping")
+        misses = metrics.counter("cache_misses", cache="table_mapping")
+        return {
+            "tables": int(hits + misses),
+            "mapped_locally": int(hits),
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "layouts": [
+                {"header": m["header"], "fields": len(m["fields"]), "hits": m.get("hits", 0)}
+                for m in sorted(self.mappings.values(), key=lambda m: -m.get("hits", 0))
+            ],
+        }
+
+
+def _read(path: str) -> dict[str, dict[str, Any]]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _apply(mapping: dict[str, Any], rows: list[list[str]]) -> Optional[Any]:
+    items: list[dict[str, Any]] = []
+    for row in rows:
+        item: dict[str, Any] = {}
+        for path, column, kind, value in mapping["fields"]:
+            cell = row[column].strip() if kind != "const" and column < len(row) else ""
+            if cell:
+                if kind == "number":
+                    value = _number(cell)
+                    if value is None:
+                        return None
+                    value = int(value) if value.is_integer() and "." not in cell else value
+                else:
+                    value = cell
+            target = item
+            for k in path[:-1]:
+                target = target.setdefault(k, {})
+            target[path[-1]] = copy.deepcopy(value)
+        items.append(item)
+    return _set(copy.deepcopy(mapping["template"]), mapping["path"], items)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python tablemap.py {report,forget} [--mappings table_mappings.json]")
+    parser.add_argument("command", choices=["report", "forget"])
+    parser.add_argument("--mappings", default=DEFAULT_MAPPINGS)
+    args = parser.parse_args()
+
+    mapper = TableMapper(args.mappings)
+    if args.command == "forget":
+        mapper.forget()
+        print(f"Removed every learned table layout from {args.mappings}")
+    else:
+        layouts = mapper.report()["layouts"]
+        print(f"{len(layouts)} learned table layouts in {args.mappings}, {sum(m['hits'] for m in layouts)} tables mapped locally")
+        for m in layouts:
+            print(f"  {m['hits']:>6} hits  {m['fields']:>3} fields  {' | '.join(m['header'])}")
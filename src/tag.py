@@ -1,30 +1,34 @@
-import json
+import argparse
 import os
 import sys
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-
-from lxml import etree
-
-from bedrock import llm_inference
-from chunky import extract_relevant_chunks
+from typing import Any, Optional
+
+import bedrock
+from bedrock import cache_tokens, llm_cost, llm_inference
+from checkpoint import RunDir
+from chunky import DEDUPE_STRATEGIES, MAX_CHUNK_SIZE, dedupe_chunks, extract_relevant_chunks
+from export import section_text
+from metrics import metrics
+from pathy import get_xml_element
+from prefilter import Prefilter, skipped_answer
 from preprocess import resolve_references, strip_namespaces, write_preprocessed_file
+from progress import Progress
+from sources import open_document
 from transform import tree_to_string
-
-tempext = "temp/"
-outext = "out/"
+from writer import InferenceWriter
 
 input_tokens = 0
 output_tokens = 0
-
-
-def cleanup():
-    for p in [tempext, outext]:
-        if os.path.exists(p):
-            for file in os.listdir(p):
-                os.remove(os.path.join(p, file))
-        else:
-            os.mkdir(p)
+# guards the token totals, which the worker threads all add to
+tokens_lock = threading.Lock()
+# set by --prefilter: the chunks of the sections it rules out get a null answer without a request
+prefilter: Optional[Prefilter] = None
+skipped_sections: set[str] = set()
+prefiltered = 0
 
 
 def normalize_text(text: str) -> str:
@@ -35,104 +39,204 @@ def normalize_text(text: str) -> str:
     return text
 
 
+def tag_chunk(i: int, chunk: dict[str, Any]) -> str:
+    """
+    runs the soft attribute inference for one chunk and returns its <chunk> entry
+    safe to call from several threads at once
+    """
+    global input_tokens, output_tokens, prefiltered
+    chunk_text = chunk.get("text", "")
+    contains_table = chunk["is_table"]
+
+    if not contains_table and chunk["section_path"] in skipped_sections:
+        inference = skipped_answer()
+        metrics.incr("llm_calls_saved", reason="prefilter")
+        with tokens_lock:
+            prefiltered += 1
+    elif not contains_table:
+        with metrics.stage("llm"):
+            llm_response = llm_inference(chunk_text)
+        inference = llm_response[0]
+        with tokens_lock:
+            input_tokens += llm_response[1]
+            output_tokens += llm_response[2]
+    else:
+        inference = (
+            '<pregnancy pregnant="false"><reasoning>Table data - no inference performed</reasoning></pregnancy>'
+            '<travel status="false"><reasoning>Table data - no inference performed</reasoning></travel>'
+            '<occupation employed="false"><reasoning>Table data - no inference performed</reasoning></occupation>'
+        )
+
+    # Escape chunk text for XML embedding
+    safe_text = (
+        chunk_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    )
+
+    return (
+        f'<chunk id="{i}" path="{chunk["path"]}">\n'
+        f"  <source>\n    {safe_text}\n  </source>\n"
+        f"  <inference>\n    {inference}\n  </inference>\n"
+        f"</chunk>\n"
+    )
+
+
 if __name__ == "__main__":
     start_time = datetime.now()
-    if len(sys.argv) < 2:
-        print("usage: python tag.py <xml_file>")
-        sys.exit(1)
-    cleanup()
-    file = sys.argv[1]
-
-    # Preprocess: resolve references
-    print("Preprocessing: resolving references...")
-    resolved_tree = resolve_references(file)
-    strip_namespaces(resolved_tree)
-
-    # Save preprocessed file (no XML declaration, no namespace prefixes)
-    preprocessed_path = os.path.join("out", os.path.basename(file).replace(".xml", "_preprocessed.xml"))
-    write_preprocessed_file(resolved_tree, preprocessed_path, file)
-    print(f"Saved preprocessed file: {preprocessed_path}")
-
-    # Extract chunks from resolved tree
-    chunks = extract_relevant_chunks(resolved_tree)
-    with open("temp/chunks.json", "w") as f:
-        json.dump(chunks, f)
-
-    seen = set()
-    unique_chunks = []
-    for chunk in chunks:
-        if normalize_text(chunk.get("text", "")) not in seen:
-            seen.add(normalize_text(chunk.get("text", "")))
-            unique_chunks.append(chunk)
+    parser = argparse.ArgumentParser(
+        usage="python tag.py <xml_file> [--fresh] [--openmetrics] [--concurrency N] [--prefilter] [--max-chunk-size N] [--dedupe MODE]"
+    )
+    parser.add_argument("file", help="xml file, compressed or not, <archive>:<member>, or - for stdin")
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="discard saved progress for this document and start over",
+    )
+    parser.add_argument(
+        "--openmetrics",
+        action="store_true",
+        help="also write the run report in OpenMetrics text format (tag_run_report.prom)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="number of chunks sent to the LLM at the same time",
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="skip the LLM for chunks that mention no pregnancy, travel or occupation terms (see prefilter.py)",
+    )
+    parser.add_argument(
+        "--max-chunk-size",
+        type=int,
+        default=MAX_CHUNK_SIZE,
+        help="characters of text per chunk at most",
+    )
+    parser.add_argument(
+        "--dedupe",
+        choices=DEDUPE_STRATEGIES,
+        default="normalized",
+        help="which repeated chunks are dropped: same normalized text (default), same exact text, or none",
+    )
+    args = parser.parse_args()
+    if args.prefilter:
+        prefilter = Prefilter.from_env()
+    document = open_document(args.file)
+    # one pooled connection per in-flight request
+    bedrock.configure(args.concurrency)
+
+    # every document gets its own temp/<key>/ and out/<key>/, completed steps are reused
+    run = RunDir(document, fresh=args.fresh)
+    # every saved step depends on the chunks, so other chunking settings start the run over
+    chunking = f"max_chunk_size={args.max_chunk_size} dedupe={args.dedupe}"
+    if run.changed("chunking.json", chunking):
+        print("Chunking settings changed: starting over")
+        run = RunDir(document, fresh=True)
+        run.changed("chunking.json", chunking)
+    preprocessed_path = run.out_path(f"{document.name}_preprocessed.xml")
+
+    chunks = run.load("chunks.json")
+    # chunks saved before the chunker recorded structural metadata are rebuilt
+    if chunks is None or not os.path.exists(preprocessed_path) or (chunks and "is_table" not in chunks[0]):
+        metrics.cache("checkpoint", False)
+        # Preprocess: resolve references
+        print("Preprocessing: resolving references...")
+        with metrics.stage("preprocess"):
+            resolved_tree = resolve_references(document)
+            strip_namespaces(resolved_tree)
+
+            # Save preprocessed file (no XML declaration, no namespace prefixes)
+            write_preprocessed_file(resolved_tree, preprocessed_path, document)
+        print(f"Saved preprocessed file: {preprocessed_path}")
+
+        # Extract chunks from resolved tree
+        with metrics.stage("chunk"):
+            chunks = extract_relevant_chunks(resolved_tree, args.max_chunk_size)
+        run.save("chunks.json", chunks)
+    else:
+        print(f"Resuming: loaded {run.temp_path('chunks.json')}")
+        metrics.cache("checkpoint", True)
+
+    with metrics.stage("dedupe"):
+        unique_chunks = dedupe_chunks(chunks, args.dedupe, normalize_text)
     print(
         f"{len(chunks)} total chunks, after deduplication, {len(unique_chunks)} total chunks"
     )
 
-    # Run LLM inference on each chunk (tagging only, no categorization)
-    inferences: list[str] = []
-    for i, chunk in enumerate(unique_chunks):
-        print(f"chunk {i + 1} / {len(unique_chunks)}:")
-        chunk_text = chunk.get("text", "")
-        chunk_xml = chunk.get("xml", "")
-
-        contains_table = False
-        if "<table" in chunk_xml.lower():
-            contains_table = True
-
-        if not contains_table:
-            try:
-                doc = etree.fromstring(chunk_xml.encode("utf-8"))
-                tables = doc.xpath(".//*[local-name()='table']")
-                if tables:
-                    contains_table = True
-            except Exception:
-                pass
-
-        if not contains_table:
-            llm_response = llm_inference(chunk_text)
-            inference = llm_response[0]
-            input_tokens += llm_response[1]
-            output_tokens += llm_response[2]
-        else:
-            inference = (
-                '<pregnancy pregnant="false"><reasoning>Table data - no inference performed</reasoning></pregnancy>'
-                '<travel status="false"><reasoning>Table data - no inference performed</reasoning></travel>'
-                '<occupation employed="false"><reasoning>Table data - no inference performed</reasoning></occupation>'
-            )
-
-        # Escape chunk text for XML embedding
-        safe_text = (
-            chunk_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-        )
-
-        xml = (
-            f'<chunk id="{i}" path="{chunk["path"]}">\n'
-            f"  <source>\n    {safe_text}\n  </source>\n"
-            f"  <inference>\n    {inference}\n  </inference>\n"
-            f"</chunk>\n"
-        )
-        inferences.append(xml)
-        print(f"  contains_table={contains_table}, path={chunk['path']}")
+    # the prefilter reads the plain text of each chunk's section, as `prefilter.py report` does
+    if prefilter is not None:
+        codes = {c["section_path"]: c.get("section_code") for c in unique_chunks if not c["is_table"]}
+        for path, code in codes.items():
+            if not prefilter.keep(section_text(get_xml_element(preprocessed_path, path)), code):
+                skipped_sections.add(path)
 
-    with open("out/xml_tagging_inference.xml", "w") as f:
-        f.write("<root>\n")
-        for i in inferences:
-            f.write(i)
-        f.write("</root>\n")
+    # Run LLM inference on each chunk (tagging only, no categorization)
+    # each chunk's entry is streamed to disk as soon as it is ready
+    output_path = run.out_path("xml_tagging_inference.xml")
+    writer = InferenceWriter(output_path, resume=True)
+    completed = writer.completed()
+    if completed:
+        print(f"Resuming: {len(completed)} / {len(unique_chunks)} chunks already inferred")
+    metrics.cache("inference", True, len(completed))
+    metrics.cache("inference", False, len(unique_chunks) - len(completed))
+    # chunks are inferred concurrently, the writer puts the entries back in chunk order
+    pending = [(i, chunk) for i, chunk in enumerate(unique_chunks) if i not in completed]
+    progress = Progress(len(unique_chunks), done=len(completed))
+    with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+        futures = {executor.submit(tag_chunk, i, chunk): i for i, chunk in pending}
+        try:
+            for future in as_completed(futures):
+                xml = future.result()
+                with metrics.stage("write"):
+                    writer.write(futures[future], xml)
+                progress.update()
+        except BaseException:
+            # a fatal error (bedrock exits on one) must not wait for the queued chunks
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    with metrics.stage("write"):
+        writer.close()
 
     end_time = datetime.now()
     elapsed = end_time - start_time
 
-    # https://aws.amazon.com/bedrock/pricing/ as of 04/01/2025
-    total_inference_cost = (input_tokens * 0.003 / 1000) + (
-        output_tokens * 0.015 / 1000
-    )
+    cache_read_tokens, cache_write_tokens = cache_tokens()
+    total_inference_cost = llm_cost(input_tokens, output_tokens, cache_read_tokens, cache_write_tokens)
 
     print("------------------------------------------------------------")
-    print("Final output created in: out/xml_tagging_inference.xml")
+    print(f"Final output created in: {output_path}")
     print(f"Preprocessed file: {preprocessed_path}")
     print(f"LLM inference input tokens: {input_tokens}")
     print(f"LLM inference output tokens: {output_tokens}")
+    print(f"LLM prompt cache read / write tokens: {cache_read_tokens} / {cache_write_tokens}")
     print(f"Approximate LLM inference cost: ${total_inference_cost:.4f}")
+    if args.prefilter:
+        print(f"Pre-filter: {prefiltered} chunks answered null without an LLM request")
     print(f"Script took approximately {elapsed.total_seconds() / 60:.2f} minutes.")
+
+    metrics.set_info(
+        script="tag.py",
+        document=document.label,
+        run_key=run.key,
+        chunks=len(chunks),
+        unique_chunks=len(unique_chunks),
+        concurrency=args.concurrency,
+        max_chunk_size=args.max_chunk_size,
+        dedupe=args.dedupe,
+        chunks_per_second=round(progress.rate(), 3),
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        cache_read_tokens=cache_read_tokens,
+        cache_write_tokens=cache_write_tokens,
+        approximate_cost=round(total_inference_cost, 6),
+        prefilter=args.prefilter,
+        chunks_prefiltered=prefiltered,
+    )
+    report_path = run.out_path("tag_run_report.json")
+    metrics.write_report(report_path, openmetrics=args.openmetrics)
+    print("Time per stage:")
+    metrics.print_summary()
+    print(f"Run report: {report_path}")
     print("------------------------------------------------------------")
@@ -1,26 +1,33 @@
+import argparse
+import hashlib
 import json
 import os
 import sys
 import xml.etree.ElementTree as ET
-from typing import Any
+from typing import Any, Optional
 import re
 
 import lxml
 import numpy as np
-from lxml import etree
 
-from bedrock import llm_inference
-from chunky import extract_relevant_chunks_file, extract_relevant_chunks
+from bedrock import cache_tokens, llm_cost, llm_inference, llm_inference_packed
+from checkpoint import RunDir
+from codeindex import MIN_CONSISTENCY, MIN_SUPPORT, CodeIndex, Lookup, corpus_signature
+from chunky import DEDUPE_STRATEGIES, MAX_CHUNK_SIZE, dedupe_chunks, extract_relevant_chunks_file, extract_relevant_chunks
+from export import RESULTS, ResultExporter, section_text
+from metrics import metrics
 from pathy import embedding_to_source_xml, get_xml_element
+from prefilter import Prefilter, skipped_answer
 from preprocess import resolve_references, strip_namespaces, write_preprocessed_file
+from schemas import get_schema
+from sources import open_document
+from store import EmbeddingStore, open_store, store_signature
 from transform import tree_to_string
-from vectoring import get_bedrock_embeddings
+from vectoring import SCHEMA_TYPE, get_bedrock_embeddings
+from writer import InferenceWriter
 
 from datetime import datetime
 
-tempext = "temp/"
-outext = "out/"
-
 input_tokens = 0
 output_tokens = 0
 
@@ -63,15 +70,6 @@ def get_content_preview(element, max_length=50):
         return f"Preview error: {str(e)[:30]}"
 
 
-def cleanup():
-    for p in [tempext, outext]:
-        if os.path.exists(p):
-            for file in os.listdir(p):
-                os.remove(os.path.join(p, file))
-        else:
-            os.mkdir(p)
-
-
 def normalize_text(text: str) -> str:
     """Normalize text by converting to lowercase and removing special characters."""
     # Convert to lowercase
@@ -124,46 +122,47 @@ def first_occurrence_of_text(
     return True
 
 
-if __name__ == "__main__":
-    start_time = datetime.now()
-    if len(sys.argv) < 2:
-        print("usage: python test.py <xml_file>")
-        sys.exit(1)
-    cleanup()
-    file = sys.argv[1]
-
-    # Preprocess: resolve references
-    print("Preprocessing: resolving references...")
-    resolved_tree = resolve_references(file)
-    strip_namespaces(resolved_tree)
-
-    # Save preprocessed file (no XML declaration, no namespace prefixes)
-    preprocessed_path = os.path.join("out", os.path.basename(file).replace(".xml", "_preprocessed.xml"))
-    write_preprocessed_file(resolved_tree, preprocessed_path, file)
-    print(f"Saved preprocessed file: {preprocessed_path}")
-    
-    # Extract chunks from resolved tree
-    chunks = extract_relevant_chunks(resolved_tree)
-    with open("temp/chunks.json", "w") as f:
-        json.dump(chunks, f)
-
-    seen = set()
-    unique_chunks = []
-    for chunk in chunks:
-        if normalize_text(chunk.get("text", "")) not in seen:
-            seen.add(normalize_text(chunk.get("text", "")))
-            unique_chunks.append(chunk)
-    print(
-        f"{len(chunks)} total chunks, after deduplication, {len(unique_chunks)} total chunks"
-    )
+def embed_chunks(run: RunDir, chunks: list[dict[str, Any]], skip: Optional[set[int]] = None) -> list[Optional[dict[str, Any]]]:
+    """
+    embeds each chunk, journaling every embedding as it arrives so a rerun only embeds the rest
+    chunks in `skip` (categorized by the section code index) are not embedded and get None
+    """
+    skip = skip or set()
+    done, journal = run.journal("embeddings.ndjson")
+    if done:
+        print(f"Resuming: {len(done)} / {len(chunks)} embeddings already computed")
+    metrics.cache("embeddings", True, len([i for i in done if i not in skip]))
+    metrics.cache("embeddings", False, len([i for i in range(len(chunks)) if i not in done and i not in skip]))
+    embeddings: list[Optional[dict[str, Any]]] = []
+    for i, c in enumerate(chunks):
+        if i in skip:
+            embeddings.append(None)
+            continue
+        if i not in done:
+            done[i] = {"index": i, **get_bedrock_embeddings(c)}
+            journal.append(done[i])
+        embeddings.append(done[i])
+    journal.close()
+    return embeddings
+
+
+def compute_similarities(
+    file: str,
+    test_file_embeddings: list[Optional[dict[str, Any]]],
+    unique_chunks: list[dict[str, Any]],
+    store: Optional[EmbeddingStore] = None,
+    rerank: int = 50,
+) -> list[list[dict[str, Any]]]:
+    if store is not None:
+        return compute_store_similarities(file, test_file_embeddings, unique_chunks, store, rerank)
 
-    # choose between hl7 and ecr (makedata golden template) schemas in vectoring.py
-    test_file_embeddings = [get_bedrock_embeddings(c) for c in unique_chunks]
     existing_embeddings = load_all_embeddings()
     similarities: list[list[dict[str, Any]]] = []
 
     for i, tfe in enumerate(test_file_embeddings):
         similarities.append([])
+        if tfe is None:
+            continue
         for j, existing_embedding in enumerate(existing_embeddings):
             similarity = cos_similarity(
                 np.array(tfe["embedding"]), np.array(existing_embedding["embedding"])
@@ -186,12 +185,60 @@ if __name__ == "__main__":
         # store all similarities for now so can access them if needed or if first one isnt best match etc
         similarities[i].sort(key=lambda x: x["similarity"], reverse=True)
 
-    with open("temp/similarities.json", "w") as f:
-        json.dump(similarities, f, indent=2)
+    return similarities
+
+
+def compute_store_similarities(
+    file: str,
+    test_file_embeddings: list[Optional[dict[str, Any]]],
+    unique_chunks: list[dict[str, Any]],
+    store: EmbeddingStore,
+    rerank: int = 50,
+) -> list[list[dict[str, Any]]]:
+    """
+    same output as compute_similarities, scored against a binary EmbeddingStore:
+    all chunks at once on the (possibly quantized) matrix, top `rerank` rows per chunk re-scored at full precision
+    """
+    embedded = [i for i, tfe in enumerate(test_file_embeddings) if tfe is not None]
+    queries = np.array([test_file_embeddings[i]["embedding"] for i in embedded], dtype=np.float32)  # type: ignore
+    scores = store.scores(queries, rerank) if len(queries) else np.zeros((0, len(store)))
+    similarities: list[list[dict[str, Any]]] = [[] for _ in test_file_embeddings]
+    meta = list(store.meta)  # parsed once per call when the store is memory-mapped
+    for i, row in zip(embedded, scores):
+        similarities[i] = (
+            [
+                {
+                    "existing_file": {
+                        "file": f"embeddings/{meta[j]['file']}",
+                        "chunk_id": meta[j]["chunk_id"],
+                        "path": meta[j]["path"],
+                    },
+                    "test_file": {
+                        "file": file,
+                        "chunk_id": i,
+                        "path": unique_chunks[i]["path"],
+                    },
+                    "similarity": float(row[j]),
+                    "category": meta[j]["category"],
+                    # rows of a condensed store stand for several reference chunks
+                    **({"weight": meta[j]["weight"]} if "weight" in meta[j] else {}),
+                }
+                for j in np.argsort(-row, kind="stable")
+            ]
+        )
+    return similarities
+
 
-    """Below is the additive code"""
+def additive_scores(similarities: list[list[dict[str, Any]]]) -> list[Any]:
+    """
+    top match plus additive per-category scores for every chunk, None for a chunk
+    without similarities (categorized by the section code index instead)
+    """
     document_with_similarities: list[Any] = []
     for i in range(len(similarities)):
+        if not similarities[i]:
+            document_with_similarities.append(None)
+            continue
         # Find the top individual match (original approach)
         top_match = similarities[i][0]
 
@@ -201,20 +248,21 @@ if __name__ == "__main__":
             category = sim["category"]
             if category not in category_scores:
                 category_scores[category] = {"score": 0, "matches": []}
-            category_scores[category]["score"] += sim["similarity"]
+            category_scores[category]["score"] += sim["similarity"] * sim.get("weight", 1)
 
             # Get a preview of the chunk text (for showing in the output)
             preview_text = ""
-            try:
-                # Try to get the source XML file to extract a preview
-                source_xml = embedding_to_source_xml(sim["existing_file"]["file"])
-                source_path = sim["existing_file"]["path"].split(".section.")[0]
-                source_el = get_xml_element(source_xml, source_path)
-                full_text = tree_to_string(source_el)
-                # Truncate to ~50 tokens (roughly 250 characters)
-                preview_text = full_text[:250] + ("..." if len(full_text) > 250 else "")
-            except:
-                preview_text = "Preview not available"
+            with metrics.stage("preview"):
+                try:
+                    # Try to get the source XML file to extract a preview
+                    source_xml = embedding_to_source_xml(sim["existing_file"]["file"])
+                    source_path = sim["existing_file"]["path"].split(".section.")[0]
+                    source_el = get_xml_element(source_xml, source_path)
+                    full_text = tree_to_string(source_el)
+                    # Truncate to ~50 tokens (roughly 250 characters)
+                    preview_text = full_text[:250] + ("..." if len(full_text) > 250 else "")
+                except:
+                    preview_text = "Preview not available"
 
             # Store match info with preview
             category_scores[category]["matches"].append(
@@ -244,13 +292,354 @@ if __name__ == "__main__":
 
         document_with_similarities.append(new_entry)
 
-    with open("temp/whole_doc_similarities.json", "w") as f:
-        # Save document with similarities
-        json.dump(document_with_similarities, f, indent=2)
+    return document_with_similarities
+
+
+def lookup_entry(file: str, i: int, chunk: dict[str, Any], lookup: Lookup) -> dict[str, Any]:
+    """
+    whole_doc_similarities entry of a chunk categorized by the section code index: the
+    category it decides, with reference chunks of the same code as matches (no similarities)
+    """
+    matches = [{"file": m["file"], "path": m["path"], "similarity": None} for m in lookup.examples]
+    return {
+        "existing_file": dict(lookup.examples[0]),
+        "test_file": {"file": file, "chunk_id": i, "path": chunk["path"]},
+        "similarity": None,
+        "category": lookup.category,
+        "additive_top_category": lookup.category,
+        "additive_top_score": None,
+        "highest_category_matches": matches,
+        "lookup": {
+            "key": lookup.key,
+            "value": lookup.value,
+            "support": lookup.support,
+            "consistency": round(lookup.consistency, 4),
+        },
+    }
+
+
+class SectionInference:
+    """
+    soft attribute inference per section: each distinct section is sent to the LLM once
+    and the answer is reused for every chunk of that section
+
+    with pack_chars > 0 the next sections still to be inferred are packed into the same
+    prompt, as long as their text adds up to at most pack_chars characters
+
+    with a prefilter, sections it rules out get a null answer without a request;
+    section_codes gives the <section> code of each path for its code hints
+    """
+
+    def __init__(
+        self,
+        preprocessed_path: str,
+        section_paths: list[str],
+        pack_chars: int = 0,
+        prefilter: Optional[Prefilter] = None,
+        section_codes: Optional[dict[str, Optional[str]]] = None,
+    ):
+        self.preprocessed_path = preprocessed_path
+        self.order = list(dict.fromkeys(section_paths))
+        self.pack_chars = pack_chars
+        self.prefilter = prefilter
+        self.section_codes = section_codes or {}
+        self.answers: dict[str, str] = {}
+        # sections answered by the prefilter instead of the LLM
+        self.skipped: set[str] = set()
+        # (input, output) tokens attributed to each inferred section
+        self.tokens: dict[str, tuple[float, float]] = {}
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.calls = 0
+        self.reused = 0
+        self.saved_input_tokens = 0.0
+        self.saved_output_tokens = 0.0
+
+    def text(self, path: str) -> str:
+        return tree_to_string(get_xml_element(self.preprocessed_path, path))
+
+    def _skip(self, path: str) -> bool:
+        """
+        answers a section the prefilter rules out, returns whether it did
+        the prefilter reads the section's plain text, as `prefilter.py report` does
+        """
+        if self.prefilter is None or self.prefilter.keep(
+            section_text(get_xml_element(self.preprocessed_path, path)), self.section_codes.get(path)
+        ):
+            return False
+        self.answers[path] = skipped_answer()
+        self.tokens[path] = (0.0, 0.0)
+        self.skipped.add(path)
+        metrics.incr("llm_calls_saved", reason="prefilter")
+        return True
+
+    def infer(self, path: str) -> str:
+        if path in self.answers:
+            self.reused += 1
+            self.saved_input_tokens += self.tokens[path][0]
+            self.saved_output_tokens += self.tokens[path][1]
+            if path not in self.skipped:
+                metrics.incr("llm_calls_saved", reason="same_section")
+            return self.answers[path]
+
+        if self._skip(path):
+            return self.answers[path]
+        text = self.text(path)
+        pack = [path]
+        texts = [text]
+        if self.pack_chars > 0 and path in self.order:
+            for p in self.order[self.order.index(path) + 1 :]:
+                if p in self.answers:
+                    continue
+                if self._skip(p):
+                    continue
+                t = self.text(p)
+                if sum(len(x) for x in texts) + len(t) > self.pack_chars:
+                    break
+                pack.append(p)
+                texts.append(t)
+
+        self.calls += 1
+        with metrics.stage("llm"):
+            if len(pack) == 1:
+                answer, in_tokens, out_tokens = llm_inference(texts[0])
+                answers: list[Optional[str]] = [answer]
+            else:
+                answers, in_tokens, out_tokens = llm_inference_packed(texts)
+                metrics.incr("llm_calls_saved", len(pack) - 1, reason="packed")
+        self.input_tokens += in_tokens
+        self.output_tokens += out_tokens
+
+        total = sum(len(t) for t in texts) or 1
+        for p, t, answer in zip(pack, texts, answers):
+            if answer is None:
+                # the model skipped this record, ask for it on its own
+                self.calls += 1
+                with metrics.stage("llm"):
+                    answer, extra_in, extra_out = llm_inference(t)
+                self.input_tokens += extra_in
+                self.output_tokens += extra_out
+            self.answers[p] = answer
+            self.tokens[p] = (in_tokens * len(t) / total, out_tokens * len(t) / total)
+        return self.answers[path]
+
+
+if __name__ == "__main__":
+    start_time = datetime.now()
+    parser = argparse.ArgumentParser(
+        usage="python test.py <xml_file> [--fresh] [--openmetrics] [--store DIR] [--rerank K] [--mapped] [--pack-chars N] "
+        "[--prefilter] [--no-code-index] [--min-support N] [--min-consistency R] [--max-chunk-size N] [--dedupe MODE]"
+    )
+    parser.add_argument("file", help="xml file, compressed or not, <archive>:<member>, or - for stdin")
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="discard saved progress for this document and start over",
+    )
+    parser.add_argument(
+        "--openmetrics",
+        action="store_true",
+        help="also write the run report in OpenMetrics text format (test_run_report.prom)",
+    )
+    parser.add_argument(
+        "--store",
+        help="score against a binary embedding store (see store.py) instead of the json files in embeddings/",
+    )
+    parser.add_argument(
+        "--rerank",
+        type=int,
+        default=50,
+        help="with --store, re-score this many top matches per chunk at full precision",
+    )
+    parser.add_argument(
+        "--mapped",
+        action="store_true",
+        help="with --store, memory-map the store read-only instead of loading it, so processes share one copy",
+    )
+    parser.add_argument(
+        "--pack-chars",
+        type=int,
+        default=0,
+        help="pack several sections into one LLM prompt, up to this many characters of section text",
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="skip the LLM for sections that mention no pregnancy, travel or occupation terms (see prefilter.py)",
+    )
+    parser.add_argument(
+        "--no-code-index",
+        action="store_true",
+        help="categorize every chunk by similarity search, without the section code index (see codeindex.py)",
+    )
+    parser.add_argument(
+        "--min-support",
+        type=int,
+        default=MIN_SUPPORT,
+        help="reference chunks a section code needs before the code index decides its category",
+    )
+    parser.add_argument(
+        "--min-consistency",
+        type=float,
+        default=MIN_CONSISTENCY,
+        help="share of a section code's reference chunks that must agree for the code index to decide",
+    )
+    parser.add_argument(
+        "--max-chunk-size",
+        type=int,
+        default=MAX_CHUNK_SIZE,
+        help="characters of text per chunk at most",
+    )
+    parser.add_argument(
+        "--dedupe",
+        choices=DEDUPE_STRATEGIES,
+        default="normalized",
+        help="which repeated chunks are dropped: same normalized text (default), same exact text, or none",
+    )
+    args = parser.parse_args()
+    document = open_document(args.file)
+
+    # every document gets its own temp/<key>/ and out/<key>/, completed steps are reused
+    run = RunDir(document, fresh=args.fresh)
+    # every saved step depends on the chunks, so other chunking settings start the run over
+    chunking = f"max_chunk_size={args.max_chunk_size} dedupe={args.dedupe}"
+    if run.changed("chunking.json", chunking):
+        print("Chunking settings changed: starting over")
+        run = RunDir(document, fresh=True)
+        run.changed("chunking.json", chunking)
+    preprocessed_path = run.out_path(f"{document.name}_preprocessed.xml")
+    # outputs written with categories, removed when the categories may change
+    categorized_outputs = [
+        run.out_path("xml_source_inference.xml"),
+        run.out_path("xml_source_inference.xml.ndjson"),
+        run.out_path(RESULTS),
+    ]
+    # similarities and inferences carry categories, which come from the classification schema
+    if run.changed("schema_version.json", get_schema(SCHEMA_TYPE).version):
+        print("Classification schema changed: recomputing similarities and inferences")
+        run.discard("similarities.json", "whole_doc_similarities.json")
+        for p in categorized_outputs:
+            if os.path.exists(p):
+                os.remove(p)
+
+    chunks = run.load("chunks.json")
+    # chunks saved before the chunker recorded structural metadata are rebuilt
+    if chunks is None or not os.path.exists(preprocessed_path) or (chunks and "is_table" not in chunks[0]):
+        metrics.cache("checkpoint", False)
+        # Preprocess: resolve references
+        print("Preprocessing: resolving references...")
+        with metrics.stage("preprocess"):
+            resolved_tree = resolve_references(document)
+            strip_namespaces(resolved_tree)
+
+            # Save preprocessed file (no XML declaration, no namespace prefixes)
+            write_preprocessed_file(resolved_tree, preprocessed_path, document)
+        print(f"Saved preprocessed file: {preprocessed_path}")
+
+        # Extract chunks from resolved tree
+        with metrics.stage("chunk"):
+            chunks = extract_relevant_chunks(resolved_tree, args.max_chunk_size)
+        run.save("chunks.json", chunks)
+    else:
+        print(f"Resuming: loaded {run.temp_path('chunks.json')}")
+        metrics.cache("checkpoint", True)
+
+    with metrics.stage("dedupe"):
+        unique_chunks = dedupe_chunks(chunks, args.dedupe, normalize_text)
+    print(
+        f"{len(chunks)} total chunks, after deduplication, {len(unique_chunks)} total chunks"
+    )
+
+    # chunks whose section code decides their category skip the embedding and similarity search
+    with metrics.stage("lookup"):
+        code_index = None if args.no_code_index else CodeIndex.load()
+        if code_index is not None:
+            code_index.min_support = args.min_support
+            code_index.min_consistency = args.min_consistency
+        lookups: dict[int, Lookup] = {}
+        for i, c in enumerate(unique_chunks):
+            lookup = code_index.lookup(c) if code_index is not None else None
+            if lookup is not None:
+                lookups[i] = lookup
+    metrics.cache("code_index", True, len(lookups))
+    metrics.cache("code_index", False, len(unique_chunks) - len(lookups))
+    lookup_version = hashlib.sha256(
+        json.dumps({i: [l.label(), l.category] for i, l in lookups.items()}, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:12]
+    if run.changed("code_lookups.json", lookup_version):
+        print("Section code lookups changed: recomputing similarities and inferences")
+        run.discard("similarities.json", "whole_doc_similarities.json")
+        for p in categorized_outputs:
+            if os.path.exists(p):
+                os.remove(p)
+
+    # similarities depend on what they were scored against: the embeddings/ corpus, or the
+    # store (its rows too) and its re-ranking
+    scoring = json.dumps(
+        {"store": None, "signature": corpus_signature()}
+        if not args.store
+        else {
+            "store": os.path.abspath(args.store),
+            "signature": store_signature(args.store),
+            "rerank": args.rerank,
+            "mapped": args.mapped,
+        },
+        sort_keys=True,
+    )
+    if run.changed("scoring.json", scoring):
+        print("Reference embeddings or store settings changed: recomputing similarities and inferences")
+        run.discard("similarities.json", "whole_doc_similarities.json")
+        for p in categorized_outputs:
+            if os.path.exists(p):
+                os.remove(p)
+
+    # choose between hl7 and ecr (makedata golden template) schemas in vectoring.py
+    with metrics.stage("embed"):
+        test_file_embeddings = embed_chunks(run, unique_chunks, set(lookups))
+    with metrics.stage("similarity"):
+        similarities = run.cached(
+            "similarities.json",
+            lambda: compute_similarities(
+                document.label, test_file_embeddings, unique_chunks, open_store(args.store, args.mapped), args.rerank
+            ),
+            indent=2,
+        )
+
+    document_with_similarities = run.cached(
+        "whole_doc_similarities.json",
+        lambda: [
+            lookup_entry(document.label, i, unique_chunks[i], lookups[i]) if i in lookups else entry
+            for i, entry in enumerate(additive_scores(similarities))
+        ],
+        indent=2,
+    )
 
     """below is the additive code"""
-    inferences: list[str] = []
+    # each chunk's entry is streamed to disk as soon as it is ready
+    output_path = run.out_path("xml_source_inference.xml")
+    writer = InferenceWriter(output_path, resume=True)
+    # compact per-chunk export (results.ndjson + sections.ndjson) for analytics
+    exporter = ResultExporter(run.out)
+    completed = writer.completed()
+    if completed:
+        print(f"Resuming: {len(completed)} / {len(document_with_similarities)} chunks already inferred")
+    metrics.cache("inference", True, len(completed))
+    metrics.cache("inference", False, len(document_with_similarities) - len(completed))
+    # every section without a table is inferred once, in the order its chunks are written
+    sections = SectionInference(
+        preprocessed_path,
+        [
+            c["section_path"]
+            for i, c in enumerate(unique_chunks)
+            if i not in completed and not c["section_has_table"]
+        ],
+        args.pack_chars,
+        Prefilter.from_env() if args.prefilter else None,
+        {c["section_path"]: c.get("section_code") for c in unique_chunks},
+    )
     for i, s in enumerate(document_with_similarities):
+        if i in completed:
+            continue
         print(f"chunk {i + 1} / {len(document_with_similarities)}:")
         embed_section_path = s["existing_file"]["path"].split(".section.")[0]
         test_section_path = s["test_file"]["path"].split(".section.")[0]
@@ -259,78 +648,69 @@ if __name__ == "__main__":
         print("------------------------------------------------------------")
         print(f"Top match: {s['existing_file']['file']}")
         print(f"to {embed_xml}")
-        print(f"category: {s['category']} (similarity: {s['similarity']:.4f})")
-        print(
-            f"\nHighest additive category: {s['additive_top_category']} (score: {s['additive_top_score']:.4f})"
-        )
-        print("  Top matches:")
-
-        # Show top matches for the highest category
-        for match in sorted(
-            s["highest_category_matches"], key=lambda x: x["similarity"], reverse=True
-        )[:3]:
-            print(f"    - {match['file']} (similarity: {match['similarity']:.4f})")
-            print(f"      Path: {match['path']}")
+        lookup = s.get("lookup")
+        if lookup is not None:
+            print(
+                f"category: {s['category']} (section {lookup['key']} {lookup['value']}: "
+                f"{lookup['support']} reference chunks, {lookup['consistency']:.0%} in this category)"
+            )
+            print("  Reference chunks with this code:")
+            for match in s["highest_category_matches"]:
+                print(f"    - {match['file']}")
+                print(f"      Path: {match['path']}")
+        else:
+            print(f"category: {s['category']} (similarity: {s['similarity']:.4f})")
+            print(
+                f"\nHighest additive category: {s['additive_top_category']} (score: {s['additive_top_score']:.4f})"
+            )
+            print("  Top matches:")
+
+            # Show top matches for the highest category
+            for match in sorted(
+                s["highest_category_matches"], key=lambda x: x["similarity"], reverse=True
+            )[:3]:
+                print(f"    - {match['file']} (similarity: {match['similarity']:.4f})")
+                print(f"      Path: {match['path']}")
             # Print preview on a new line with some indentation
             # print(f"      Preview: \"{match['preview'].replace('\n', ' ').strip()[:50]}\"")
 
         print("------------------------------------------------------------\n")
 
         # Get the elements for the XML output (use preprocessed file so resolved references are included)
-        embed_el: Any = get_xml_element(embed_xml, embed_section_path)
-        test_el: Any = get_xml_element(preprocessed_path, test_section_path)
+        with metrics.stage("preview"):
+            embed_el: Any = get_xml_element(embed_xml, embed_section_path)
+            test_el: Any = get_xml_element(preprocessed_path, test_section_path)
         text = tree_to_string(test_el)
-        test_el_string = etree.tostring(test_el, encoding="unicode")
 
-        contains_table = False
-        # 3 different methods to check if the chunk is a table
-        if "<table" in test_el_string:
-            contains_table = True
+        # the chunker records whether the chunk's section contains a table
+        contains_table = unique_chunks[i]["section_has_table"]
 
         if not contains_table:
-            for elem in test_el.iter():
-                tag = elem.tag
-
-                # skip comments
-                if type(tag).__name__ == "cython_function_or_method":
-                    continue
-
-                # Remove namespace if present
-                if "}" in tag:
-                    tag = tag.split("}", 1)[1]
-                if tag.lower() == "table":
-                    contains_table = True
-                    break
-
-        if not contains_table:
-            try:
-                tables = test_el.xpath(".//*[local-name()='table']")
-                if tables:
-                    contains_table = True
-            except (AttributeError, TypeError):
-                pass
-
-        if not contains_table:
-            llm_response = llm_inference(text)
-            inference = llm_response[0]
-            input_tokens += llm_response[1]
-            output_tokens += llm_response[2]
+            inference = sections.infer(test_section_path)
         else:
             inference = '<pregnancy pregnant="false"><reasoning>Table data - no inference performed</reasoning></pregnancy><travel status="false"><reasoning>Table data - no inference performed</reasoning></travel><occupation employed="false"><reasoning>Table data - no inference performed</reasoning></occupation>'
 
         # Create the XML with only the highest additive category
-        additive_scores_xml = f'<category name="{s["additive_top_category"]}" score="{s["additive_top_score"]}">'
+        # a category from the section code index has no scores, the evidence for it instead
+        if lookup is not None:
+            scores = f'lookup="{lookup["key"]}:{lookup["value"]}" support="{lookup["support"]}" consistency="{lookup["consistency"]}"'
+            category_scores = scores
+        else:
+            scores = f'similarity="{s["similarity"]}" additive_top_category="{s["additive_top_category"]}" additive_top_score="{s["additive_top_score"]}"'
+            category_scores = f'score="{s["additive_top_score"]}"'
+        additive_scores_xml = f'<category name="{s["additive_top_category"]}" {category_scores}>'
         for match in sorted(
-            s["highest_category_matches"], key=lambda x: x["similarity"], reverse=True
+            s["highest_category_matches"], key=lambda x: x["similarity"] or 0.0, reverse=True
         )[:3]:
-            try:
-                # Get a better preview of the content
-                source_xml = embedding_to_source_xml(match["file"])
-                source_path = match["path"].split(".section.")[0]
-                source_el = get_xml_element(source_xml, source_path)
-                preview = get_content_preview(source_el, 100)  # Get a 100-char preview
-            except Exception as e:
-                preview = f"Preview not available: {str(e)[:30]}"
+            with metrics.stage("preview"):
+                try:
+                    # Get a better preview of the content
+                    source_xml = embedding_to_source_xml(match["file"])
+                    source_path = match["path"].split(".section.")[0]
+                    source_el = get_xml_element(source_xml, source_path)
+                    preview = get_content_preview(source_el, 100)  # Get a 100-char preview
+                except Exception as e:
+                    preview = f"Preview not available: {str(e)[:30]}"
 
             # Escape the preview text for XML
             preview = (
@@ -338,11 +718,12 @@ if __name__ == "__main__":
             )
             preview = preview.replace("\n", " ").strip()
 
-            additive_scores_xml += f'<match file="{match["file"]}" path="{match["path"]}" similarity="{match["similarity"]}">\n  <preview>{preview}</preview>\n</match>\n'
+            similarity = f' similarity="{match["similarity"]}"' if match["similarity"] is not None else ""
+            additive_scores_xml += f'<match file="{match["file"]}" path="{match["path"]}"{similarity}>\n  <preview>{preview}</preview>\n</match>\n'
         additive_scores_xml += "</category>\n"
 
         xml = (
-            f"<{s['category'].replace(' ', '_')} similarity=\"{s['similarity']}\" additive_top_category=\"{s['additive_top_category']}\" additive_top_score=\"{s['additive_top_score']}\">\n"
+            f"<{s['category'].replace(' ', '_')} {scores}>\n"
             f"  <testSource filePath=\"{preprocessed_path}\" elementPath=\"{test_section_path}\">\n"
             + text
             + f"\n  </testSource>\n"
@@ -353,26 +734,76 @@ if __name__ == "__main__":
             f"  <inference>\n" + inference + f"\n  </inference>\n"
             f"</{s['category'].replace(' ', '_')}>\n"
         )
-        inferences.append(xml)
+        with metrics.stage("write"):
+            exporter.write(
+                i,
+                s,
+                unique_chunks[i],
+                exporter.section(preprocessed_path, test_section_path, test_el),
+                exporter.section(embed_xml, embed_section_path, embed_el),
+                None if contains_table else inference,
+                prefiltered=test_section_path in sections.skipped,
+            )
+            writer.write(i, xml)
+
+    with metrics.stage("write"):
+        writer.close()
+        exporter.close()
 
-    with open("out/xml_source_inference.xml", "w") as f:
-        f.write("<root>")
-        for i in inferences:
-            f.write(i)
-        f.write("</root>")
+    input_tokens += sections.input_tokens
+    output_tokens += sections.output_tokens
 
     end_time = datetime.now()
     elapsed = end_time - start_time
 
-    # https://aws.amazon.com/bedrock/pricing/ as of 04/01/2025
-    total_inference_cost = (input_tokens * 0.003 / 1000) + (
-        output_tokens * 0.015 / 1000
-    )
+    cache_read_tokens, cache_write_tokens = cache_tokens()
+    total_inference_cost = llm_cost(input_tokens, output_tokens, cache_read_tokens, cache_write_tokens)
 
     print("------------------------------------------------------------")
-    print("Final output created in: out/xml_source_inference.xml")
+    print(f"Final output created in: {output_path}")
     print(f"LLM inference input tokens: {input_tokens}")
     print(f"LLM inference output tokens: {output_tokens}")
+    print(f"LLM prompt cache read / write tokens: {cache_read_tokens} / {cache_write_tokens}")
     print(f"Approximate LLM inference cost: ${total_inference_cost:.4f}")
+    print(
+        f"LLM requests: {sections.calls} for {len(sections.answers)} sections; "
+        f"{sections.reused} chunks reused their section's answer, saving about "
+        f"{sections.saved_input_tokens:.0f} input and {sections.saved_output_tokens:.0f} output tokens"
+    )
+    if args.prefilter:
+        print(f"Pre-filter: {len(sections.skipped)} sections answered null without an LLM request")
+    print(
+        f"Categories: {len(lookups)} / {len(unique_chunks)} chunks short-circuited by the section code index, "
+        f"{len(unique_chunks) - len(lookups)} by similarity search"
+    )
     print(f"Script took approximately {elapsed.total_seconds() / 60:.2f} minutes.")
+
+    metrics.set_info(
+        script="test.py",
+        document=document.label,
+        run_key=run.key,
+        chunks=len(chunks),
+        unique_chunks=len(unique_chunks),
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        cache_read_tokens=cache_read_tokens,
+        cache_write_tokens=cache_write_tokens,
+        approximate_cost=round(total_inference_cost, 6),
+        pack_chars=args.pack_chars,
+        max_chunk_size=args.max_chunk_size,
+        dedupe=args.dedupe,
+        llm_requests=sections.calls,
+        sections_inferred=len(sections.answers),
+        prefilter=args.prefilter,
+        sections_prefiltered=len(sections.skipped),
+        code_index_lookups=len(lookups),
+        similarity_searches=len(unique_chunks) - len(lookups),
+        saved_input_tokens=round(sections.saved_input_tokens),
+        saved_output_tokens=round(sections.saved_output_tokens),
+    )
+    report_path = run.out_path("test_run_report.json")
+    metrics.write_report(report_path, openmetrics=args.openmetrics)
+    print("Time per stage:")
+    metrics.print_summary()
+    print(f"Run report: {report_path}")
     print("------------------------------------------------------------")
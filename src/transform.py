@@ -1,12 +1,20 @@
+import argparse
+import atexit
+import functools
 import json
+import os
 import re
-import sys
-from typing import Any
+from typing import Any, Optional
 from xml.etree import ElementTree as ET
 
 from bedrock import invoke_llm
 from lxml import etree  # type: ignore
+from metrics import metrics
+from schemas import get_schema, validator_for
+from sources import open_document
+from tablemap import TableMapper
 from vectoring import SCHEMA_TYPE
+from xmljson import element_attributes, element_to_json, stream_to_json, table_to_json
 
 
 def transform_text_to_xml(text: str) -> str:
@@ -25,16 +33,24 @@ def transform_text_to_xml(text: str) -> str:
     return table
 
 
+@functools.lru_cache(maxsize=16)
+def _load_json(path: str, mtime_ns: int, size: int) -> Any:
+    # keyed on the file's stamp, so a rewritten file is read again
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_json(filepath: str) -> Any:
+    st = os.stat(filepath)
+    return _load_json(os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+
+
 def get_matching_schema(filepath: str, chunk_id: int) -> dict[str, Any]:
     """
     returns the schema for the category that the chunk belongs to
     """
-    with open(filepath, "r") as f:
-        d = json.load(f)
-    category_name = d[chunk_id]["category"]
-    with open(f"assets/{SCHEMA_TYPE}_schema.json", "r") as f:
-        schema = json.load(f)
-    return schema["properties"][category_name]
+    category_name = load_json(filepath)[chunk_id]["category"]
+    return get_schema(SCHEMA_TYPE).category(category_name)
 
 
 def llm_transform_data_to_json(data: str, schema: dict[str, Any]) -> dict[str, Any]:
@@ -71,87 +87,68 @@ def llm_transform_data_to_json(data: str, schema: dict[str, Any]) -> dict[str, A
     return j
 
 
+_table_mapper: Optional[TableMapper] = None
+
+
+def transform_table_to_json(data: str, schema: dict[str, Any], mapper: Optional[TableMapper] = None) -> Any:
+    """
+    takes tab separated table text and returns a json object following the schema
+    tables whose layout the mapper knows are transformed locally, the rest go to the LLM
+    and a valid answer is learned as the layout of their headers; an answer that does not
+    validate against the schema is asked for once more, and returned but never learned if
+    it still does not
+    the shared mapper saves its hit counts when the process exits; a mapper passed in
+    is saved by the caller
+    """
+    global _table_mapper
+    if mapper is None:
+        if _table_mapper is None:
+            _table_mapper = TableMapper()
+            # hits are only counted in memory until saved
+            atexit.register(_table_mapper.save)
+        mapper = _table_mapper
+    j = mapper.apply(data, schema)
+    if j is None:
+        validate = validator_for(schema)
+        for attempt in range(2):
+            if attempt:
+                metrics.incr("llm_retries", kind="table")
+            j = llm_transform_data_to_json(data, schema)
+            if not validate(j, ""):
+                mapper.learn(data, schema, j)
+                break
+            metrics.incr("llm_invalid_responses", kind="table")
+    return j
+
+
 def attrib_nesting_helper(element: etree.Element) -> dict[str, Any]:  # type: ignore
     """
     helper function to transform a etree.Element's attributes to a json object, including attributes
     """
-    json_data = {}
-    for attr_name, attr_value in element.attrib.items():  # type: ignore
-        json_data[attr_name] = attr_value  # type: ignore
-    return json_data  # type: ignore
+    return element_attributes(element)
 
 
-def etree_table_helper(element: etree.Element, headers: list[str] = []) -> dict[str, Any]:  # type: ignore
+def etree_table_helper(element: etree.Element) -> list[dict[str, Any]]:  # type: ignore
     """
-    helper function to transform a etree.Element's table to a json array, including attributes
+    helper function to transform a etree.Element's table to a json array, one object per row
+    keyed by the column headers
     """
-    table_list = []
-    for child in element:  # type: ignore
-        if child.tag.endswith("colgroup"):  # type: ignore
-            continue
-        if child.tag.endswith("thead"):  # type: ignore
-            for tr in child:  # type: ignore
-                for _, cell in enumerate(tr):  # type: ignore
-                    headers.append(cell.text)  # type: ignore
-        if child.tag.endswith("tbody"):  # type: ignore
-            for tr in child:  # type: ignore
-                table_dict = {}
-                for index, td in enumerate(tr):  # type: ignore
-                    table_dict[headers[index]] = etree_transform_data_to_json(td)  # type: ignore
-                table_list.append(table_dict)  # type: ignore
-
-    return table_list  # type: ignore
+    return table_to_json(element)
 
 
 def etree_text_helper(element: etree.Element) -> dict[str, Any]:  # type: ignore
     """
     helper function to transform a etree.Element's text to a json object, including attributes
     """
-    json_data = {}
-    for child in element:  # type: ignore
-        if child.tag.endswith("table"):  # type: ignore
-            json_data[child.tag[16:]] = etree_table_helper(child)  # type: ignore
-
-        if len(child) > 0:  # type: ignore
-            json_data[child.tag[16:]] = etree_transform_data_to_json(child)  # type: ignore
-
-        else:
-            if child.text is not None:  # type: ignore
-                json_data[child.tag[16:]] = {  # type: ignore
-                    ".text": child.text,  # type: ignore
-                    **attrib_nesting_helper(child),  # type: ignore
-                }  # type: ignore
-            else:
-                json_data[child.tag[16:]] = attrib_nesting_helper(child)  # type: ignore
-
-    return json_data  # type: ignore
+    return element_to_json(element)
 
 
 def etree_transform_data_to_json(element: etree.Element) -> dict[str, Any]:  # type: ignore
     """
     transform a etree.Element to a json object, including attributes
+    see xmljson for the structure; repeated child elements become lists
     """
-    json_data = {}
-    for child in element:  # type: ignore
-        if child.tag.endswith("text"):  # type: ignore
-            json_data[child.tag[16:]] = etree_text_helper(child)  # type: ignore
-
-        # if child.tag.endswith("table"):  # type: ignore
-        #     json_data[child.tag[16:]] = etree_table_helper(child)  # type: ignore
-
-        elif len(child) > 0:  # type: ignore
-            json_data[child.tag[16:]] = etree_transform_data_to_json(child)  # type: ignore
-
-        else:
-            if child.text is not None:  # type: ignore
-                json_data[child.tag[16:]] = {  # type: ignore
-                    "content": child.text,  # type: ignore
-                    **attrib_nesting_helper(child),  # type: ignore
-                }  # type: ignore
-            else:
-                json_data[child.tag[16:]] = attrib_nesting_helper(child)  # type: ignore
-
-    return json_data  # type: ignore
+    return element_to_json(element)
 
 
 def remove_xml_comments(tree: ET.ElementTree) -> ET.ElementTree:  # type: ignore
@@ -175,15 +172,22 @@ def tree_to_string(tree: etree._Element) -> str:  # type: ignore
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("usage: python transform.py <filepath>")
-        exit(1)
-
-    filepath = sys.argv[1]
-    with open(filepath, "r") as f:
-        parser = etree.XMLParser(remove_blank_text=True)  # type: ignore # To preserve line numbers
-        tree = etree.parse(filepath, parser)  # type: ignore
-    j = etree_transform_data_to_json(tree.getroot())  # type: ignore
-
-    with open("out/transform.json", "w") as f:
-        json.dump(j, f, indent=2)
+    parser = argparse.ArgumentParser(usage="python transform.py <filepath> [--output out/transform.json] [--stream]")
+    parser.add_argument("filepath", help="xml file, compressed or not, <archive>:<member>, or - for stdin")
+    parser.add_argument("--output", default="out/transform.json")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write compact json while parsing, in constant memory, for very large documents",
+    )
+    args = parser.parse_args()
+
+    document = open_document(args.filepath)
+    with open(args.output, "w") as f:
+        if args.stream:
+            stream_to_json(document.open, f)
+        else:
+            parser = etree.XMLParser(remove_blank_text=True)  # type: ignore # To preserve line numbers
+            with document.open() as source:
+                tree = etree.parse(source, parser)  # type: ignore
+            json.dump(etree_transform_data_to_json(tree.getroot()), f, indent=2)  # type: ignore
@@ -1,23 +1,42 @@
 import json
 import re
-from typing import Any
+from typing import Any, Optional
 
-from bedrock import invoke_embedding, invoke_llm, llm_model_id
+from bedrock import anthropic_request, complete, invoke_embedding, llm_model_id
+from metrics import metrics
+from records import parse_category
+from schemas import get_schema
 
 # choose schema type here
 SCHEMA_TYPE = "hl7"
 
 
 def get_categories_from_file(type: str) -> list[str]:
-    with open(f"src/assets/{type}_schema.json", "r") as f:
-        schema = json.load(f)
-    categories = schema["properties"]
-    return list(categories.keys())
+    # loaded once per process by the schema registry, re-read only if the file changes
+    return list(get_schema(type).categories)
 
 
-def get_category(text: str) -> str:
+# max_tokens of the second try when the first answer is cut off or has no valid <category>
+CATEGORY_RETRY_MAX_TOKENS = 1000
+
+
+def category_max_tokens(categories: list[str]) -> int:
+    """
+    max_tokens for a category answer: the <category></category> tags around the longest
+    category name (~3 characters per token), with room for a short preamble
+    """
+    return (len("<category></category>") + max(len(c) for c in categories)) // 3 + 32
+
+
+def get_category(text: str) -> Optional[str]:
+    """
+    the LLM's category for a text, asked again with CATEGORY_RETRY_MAX_TOKENS if the
+    answer was cut off or is not one of the categories
+    returns None if no answer names a category at all
+    """
     categories = get_categories_from_file(SCHEMA_TYPE)
-    prompt = """ You will be given a block of text and a list of categories. Your task is to choose the single most appropriate category that best describes the text.
+    # everything but the text block is the same on every call and forms the cacheable prefix
+    instructions = """ You will be given a block of text and a list of categories. Your task is to choose the single most appropriate category that best describes the text.
 
         Important rules:
         You must choose one category from the provided list.
@@ -27,27 +46,28 @@ def get_category(text: str) -> str:
         The available categories are:"""
 
     for i, c in enumerate(categories):
-        prompt += f"{i+1}. {c}, "
-    prompt = prompt[:-2] + ".\n\n"
-    prompt += "Text block:\n"
+        instructions += f"{i+1}. {c}, "
+    instructions = instructions[:-2] + ".\n\n"
+    instructions += "Please respond with the name of the category in XML format, e.g. <category>category_name</category>."
+    prompt = "Text block:\n"
     prompt += text
-    prompt += "\n\nWhich category best describes the text? Please respond with the name of the category in XML format, e.g. <category>category_name</category>."
-
-    request_body = {  # type: ignore
-        "anthropic_version": "bedrock-2023-05-31",
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 1000,
-    }
-
-    response = invoke_llm(
-        json.dumps(request_body), llm_model_id
-    )
-    response_body = json.loads(response["body"].read())  # type: ignore
-    response_text = response_body["content"][0]["text"]
+    prompt += "\n\nWhich category best describes the text?"
+
+    response_text = ""
+    for attempt, max_tokens in enumerate([category_max_tokens(categories), CATEGORY_RETRY_MAX_TOKENS]):
+        if attempt:
+            metrics.incr("llm_retries", kind="category")
+        request_body = anthropic_request(instructions, prompt, max_tokens, llm_model_id)
+        response_text, _, _ = complete(request_body, {"category": 1}, llm_model_id)
+        try:
+            return parse_category(response_text, categories)
+        except ValueError:
+            metrics.incr("llm_invalid_responses", kind="category")
+    # keep whatever the model put in the tag, as before validation
     match = re.search(r"<category>(.*?)</category>", response_text)
-    if match:
-        return match.group(1)
-    return ""
+    if match and match.group(1).strip():
+        return match.group(1).strip()
+    return None
 
 
 def get_bedrock_embeddings(data: dict[str, Any]) -> dict[str, Any]:
@@ -70,9 +90,20 @@ def get_bedrock_embeddings(data: dict[str, Any]) -> dict[str, Any]:
     return r
 
 
-def get_bedrock_embeddings_with_category(data: dict[str, Any]) -> dict[str, Any]:
+def get_bedrock_embeddings_with_category(data: dict[str, Any], category: Optional[str] = None) -> Optional[dict[str, Any]]:
+    """
+    embedding of a reference chunk with its category, asked of the LLM unless given
+    (e.g. by the section code index); the section code and template id are kept so the
+    code index can be built from the embeddings
+    returns None, without embedding the chunk, if the LLM names no category for it
+    """
+    if category is None:
+        category = get_category(data["text"])
+        if category is None:
+            return None
     e = get_bedrock_embeddings(data)
-    category = get_category(data["text"])
     e["xml"] = data["xml"]
     e["category"] = category
+    e["section_code"] = data.get("section_code")
+    e["section_template_id"] = data.get("section_template_id")
     return e
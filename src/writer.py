@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+from typing import Any, Iterator
+
+
+class NdjsonJournal:
+    """
+    append-only newline-delimited json file
+    every record is flushed and fsynced as soon as it is written so that a crash
+    loses at most the record being written
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        _truncate_partial_line(path)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, record: dict[str, Any]) -> None:
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    @staticmethod
+    def read(path: str) -> Iterator[dict[str, Any]]:
+        """
+        yields the records of a journal, ignoring a truncated last line
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    break
+
+
+def _truncate_partial_line(path: str) -> None:
+    """
+    drops a half written last record left behind by a crash, so appends start on a fresh line
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+class InferenceWriter:
+    """
+    streams per-chunk xml entries to an output document as they complete
+
+    every entry is first appended to an ndjson journal next to the output
+    (<output>.ndjson), in whatever order chunks finish. the xml document itself is
+    written in chunk order: an entry is copied to it as soon as every entry before
+    it has arrived, and </root> is written by close(), so the xml is well-formed
+    once the run finishes and the journal always holds everything paid for.
+
+    with resume=True the journal of a previous run is loaded, completed() reports
+    which chunks can be skipped and the xml is rewritten from the journal.
+    """
+
+    def __init__(self, output_path: str, resume: bool = False, root_tag: str = "root"):
+        self.output_path = output_path
+        self.journal_path = output_path + ".ndjson"
+        self.root_tag = root_tag
+        self._lock = threading.Lock()
+        self._pending: dict[int, str] = {}
+        self._next = 0
+
+        if not resume and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        for record in NdjsonJournal.read(self.journal_path):
+            self._pending[record["index"]] = record["xml"]
+
+        self._journal = NdjsonJournal(self.journal_path)
+        self._out = open(output_path, "w", encoding="utf-8")
+        self._out.write(f"<{root_tag}>\n")
+        with self._lock:
+            self._drain()
+
+    def completed(self) -> set[int]:
+        """
+        indices of the chunks already written (including those loaded on resume)
+        """
+        with self._lock:
+            return set(range(self._next)) | set(self._pending)
+
+    def write(self, index: int, xml: str) -> None:
+        """
+        records the entry for chunk `index`; safe to call from several threads
+        """
+        self._journal.append({"index": index, "xml": xml})
+        with self._lock:
+            self._pending[index] = xml
+            self._drain()
+
+    def _drain(self) -> None:
+        while self._next in self._pending:
+            self._out.write(self._pending.pop(self._next))
+            self._next += 1
+        self._out.flush()
+
+    def close(self) -> None:
+        """
+        writes any entries still waiting on a missing predecessor and closes the document
+        """
+        with self._lock:
+            for index in sorted(self._pending):
+                self._out.write(self._pending[index])
+            self._pending.clear()
+            self._out.write(f"</{self.root_tag}>\n")
+            self._out.close()
+        self._journal.close()
+
+    def __enter__(self) -> "InferenceWriter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if not self._out.closed:
+            self.close()
@@ -0,0 +1,256 @@
+import json
+from typing import IO, Any, Callable, Optional, Union
+
+from lxml import etree  # type: ignore
+
+# conversion of an XML element to a json value:
+#   element without child elements  {**attributes, "content": text}
+#                                   (".text" instead of "content" directly under a <text>)
+#   element with child elements     {**attributes, <child name>: <child value>, ..., ".text": mixed text}
+#                                   a child name that occurs more than once maps to a list
+#   <table>                         list of rows, each {header: cell value}
+# tag and attribute names lose their namespace, comments and processing instructions are skipped
+
+
+def local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def element_attributes(element: Any) -> dict[str, Any]:
+    """
+    attributes of an element, without namespaces
+    """
+    return {local_name(k): v for k, v in element.attrib.items()}
+
+
+def _text_key(parent_name: str) -> str:
+    return ".text" if parent_name == "text" else "content"
+
+
+def _children(element: Any) -> list[Any]:
+    return [c for c in element if isinstance(c.tag, str)]
+
+
+def _mixed_text(element: Any, children: list[Any]) -> str:
+    return " ".join("".join([element.text or ""] + [c.tail or "" for c in children]).split())
+
+
+def table_to_json(table: Any) -> list[dict[str, Any]]:
+    """
+    rows of a <table>, each mapping the column header (or the column number if there is
+    none) to the value of the cell
+    """
+    headers: list[str] = []
+    rows: list[Any] = []
+    for part in _children(table):
+        name = local_name(part.tag)
+        if name == "thead":
+            for tr in _children(part):
+                headers = ["".join(cell.itertext()).strip() for cell in _children(tr)]
+        elif name in ("tbody", "tfoot"):
+            rows.extend(_children(part))
+        elif name == "tr":
+            rows.append(part)
+    table_rows: list[dict[str, Any]] = []
+    for tr in rows:
+        row: dict[str, Any] = {}
+        for index, cell in enumerate(_children(tr)):
+            header = headers[index] if index < len(headers) and headers[index] else str(index)
+            row[header] = _convert(cell, "tr")
+        table_rows.append(row)
+    return table_rows
+
+
+class _Frame:
+    __slots__ = ("element", "name", "parent_name", "value", "lists", "children", "child_elements")
+
+    def __init__(self, element: Any, parent_name: str):
+        self.element = element
+        self.name = local_name(element.tag)
+        self.parent_name = parent_name
+        self.value = element_attributes(element)
+        self.lists: set[str] = set()
+        self.child_elements = _children(element)
+        self.children = iter(self.child_elements)
+
+    def add(self, key: str, value: Any) -> None:
+        if key in self.lists:
+            self.value[key].append(value)
+        elif key in self.value:
+            self.value[key] = [self.value[key], value]
+            self.lists.add(key)
+        else:
+            self.value[key] = value
+
+    def finish(self) -> dict[str, Any]:
+        if not self.child_elements:
+            if self.element.text is not None:
+                self.value[_text_key(self.parent_name)] = self.element.text
+        else:
+            text = _mixed_text(self.element, self.child_elements)
+            if text:
+                self.value[".text"] = text
+        return self.value
+
+
+def _convert(element: Any, parent_name: str = "") -> Any:
+    if local_name(element.tag) == "table":
+        return table_to_json(element)
+    frames = [_Frame(element, parent_name)]
+    while True:
+        frame = frames[-1]
+        child = next(frame.children, None)
+        if child is None:
+            frames.pop()
+            value = frame.finish()
+            if not frames:
+                return value
+            frames[-1].add(frame.name, value)
+        elif local_name(child.tag) == "table":
+            frame.add("table", table_to_json(child))
+        else:
+            frames.append(_Frame(child, frame.name))
+
+
+def element_to_json(element: Any) -> dict[str, Any]:
+    """
+    json value of an element (lxml or xml.etree) and everything below it, without recursion
+    """
+    return _convert(element)
+
+
+def _repeats(source: Any) -> tuple[dict[int, set[str]], set[int]]:
+    """
+    first pass of stream_to_json: for every element (by document order) the child names
+    that occur more than once, and the elements whose repeated children are not adjacent
+    """
+    repeated: dict[int, set[str]] = {}
+    scattered: set[int] = set()
+    # per open element: index, child names seen, name of the previous child, repeated names
+    stack: list[tuple[int, set[str], list[str], set[str]]] = []
+    index = 0
+    for event, element in etree.iterparse(source, events=("start", "end"), remove_comments=True, huge_tree=True):
+        if event == "start":
+            if stack:
+                _, seen, previous, names = stack[-1]
+                name = local_name(element.tag)
+                if name in seen:
+                    names.add(name)
+                    if previous[0] != name:
+                        scattered.add(stack[-1][0])
+                seen.add(name)
+                previous[0] = name
+            stack.append((index, set(), [""], set()))
+            index += 1
+        else:
+            i, _, _, names = stack.pop()
+            if names:
+                repeated[i] = names
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    return repeated, scattered
+
+
+class _StreamFrame:
+    __slots__ = ("name", "parent_name", "repeated", "open_list", "first", "has_children", "tails")
+
+    def __init__(self, name: str, parent_name: str, repeated: set[str], first: bool):
+        self.name = name
+        self.parent_name = parent_name
+        self.repeated = repeated
+        self.open_list: Optional[str] = None
+        self.first = first
+        self.has_children = False
+        self.tails: list[str] = []
+
+
+def stream_to_json(source: Union[str, IO[bytes], Callable[[], IO[bytes]]], out: IO[str]) -> None:
+    """
+    writes element_to_json of the document's root element to `out` as it is parsed,
+    producing the same json as json.dump(element_to_json(root), out)
+
+    the document is parsed twice, once to find which children repeat and once to write;
+    elements are discarded as soon as they are written, so memory stays flat however large
+    the document is. tables, and the rare element whose repeated children are not adjacent,
+    are converted in memory once complete
+
+    `source` is a path, a seekable binary stream, or a function opening a new stream of
+    the document for each pass (e.g. sources.Document.open for a compressed file)
+    """
+    if callable(source):
+        with source() as f:
+            repeated, scattered = _repeats(f)
+        with source() as f:
+            _write_json(f, out, repeated, scattered)
+        return
+    repeated, scattered = _repeats(source)
+    if hasattr(source, "seek"):
+        source.seek(0)  # type: ignore
+    _write_json(source, out, repeated, scattered)
+
+
+def _write_json(source: Union[str, IO[bytes]], out: IO[str], repeated: dict[int, set[str]], scattered: set[int]) -> None:
+    """
+    second pass of stream_to_json
+    """
+    stack: list[_StreamFrame] = []
+    index = 0
+    buffered = 0  # depth inside an element that is converted in memory once complete
+    for event, element in etree.iterparse(source, events=("start", "end"), remove_comments=True, huge_tree=True):
+        if event == "start":
+            i = index
+            index += 1
+            if buffered:
+                buffered += 1
+                continue
+            name = local_name(element.tag)
+            parent = stack[-1] if stack else None
+            if parent is not None:
+                if parent.open_list == name:
+                    out.write(", ")
+                else:
+                    if parent.open_list is not None:
+                        out.write("]")
+                        parent.open_list = None
+                    out.write(("" if parent.first else ", ") + json.dumps(name) + ": ")
+                    if name in parent.repeated:
+                        out.write("[")
+                        parent.open_list = name
+                parent.first = False
+                parent.has_children = True
+            if name == "table" or i in scattered:
+                buffered = 1
+                continue
+            attributes = element_attributes(element)
+            out.write(json.dumps(attributes)[:-1] if attributes else "{")
+            stack.append(_StreamFrame(name, parent.name if parent else "", repeated.get(i, set()), not attributes))
+            continue
+
+        if buffered:
+            buffered -= 1
+            if buffered:
+                continue
+            out.write(json.dumps(_convert(element, stack[-1].name if stack else "")))
+        else:
+            frame = stack.pop()
+            if frame.open_list is not None:
+                out.write("]")
+            children = _children(element)
+            if not frame.has_children:
+                if element.text is not None:
+                    out.write(("" if frame.first else ", ") + json.dumps(_text_key(frame.parent_name)) + ": ")
+                    out.write(json.dumps(element.text))
+            else:
+                text = " ".join("".join([element.text or ""] + frame.tails + [c.tail or "" for c in children]).split())
+                if text:
+                    out.write(("" if frame.first else ", ") + '".text": ' + json.dumps(text))
+            out.write("}")
+        # the tails of earlier siblings are complete now, keep them for the parent's mixed text
+        parent_element = element.getparent()
+        while element.getprevious() is not None:
+            previous = parent_element[0]
+            if stack and isinstance(previous.tag, str):
+                stack[-1].tails.append(previous.tail or "")
+            del parent_element[0]
+        element.clear(keep_tail=True)